@@ -0,0 +1,66 @@
+"""Measures how long 'import sentinelloader' takes in a fresh interpreter and which modules take most of it (using python -X importtime).
+Exits with status 1 if the median import time is above --max-seconds, so it can be used to keep startup low.
+
+    python benchmarks/import_time.py --runs 5 --top 15 --max-seconds 2
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importTime(module, env):
+    """Returns (seconds, {module: cumulative microseconds}) of importing module in a new interpreter"""
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if p.returncode != 0:
+        raise Exception("Could not import %s. err=%s" % (module, p.stderr.strip().splitlines()[-1:]))
+    modules = {}
+    for line in p.stderr.splitlines():
+        #import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].rstrip()
+        #only top level packages, as their cumulative time includes their submodules
+        if len(name) - len(name.lstrip()) == 1:
+            modules[name.strip()] = int(fields[1])
+    return seconds, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures sentinelloader import time')
+    parser.add_argument('--module', default='sentinelloader')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest modules to show')
+    parser.add_argument('--max-seconds', type=float, help='fail if the median import time is above this')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    times = []
+    modules = None
+    for i in range(args.runs):
+        seconds, modules = importTime(args.module, env)
+        times.append(seconds)
+
+    median = float(np.median(times))
+    print('import %s: median %.3fs min %.3fs max %.3fs (%d runs, including interpreter startup)' % (args.module, median, min(times), max(times), args.runs))
+    print('slowest top level imports of the last run:')
+    for name, us in sorted(modules.items(), key=lambda m: -m[1])[:args.top]:
+        print('  %8.3fs  %s' % (us/1e6, name))
+
+    if args.max_seconds is not None and median > args.max_seconds:
+        print('median import time %.3fs is above %.3fs' % (median, args.max_seconds))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""Local stand-in for the Copernicus catalogue and OData endpoints used by Sentinel2Loader, serving synthetic Level-2A products.
+Tiles are GeoTIFF files served as .jp2 (GDAL identifies files by their contents), so no JPEG2000 driver is needed"""
+import os
+import re
+import json
+import threading
+import hashlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+from shapely.geometry import Polygon
+from shapely.wkt import loads
+
+from sentinelloader.utils import transformCoordinates
+
+RESOLUTIONS = {'10m': 10, '20m': 20, '60m': 60}
+BANDS = {
+    '10m': ['B02', 'B03', 'B04', 'B08', 'TCI'],
+    '20m': ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B11', 'B12', 'B8A', 'SCL', 'TCI'],
+    '60m': ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B09', 'B11', 'B12', 'B8A', 'SCL', 'TCI'],
+}
+
+MTD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-2A_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-2A.xsd">
+<n1:General_Info>
+<Product_Info>
+<PRODUCT_START_TIME>%(startTime)s</PRODUCT_START_TIME>
+<PRODUCT_TYPE>S2MSI2A</PRODUCT_TYPE>
+<Product_Organisation>
+<Granule_List>
+<Granule datastripIdentifier="%(granule)s" granuleIdentifier="%(granule)s" imageFormat="JPEG2000">
+%(imageFiles)s
+</Granule>
+</Granule_List>
+</Product_Organisation>
+</Product_Info>
+</n1:General_Info>
+<n1:Quality_Indicators_Info>
+<Cloud_Coverage_Assessment>%(cloudCoverage)s</Cloud_Coverage_Assessment>
+<Image_Content_QI>
+<CLOUDY_PIXEL_PERCENTAGE>%(cloudCoverage)s</CLOUDY_PIXEL_PERCENTAGE>
+</Image_Content_QI>
+</n1:Quality_Indicators_Info>
+</n1:Level-2A_User_Product>
+"""
+
+
+def _tileName(column, row):
+    return "T23L%s%s" % (chr(ord('A') + column), chr(ord('A') + row))
+
+
+def _writeBand(filename, bandName, bounds, resolutionMeters, seed):
+    """Writes a synthetic band covering bounds (EPSG:3857) as a tiled GeoTIFF"""
+    cols = int(round((bounds[2]-bounds[0])/resolutionMeters))
+    rows = int(round((bounds[3]-bounds[1])/resolutionMeters))
+    rng = np.random.RandomState(seed)
+    if bandName == 'SCL':
+        count, dataType = 1, gdal.GDT_Byte
+        #mostly vegetation and bare soil with some clouds, in blocks so that visibility varies along the tile
+        classes = np.array([4, 4, 4, 5, 5, 6, 8, 9, 10, 3], dtype=np.uint8)
+        blocks = rng.randint(0, len(classes), size=((rows+63)//64, (cols+63)//64))
+        data = [np.kron(classes[blocks], np.ones((64, 64), dtype=np.uint8))[:rows, :cols]]
+    elif bandName == 'TCI':
+        count, dataType = 3, gdal.GDT_Byte
+        data = [rng.randint(0, 256, size=(rows, cols)).astype(np.uint8) for i in range(3)]
+    else:
+        count, dataType = 1, gdal.GDT_UInt16
+        data = [rng.randint(1, 10000, size=(rows, cols)).astype(np.uint16)]
+
+    ds = gdal.GetDriverByName('GTiff').Create(filename, cols, rows, count, dataType, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform([bounds[0], resolutionMeters, 0, bounds[3], 0, -resolutionMeters])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    ds.SetProjection(srs.ExportToWkt())
+    for i in range(count):
+        ds.GetRasterBand(i+1).WriteArray(data[i])
+    ds = None
+
+
+def _gmlFootprint(bounds):
+    """GML footprint (lat,lon pairs) of bounds in EPSG:3857, in the format returned by the catalogue"""
+    xs = [bounds[0], bounds[0], bounds[2], bounds[2], bounds[0]]
+    ys = [bounds[3], bounds[1], bounds[1], bounds[3], bounds[3]]
+    lons, lats = transformCoordinates(xs, ys, sourceEpsg=3857, targetEpsg=4326)
+    coords = " ".join(["%s,%s" % (lat, lon) for lon, lat in zip(lons, lats)])
+    return '<gml:Polygon xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>%s</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>' % coords
+
+
+def generateProducts(outputDir, origin=(-47.95, -16.05), tileColumns=2, tileRows=2, tilePixels=1098, dateFrom='2019-01-01', dates=10, daysStep=5):
+    """Generates synthetic Level-2A products for a grid of tileColumns x tileRows adjacent tiles with its top left corner at origin (lon, lat),
+       one product per tile every daysStep days. Tiles have tilePixels pixels at 10m. Returns a dataframe in the format of SentinelAPI.to_dataframe().
+       Products already generated in outputDir are reused"""
+    catalogue_file = os.path.join(outputDir, 'catalogue-%s.json' % hashlib.md5(json.dumps([origin, tileColumns, tileRows, tilePixels, dateFrom, dates, daysStep]).encode()).hexdigest())
+    if os.path.isfile(catalogue_file):
+        with open(catalogue_file, 'r') as fr:
+            return _catalogueDataframe(json.load(fr))
+
+    xs, ys = transformCoordinates([origin[0]], [origin[1]], sourceEpsg=4326, targetEpsg=3857)
+    tileSize = tilePixels*10
+    rows = []
+    for d in range(dates):
+        dateObj = datetime.strptime(dateFrom, '%Y-%m-%d') + timedelta(days=d*daysStep)
+        sensing = dateObj.strftime('%Y%m%dT132231')
+        for column in range(tileColumns):
+            for row in range(tileRows):
+                tileName = _tileName(column, row)
+                bounds = (xs[0] + column*tileSize, ys[0] - (row+1)*tileSize, xs[0] + (column+1)*tileSize, ys[0] - row*tileSize)
+                productUuid = hashlib.md5(("%s-%s" % (sensing, tileName)).encode()).hexdigest()
+                productUuid = "%s-%s-%s-%s-%s" % (productUuid[0:8], productUuid[8:12], productUuid[12:16], productUuid[16:20], productUuid[20:32])
+                title = "S2A_MSIL2A_%s_N0211_R038_%s_%s" % (sensing, tileName, dateObj.strftime('%Y%m%dT153000'))
+                granule = "L2A_%s_A018000_%s" % (tileName, sensing)
+                cloudCoverage = float((d*7 + column*3 + row*5) % 60)
+
+                productDir = os.path.join(outputDir, productUuid)
+                os.makedirs(productDir, exist_ok=True)
+                imageFiles = []
+                for resolution in BANDS:
+                    for bandName in BANDS[resolution]:
+                        imageName = "%s_%s_%s_%s" % (tileName, sensing, bandName, resolution)
+                        imageFiles.append("<IMAGE_FILE>GRANULE/%s/IMG_DATA/R%s/%s</IMAGE_FILE>" % (granule, resolution, imageName))
+                        _writeBand(os.path.join(productDir, imageName + '.jp2'), bandName, bounds, RESOLUTIONS[resolution], d*1000 + column*10 + row)
+                with open(os.path.join(productDir, 'MTD_MSIL2A.xml'), 'w') as fw:
+                    fw.write(MTD_TEMPLATE % {'startTime': dateObj.strftime('%Y-%m-%dT13:22:31.024Z'), 'granule': granule,
+                                             'imageFiles': "\n".join(imageFiles), 'cloudCoverage': cloudCoverage})
+
+                rows.append({'uuid': productUuid, 'title': title, 'producttype': 'S2MSI2A', 'platformname': 'Sentinel-2',
+                             'beginposition': dateObj.strftime('%Y-%m-%d 13:22:31'), 'ingestiondate': dateObj.strftime('%Y-%m-%d 15:30:00'),
+                             'cloudcoverpercentage': cloudCoverage, 'gmlfootprint': _gmlFootprint(bounds)})
+
+    with open(catalogue_file, 'w') as fw:
+        json.dump(rows, fw)
+    return _catalogueDataframe(rows)
+
+
+def _catalogueDataframe(rows):
+    df = pd.DataFrame(rows)
+    df.index = df['uuid'].values
+    df['beginposition'] = pd.to_datetime(df['beginposition'])
+    df['ingestiondate'] = pd.to_datetime(df['ingestiondate'])
+    return df
+
+
+class MockSentinelAPI:
+    """Implements the SentinelAPI calls used by Sentinel2Loader over a synthetic catalogue (see generateProducts)"""
+
+    def __init__(self, catalogue):
+        self.catalogue = catalogue
+        self.queries = 0
+        self._footprints = dict([(u, Polygon([(lon, lat) for lat, lon in [tuple(map(float, p.split(','))) for p in re.search('<gml:coordinates>(.*)</gml:coordinates>', g).group(1).split(' ')]]))
+                                 for u, g in zip(catalogue['uuid'], catalogue['gmlfootprint'])])
+
+    def query(self, area, date, platformname=None, producttype=None, cloudcoverpercentage=(0, 100)):
+        self.queries = self.queries + 1
+        region = loads(area)
+        #like the real API, 'YYYYMMDD' dates are midnight on both ends of the sensing date range
+        df = self.catalogue
+        df = df[(df['beginposition'] >= pd.Timestamp(date[0])) & (df['beginposition'] <= pd.Timestamp(date[1]))]
+        df = df[(df['cloudcoverpercentage'] >= cloudcoverpercentage[0]) & (df['cloudcoverpercentage'] <= cloudcoverpercentage[1])]
+        if producttype is not None:
+            df = df[df['producttype'] == producttype]
+        df = df[[self._footprints[u].intersects(region) for u in df['uuid']]]
+        return df
+
+    def to_dataframe(self, products):
+        return products.copy()
+
+
+class _ODataHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _serve(self, withBody):
+        if self.path == '/stats':
+            with self.server.statsLock:
+                self._send(200, json.dumps(self.server.stats).encode(), 'application/json', withBody)
+            return
+
+        m = re.search(r"/odata/v1/Products\('([^']+)'\)/.*Nodes\('([^']+)'\)/\$value$", self.path)
+        if m is None:
+            self._send(404, b'not found', withBody=withBody)
+            return
+        filename = os.path.join(self.server.dataDir, m.group(1), m.group(2))
+        if not os.path.isfile(filename):
+            self._send(404, b'not found', withBody=withBody)
+            return
+
+        size = os.path.getsize(filename)
+        start, end = 0, size-1
+        status = 200
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader is not None:
+            r = re.match(r"bytes=([0-9]+)-([0-9]*)", rangeHeader)
+            start = int(r.group(1))
+            if r.group(2) != '':
+                end = min(int(r.group(2)), size-1)
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(end-start+1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if not withBody:
+            return
+        with open(filename, 'rb') as fr:
+            fr.seek(start)
+            self.wfile.write(fr.read(end-start+1))
+        with self.server.statsLock:
+            self.server.stats['requests'] = self.server.stats['requests'] + 1
+            self.server.stats['bytes'] = self.server.stats['bytes'] + (end-start+1)
+
+    def _send(self, status, body, contentType='text/plain', withBody=True):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startServer(dataDir, port=0):
+    """Serves the products generated in dataDir at http://127.0.0.1:<port>/ in a background thread. Returns the server;
+       use server.apiUrl as the loader apiUrl and server.shutdown() to stop it. GET /stats returns the requests and bytes served"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _ODataHandler)
+    server.daemon_threads = True
+    server.dataDir = dataDir
+    server.stats = {'requests': 0, 'bytes': 0}
+    server.statsLock = threading.Lock()
+    server.apiUrl = 'http://127.0.0.1:%d/' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, name='mock-odata')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,202 @@
+"""Offline benchmarks for Sentinel2Loader. Runs each scenario in its own process against a local mock catalogue and OData server
+with synthetic products (see mockapi.py) and reports latency percentiles, throughput, peak memory and bytes downloaded and written.
+
+    python benchmarks/run.py --repeat 5 --dates 6 --option maxParallelDownloads=4 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import resource
+import multiprocessing
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mockapi import generateProducts, startServer, MockSentinelAPI
+from sentinelloader.utils import transformCoordinates
+
+SCENARIOS = ['tile-cold', 'tile-warm', 'multitile-cold', 'multitile-warm', 'crop', 'index-cold', 'index-warm', 'history-cold', 'history-warm']
+
+
+def _area(args, fromTile, toTile):
+    """Polygon (lon, lat) from the center of tile fromTile to the center of tile toTile ((column, row) in the synthetic grid),
+       shrunk by a quarter of a tile on each side"""
+    xs, ys = transformCoordinates([args.origin[0]], [args.origin[1]], sourceEpsg=4326, targetEpsg=3857)
+    tileSize = args.tile_pixels*10
+    minx = xs[0] + (fromTile[0]+0.25)*tileSize
+    maxx = xs[0] + (toTile[0]+0.75)*tileSize
+    maxy = ys[0] - (fromTile[1]+0.25)*tileSize
+    miny = ys[0] - (toTile[1]+0.75)*tileSize
+    lons, lats = transformCoordinates([minx, minx, maxx, maxx], [maxy, miny, miny, maxy], sourceEpsg=3857, targetEpsg=4326)
+    return list(zip(lons, lats))
+
+
+def _directorySize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total = total + os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def _createLoader(args, apiUrl, dataPath, metrics=None):
+    from sentinelloader import Sentinel2Loader
+    sl = Sentinel2Loader(dataPath, 'user', 'password', apiUrl=apiUrl, showProgressbars=False, loglevel=logging.WARNING, **args.options)
+    if metrics is not None:
+        sl.metrics = metrics
+    sl.api = MockSentinelAPI(generateProducts(args.products_dir, **_productsArgs(args)))
+    return sl
+
+
+def _productsArgs(args):
+    return {'origin': tuple(args.origin), 'tileColumns': 2, 'tileRows': 2, 'tilePixels': args.tile_pixels,
+            'dateFrom': args.date_from, 'dates': args.dates, 'daysStep': 5}
+
+
+def _operation(args, sl, scenario):
+    """Returns a function that performs one run of the scenario"""
+    single = _area(args, (0, 0), (0, 0))
+    multi = _area(args, (0, 0), (1, 1))
+    #products are sensed in the afternoon and the catalogue date range ends at midnight of the reference date,
+    #so each product is requested from the day after it was sensed
+    firstDate = (datetime.strptime(args.date_from, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    lastDate = (datetime.strptime(args.date_from, '%Y-%m-%d') + timedelta(days=(args.dates-1)*5 + 1)).strftime('%Y-%m-%d')
+
+    if scenario.startswith('tile'):
+        return lambda: sl.getProductBandTiles(single, args.band, args.resolution, lastDate)
+    if scenario.startswith('multitile'):
+        return lambda: sl.getProductBandTiles(multi, args.band, args.resolution, lastDate)
+    if scenario == 'crop':
+        tiles = sl.getProductBandTiles(multi, args.band, args.resolution, lastDate)
+        return lambda: os.remove(sl.cropRegion(multi, tiles, args.resolution))
+    if scenario.startswith('index'):
+        return lambda: os.remove(sl.getRegionIndex(single, 'NDVI', args.resolution, lastDate))
+    if scenario.startswith('history'):
+        def history():
+            for f in sl.getRegionHistory(single, args.band, args.resolution, firstDate, lastDate, daysStep=5, parallelDates=args.parallel_dates):
+                os.remove(f)
+        return history
+    raise Exception('Unknown scenario %s' % scenario)
+
+
+def _runScenario(args, apiUrl, scenario, queue):
+    try:
+        dataPath = os.path.join(args.workdir, 'cache', scenario)
+        shutil.rmtree(dataPath, ignore_errors=True)
+        cold = scenario.endswith('-cold')
+        if not cold:
+            #warm scenarios run once before measuring
+            with _createLoader(args, apiUrl, dataPath) as sl:
+                _operation(args, sl, scenario)()
+
+        from sentinelloader.metrics import Metrics
+        metrics = Metrics()
+        stats = requests.get(apiUrl + 'stats').json()
+        latencies = []
+        written = 0
+        for i in range(args.repeat):
+            runPath = dataPath
+            if cold:
+                runPath = os.path.join(dataPath, str(i))
+            with _createLoader(args, apiUrl, runPath, metrics) as sl:
+                op = _operation(args, sl, scenario)
+                sizeBefore = _directorySize(runPath)
+                start = time.perf_counter()
+                op()
+                latencies.append(time.perf_counter() - start)
+            written = written + _directorySize(runPath) - sizeBefore
+        statsAfter = requests.get(apiUrl + 'stats').json()
+
+        queue.put({'latencies': latencies, 'bytesWritten': written,
+                   'bytesDownloaded': statsAfter['bytes'] - stats['bytes'], 'requests': statsAfter['requests'] - stats['requests'],
+                   'peakRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024, 'metrics': metrics.snapshot()})
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def runScenario(args, apiUrl, scenario):
+    """Runs a scenario in a new process, so that its peak memory is not affected by previous scenarios"""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_runScenario, args=(args, apiUrl, scenario, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    if 'error' in result:
+        return {'scenario': scenario, 'error': result['error']}
+
+    latencies = np.array(result['latencies'])
+    total = float(np.sum(latencies))
+    return {'scenario': scenario, 'runs': len(latencies),
+            'latencyP50': float(np.percentile(latencies, 50)), 'latencyP90': float(np.percentile(latencies, 90)),
+            'latencyP99': float(np.percentile(latencies, 99)), 'latencyMax': float(np.max(latencies)),
+            'throughputOps': len(latencies)/total if total > 0 else None,
+            'downloadMBps': result['bytesDownloaded']/total/1e6 if total > 0 else None,
+            'bytesDownloaded': result['bytesDownloaded'], 'requests': result['requests'],
+            'bytesWritten': result['bytesWritten'], 'peakRssBytes': result['peakRssBytes'], 'metrics': result['metrics']}
+
+
+def _option(value):
+    key, v = value.split('=', 1)
+    try:
+        v = json.loads(v)
+    except ValueError:
+        pass
+    return key, v
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Sentinel2Loader benchmarks')
+    parser.add_argument('--workdir', default='/tmp/sentinelloader-benchmarks')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated list of %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dates', type=int, default=6, help='number of product dates (and history steps)')
+    parser.add_argument('--date-from', default='2019-01-01')
+    parser.add_argument('--tile-pixels', type=int, default=1098, help='synthetic tile width and height at 10m')
+    parser.add_argument('--origin', type=float, nargs=2, default=[-47.95, -16.05], help='lon lat of the top left corner of the tiles grid')
+    parser.add_argument('--band', default='B04')
+    parser.add_argument('--resolution', default='10m')
+    parser.add_argument('--parallel-dates', type=int, default=1)
+    parser.add_argument('--option', action='append', default=[], type=_option, help='Sentinel2Loader constructor option as key=value, e.g. maxParallelDownloads=4')
+    parser.add_argument('--output', help='also write results to this JSON file')
+    args = parser.parse_args()
+    args.options = dict(args.option)
+    args.products_dir = os.path.join(args.workdir, 'products')
+
+    os.makedirs(args.products_dir, exist_ok=True)
+    print('Generating synthetic products in %s' % args.products_dir)
+    generateProducts(args.products_dir, **_productsArgs(args))
+    server = startServer(args.products_dir)
+
+    results = []
+    try:
+        print('%-16s %5s %9s %9s %9s %9s %10s %12s %12s %10s' % ('scenario', 'runs', 'p50(s)', 'p90(s)', 'p99(s)', 'ops/s', 'dl(MB/s)', 'downloaded', 'written', 'rss(MB)'))
+        for scenario in args.scenarios.split(','):
+            r = runScenario(args, server.apiUrl, scenario)
+            results.append(r)
+            if 'error' in r:
+                print('%-16s failed: %s' % (scenario, r['error']))
+                continue
+            print('%-16s %5d %9.3f %9.3f %9.3f %9.2f %10.1f %12d %12d %10.1f' % (scenario, r['runs'], r['latencyP50'], r['latencyP90'], r['latencyP99'],
+                  r['throughputOps'] or 0, r['downloadMBps'] or 0, r['bytesDownloaded'], r['bytesWritten'], r['peakRssBytes']/1e6))
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as fw:
+            json.dump({'options': args.options, 'results': results}, fw, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
 from .sentinel2loader import Sentinel2Loader
+from .asyncloader import AsyncSentinel2Loader
@@ -0,0 +1,240 @@
+import os
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .sentinel2loader import Sentinel2Loader
+from .utils import acquireCacheLock, releaseCacheLock, loadFile
+from .indices import requiredBands
+
+logger = logging.getLogger('sentinelloader')
+
+
+class AsyncSentinel2Loader:
+    """asyncio counterpart of Sentinel2Loader for serving many concurrent requests from a single thread. Metadata and tiles are
+       downloaded with a shared aiohttp client, limited to maxConcurrentDownloads connections in total and maxDownloadsPerHost per host,
+       while catalogue queries and GDAL work run in executors (GDAL in a pool of maxParallelConversions threads).
+       The cache layout and locks are the same as Sentinel2Loader's, so both can share dataPath, even from different processes.
+       Other keyword arguments are passed to Sentinel2Loader (see its constructor). maxDownloadRate caps the throughput of the async downloads too,
+       while downloadRanges is not supported. Use it as an async context manager or call close() when done:
+
+           async with AsyncSentinel2Loader(dataPath, user, password) as sl:
+               files = await asyncio.gather(*[sl.getRegionBand(area, 'TCI', '10m', date) for date in dates])
+    """
+
+    def __init__(self, dataPath, user, password, maxConcurrentDownloads=20, maxDownloadsPerHost=4, maxParallelConversions=2, retries=3, **kwargs):
+        if kwargs.get('downloadRanges', 1) > 1:
+            raise Exception('downloadRanges is not supported by AsyncSentinel2Loader. Concurrent downloads are limited by maxConcurrentDownloads and maxDownloadsPerHost')
+        self.loader = Sentinel2Loader(dataPath, user, password, maxParallelConversions=maxParallelConversions, **kwargs)
+        self.dataPath = dataPath
+        self.maxConcurrentDownloads = maxConcurrentDownloads
+        self.maxDownloadsPerHost = maxDownloadsPerHost
+        self.retries = retries
+        self.metrics = self.loader.metrics
+        self._gdalPool = ThreadPoolExecutor(max_workers=maxParallelConversions, thread_name_prefix='sentinelloader-async-gdal')
+        self._session = None
+        #tiles being fetched by this process, so that concurrent requests for the same tile wait for a single download
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Closes the HTTP client and shuts down the GDAL pool and the pools of the wrapped Sentinel2Loader"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        #waiting for running GDAL tasks must not block the event loop
+        await self._run(self._gdalPool.shutdown)
+        await self._run(self.loader.close)
+
+    def _getSession(self):
+        if self._session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise Exception('AsyncSentinel2Loader requires aiohttp. Install it with "pip install aiohttp"')
+            connector = aiohttp.TCPConnector(limit=self.maxConcurrentDownloads, limit_per_host=self.maxDownloadsPerHost)
+            self._session = aiohttp.ClientSession(connector=connector, auth=aiohttp.BasicAuth(self.loader.user, self.loader.password),
+                                                  timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+        return self._session
+
+    async def _run(self, function, *args, executor=None):
+        return await asyncio.get_running_loop().run_in_executor(executor, lambda: function(*args))
+
+    async def getProductBandTiles(self, geoPolygon, bandName, resolution, dateReference):
+        """Same as Sentinel2Loader.getProductBandTiles"""
+        logger.debug("Getting contents. band=%s, resolution=%s, date=%s", bandName, resolution, dateReference)
+        productLevel, selected_df = await self._run(self.loader._selectProducts, geoPolygon, dateReference)
+        resolutionDownload = self.loader._resolutionDownload(productLevel, bandName, resolution)
+        #all tiles are fetched even if one of them fails, so that no download is left running
+        results = await asyncio.gather(*[self._getTile(sp, productLevel, bandName, resolution, resolutionDownload) for index, sp in selected_df.iterrows()],
+                                       return_exceptions=True)
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+        return results
+
+    async def getRegionBand(self, geoPolygon, bandName, resolution, dateReference):
+        """Same as Sentinel2Loader.getRegionBand"""
+        regionTileFiles = await self.getProductBandTiles(geoPolygon, bandName, resolution, dateReference)
+        return await self._run(self.loader.cropRegion, geoPolygon, regionTileFiles, resolution, executor=self._gdalPool)
+
+    async def getRegionIndex(self, geoPolygon, indexName, resolution, dateReference):
+        """Same as Sentinel2Loader.getRegionIndex. All bands required by the index are fetched concurrently"""
+        bandNames = requiredBands([indexName], self.loader.nirBand)
+        bandTiles = await asyncio.gather(*[self.getProductBandTiles(geoPolygon, b, resolution, dateReference) for b in bandNames])
+        return await self._run(self._regionIndex, geoPolygon, indexName, resolution, dict(zip(bandNames, bandTiles)), executor=self._gdalPool)
+
+    def _regionIndex(self, geoPolygon, indexName, resolution, bandTiles):
+        indices, geoTransform, projection = self.loader._regionIndicesArray(geoPolygon, [indexName], resolution, bandTiles)
+        return self.loader._saveRegionIndex(indexName, indices[indexName].astype(np.float32, copy=False), geoTransform, projection)
+
+    async def _getTile(self, sp, productLevel, bandName, resolution, resolutionDownload):
+        """Returns the cached tile file of a product band at resolution, downloading and converting it if needed"""
+        key = (sp['uuid'], bandName, resolution, resolutionDownload)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetchTile(sp, productLevel, bandName, resolution, resolutionDownload))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetchTile(self, sp, productLevel, bandName, resolution, resolutionDownload):
+        loader = self.loader
+        metadata = await self._productMetadata(sp, productLevel)
+        tile, jp2File, url = loader._tileInfo(sp, productLevel, bandName, resolutionDownload, metadata)
+        os.makedirs(os.path.dirname(tile['downloadFilename']), exist_ok=True)
+
+        if not loader.cacheTilesData or not os.path.isfile(tile['downloadFilename']):
+            #another process may be producing the same tile. the lock is released by _convertTile
+            tile['lock'] = await self._run(acquireCacheLock, self.dataPath, tile['downloadFilename'])
+            if loader.cacheTilesData and os.path.isfile(tile['downloadFilename']):
+                logger.debug('Tile data was cached while waiting for it')
+                releaseCacheLock(tile['lock'])
+                tile['lock'] = None
+                self.metrics.cacheHit('tile')
+            else:
+                self.metrics.cacheMiss('tile')
+                if loader.offline:
+                    releaseCacheLock(tile['lock'])
+                    raise Exception('Tile is not cached and downloads are disabled in offline mode. uuid=%s image=%s' % (sp['uuid'], tile['name']))
+                tile['jp2'] = jp2File
+                os.makedirs(os.path.dirname(jp2File), exist_ok=True)
+                logger.info('Downloading tile uuid=\'%s\', resolution=\'%s\', band=\'%s\', date=\'%s\'', sp['uuid'], resolutionDownload, bandName, tile['date'])
+                try:
+                    with self.metrics.stage('download'):
+                        size = await self._downloadFile(url, jp2File)
+                    self.metrics.increment('bytes_downloaded', size)
+                except BaseException:
+                    releaseCacheLock(tile['lock'])
+                    raise
+        else:
+            logger.debug('Reusing tile data from cache')
+            self.metrics.cacheHit('tile')
+
+        return await self._run(loader._convertTile, tile, bandName, resolution, resolutionDownload, executor=self._gdalPool)
+
+    async def _productMetadata(self, sp, productLevel):
+        """Same as Sentinel2Loader._productMetadata, fetching the MTD_MSIL XML with the async client"""
+        loader = self.loader
+        metadata = loader._metadata.get(sp['uuid'])
+        if metadata is not None:
+            self.metrics.cacheHit('metadata')
+            return metadata
+
+        meta_cache_file, legacy_cache_file = loader._metadataCacheFiles(sp, productLevel)
+        if loader.cacheTilesData and os.path.isfile(meta_cache_file):
+            metadata = json.loads(loadFile(meta_cache_file))
+            loader._cacheIndex.hit(meta_cache_file, 'metadata')
+            self.metrics.cacheHit('metadata')
+        else:
+            lock = await self._run(acquireCacheLock, self.dataPath, meta_cache_file)
+            try:
+                if loader.cacheTilesData and os.path.isfile(meta_cache_file):
+                    metadata = json.loads(loadFile(meta_cache_file))
+                    self.metrics.cacheHit('metadata')
+                else:
+                    self.metrics.cacheMiss('metadata')
+                    if loader.cacheTilesData and os.path.isfile(legacy_cache_file):
+                        mcontents = loadFile(legacy_cache_file)
+                    else:
+                        if loader.offline:
+                            raise Exception('Product metadata is not cached and downloads are disabled in offline mode. uuid=%s' % sp['uuid'])
+                        logger.debug('Getting metadata info for tile \'%s\' remotelly', sp['uuid'])
+                        with self.metrics.stage('metadata'):
+                            async with self._getSession().get(loader._metadataUrl(sp, productLevel)) as response:
+                                if response.status != 200:
+                                    raise Exception("Could not get metadata info. status=%s" % response.status)
+                                contents = await response.read()
+                        self.metrics.increment('bytes_downloaded', len(contents))
+                        mcontents = contents.decode("utf-8")
+                    metadata = loader._storeMetadata(sp, productLevel, mcontents)
+            finally:
+                releaseCacheLock(lock)
+
+        loader._metadata[sp['uuid']] = metadata
+        return metadata
+
+    async def _downloadFile(self, url, filepath):
+        """Downloads url contents to filepath through a '.part' file, resuming interrupted transfers with Range requests
+           (the same '.part' file as utils.downloadFile, so downloads interrupted in any of the loaders are resumed by both). Returns the file size"""
+        import aiohttp
+        part = filepath + ".part"
+        name = os.path.basename(filepath)
+        progress = self.loader.progressReporter
+        rateLimiter = self.loader.rateLimiter
+        attempt = 0
+        while True:
+            done = 0
+            if os.path.isfile(part):
+                done = os.path.getsize(part)
+            headers = {}
+            if done > 0:
+                headers['Range'] = 'bytes=%d-' % done
+            try:
+                async with self._getSession().get(url, headers=headers) as response:
+                    mode = 'ab'
+                    if response.status == 416 and done > 0:
+                        break
+                    elif response.status == 200 and done > 0:
+                        logger.debug("Server ignored range request. Restarting download of %s" % url)
+                        mode = 'wb'
+                        done = 0
+                    elif response.status not in [200, 206]:
+                        raise Exception("Could not download file. status=%s" % response.status)
+
+                    remaining = response.content_length
+                    total = None if remaining is None else done + remaining
+                    received = 0
+                    with open(part, mode) as f:
+                        async for data in response.content.iter_chunked(256*1024):
+                            f.write(data)
+                            received += len(data)
+                            if progress is not None:
+                                progress(name, done + received, total, False)
+                            if rateLimiter is not None:
+                                wait = rateLimiter.reserve(len(data))
+                                if wait > 0:
+                                    await asyncio.sleep(wait)
+                    if remaining is not None and received < remaining:
+                        raise aiohttp.ClientPayloadError("Connection closed after %d of %d bytes" % (received, remaining))
+                    break
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt = attempt + 1
+                if attempt > self.retries:
+                    raise
+                logger.warning("Download of %s interrupted. Resuming. attempt=%d err=%s" % (url, attempt, e))
+
+        os.replace(part, filepath)
+        size = os.path.getsize(filepath)
+        if progress is not None:
+            progress(name, size, size, True)
+        return size
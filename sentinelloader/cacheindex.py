@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger('sentinelloader')
+
+
+class CacheIndex:
+    """Index of the artifacts cached under dataPath (API query results, product metadata, tiles and resampled tiles).
+       It is kept in a SQLite database at dataPath/cache.sqlite with the size, last access time and number of hits of each artifact,
+       so that hits are recorded and cache cleanups are planned without walking the whole cache tree"""
+
+    def __init__(self, dataPath):
+        self.dataPath = dataPath
+        self.dbFile = os.path.join(dataPath, 'cache.sqlite')
+        self._local = threading.local()
+
+    def _connection(self):
+        #sqlite connections must not be shared among threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(self.dataPath, exist_ok=True)
+            conn = sqlite3.connect(self.dbFile, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, kind TEXT, size INTEGER, created REAL, last_access REAL, hits INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)')
+            self._local.conn = conn
+        return conn
+
+    def _key(self, path):
+        return os.path.relpath(path, self.dataPath)
+
+    def add(self, path, kind, lastAccess=None):
+        """Records a new (or rewritten) artifact file"""
+        if lastAccess is None:
+            lastAccess = time.time()
+        self._connection().execute('INSERT INTO artifacts (key, kind, size, created, last_access, hits) VALUES (?, ?, ?, ?, ?, 0) '
+                                   'ON CONFLICT (key) DO UPDATE SET kind=excluded.kind, size=excluded.size, created=excluded.created, last_access=excluded.last_access',
+                                   (self._key(path), kind, os.path.getsize(path), lastAccess, lastAccess))
+
+    def hit(self, path, kind):
+        """Records a cache hit for an artifact. Artifacts that are not indexed yet (cached before the index existed) are added"""
+        cur = self._connection().execute('UPDATE artifacts SET last_access=?, hits=hits+1 WHERE key=?', (time.time(), self._key(path)))
+        if cur.rowcount == 0:
+            self.add(path, kind)
+
+    def remove(self, path):
+        self._connection().execute('DELETE FROM artifacts WHERE key=?', (self._key(path),))
+
+    def totalSize(self):
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+
+    def evict(self, notUsedDays=None, maxBytes=None, policy='lru'):
+        """Deletes artifacts not used for more than notUsedDays and then, if maxBytes is specified, the least recently used (policy='lru')
+           or least frequently used (policy='lfu') artifacts until the total cache size is within maxBytes. Returns (files removed, bytes freed)"""
+        if policy not in ['lru', 'lfu']:
+            raise Exception('\'policy\' must be lru or lfu')
+        conn = self._connection()
+        removed = 0
+        freed = 0
+
+        if notUsedDays is not None:
+            rows = conn.execute('SELECT key, size FROM artifacts WHERE last_access < ?', (time.time() - notUsedDays*86400,)).fetchall()
+            for key, size in rows:
+                removed, freed = self._evictKey(key, size, removed, freed)
+
+        if maxBytes is not None:
+            excess = self.totalSize() - maxBytes
+            order = 'last_access ASC'
+            if policy == 'lfu':
+                order = 'hits ASC, last_access ASC'
+            if excess > 0:
+                for key, size in conn.execute('SELECT key, size FROM artifacts ORDER BY %s' % order).fetchall():
+                    if excess <= 0:
+                        break
+                    removed, freed = self._evictKey(key, size, removed, freed)
+                    excess = excess - size
+
+        logger.debug('Evicted %d cached files (%d bytes)' % (removed, freed))
+        return removed, freed
+
+    def _evictKey(self, key, size, removed, freed):
+        path = os.path.join(self.dataPath, key)
+        if os.path.isfile(path):
+            os.remove(path)
+            removed = removed + 1
+            freed = freed + size
+        self._connection().execute('DELETE FROM artifacts WHERE key=?', (key,))
+        return removed, freed
+
+    def rebuild(self):
+        """Walks the cache directories once, indexing files that are not in the index yet (using their modification time as last access)
+           and dropping index entries whose files don't exist anymore. Only needed for caches created before the index existed"""
+        kinds = {'apiquery': 'query', 'products': 'tile', 'visibility': 'visibility', 'history': 'history'}
+        for directory in kinds:
+            for root, dirs, files in os.walk(os.path.join(self.dataPath, directory)):
+                for f in files:
+                    path = os.path.join(root, f)
+                    kind = kinds[directory]
+                    if directory == 'history' and f == 'manifest.json':
+                        continue
+                    elif directory in ['visibility', 'history']:
+                        pass
+                    elif f.endswith('.xml') or f.endswith('.json'):
+                        kind = 'metadata'
+                    elif f.endswith('.vrt'):
+                        kind = 'resampled'
+                    cur = self._connection().execute('SELECT 1 FROM artifacts WHERE key=?', (self._key(path),))
+                    if cur.fetchone() is None:
+                        self.add(path, kind, lastAccess=os.path.getmtime(path))
+
+        for (key,) in self._connection().execute('SELECT key FROM artifacts').fetchall():
+            if not os.path.isfile(os.path.join(self.dataPath, key)):
+                self._connection().execute('DELETE FROM artifacts WHERE key=?', (key,))
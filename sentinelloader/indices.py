@@ -0,0 +1,101 @@
+import numpy as np
+
+#bands needed by each index. 'NIR' stands for the near infrared band configured in the loader (B08 or B8A)
+INDEX_BANDS = {
+    'NDVI': ['NIR', 'B04'],
+    'NDWI': ['NIR', 'B11'],
+    'NDWI_MacFeeters': ['B03', 'NIR'],
+    'NDMI': ['NIR', 'B11'],
+    'EVI': ['NIR', 'B04', 'B02'],
+}
+
+INDEX_NAMES = list(INDEX_BANDS.keys())
+
+INT16_NODATA = -32768
+
+
+def requiredBands(indexNames, nirBand='B08'):
+    """Returns the union of bands needed to calculate all indexNames, each band listed once"""
+    bands = []
+    for indexName in indexNames:
+        if indexName not in INDEX_BANDS:
+            raise Exception('\'indexName\' must be one of %s' % ', '.join(INDEX_NAMES))
+        for band in INDEX_BANDS[indexName]:
+            if band == 'NIR':
+                band = nirBand
+            if band not in bands:
+                bands.append(band)
+    return bands
+
+
+def _normalizedDifference(a, b):
+    num = np.subtract(a, b)
+    den = np.add(a, b)
+    np.divide(num, den, out=num)
+    return num, den == 0
+
+
+def _evi(nir, red, blue):
+    # index = 2.5 * (B08 - B04) / ((B08 + 6.0 * B04 - 7.5 * B02) + 1.0)
+    #https://github.com/sentinel-hub/custom-scripts/tree/master/sentinel-2
+    den = np.multiply(red, 6.0)
+    den += nir
+    den -= np.multiply(blue, 7.5)
+    den += 1.0
+    num = np.subtract(nir, red)
+    num *= 2.5
+    np.divide(num, den, out=num)
+    return num, den == 0
+
+
+_INDEX_FUNCTIONS = {
+    'NDVI': lambda b: _normalizedDifference(b('NIR'), b('B04')),
+    'NDWI': lambda b: _normalizedDifference(b('NIR'), b('B11')),
+    'NDWI_MacFeeters': lambda b: _normalizedDifference(b('B03'), b('NIR')),
+    'NDMI': lambda b: _normalizedDifference(b('NIR'), b('B11')),
+    'EVI': lambda b: _evi(b('NIR'), b('B04'), b('B02')),
+}
+
+
+def calculateIndices(indexNames, bands, nirBand='B08', nodata=None, scale=None, blockRows=512):
+    """Calculates indexNames from bands (a dict of band name -> 2D array, all with the same shape) and returns a dict of index name -> 2D array.
+       Calculations are done in float32 over blocks of blockRows rows, so that temporary arrays are only as big as a block.
+       Pixels where the divisor is zero or where any of the index source bands is 0 (no data) are set to nodata.
+       If scale is specified, values are multiplied by it and returned as int16 (e.g. scale=10000 keeps 4 decimal places in a quarter of float64 size)
+       and nodata defaults to -32768, otherwise arrays are float32 and nodata defaults to NaN"""
+    shape = np.shape(bands[requiredBands(indexNames, nirBand)[0]])
+    dtype = np.float32
+    if scale is not None:
+        dtype = np.int16
+    if nodata is None:
+        nodata = np.nan if scale is None else INT16_NODATA
+
+    indices = {}
+    for indexName in indexNames:
+        indices[indexName] = np.empty(shape, dtype=dtype)
+
+    for r in range(0, shape[0], blockRows):
+        block = {}
+        for band in requiredBands(indexNames, nirBand):
+            block[band] = np.asarray(bands[band][r:r+blockRows], dtype=np.float32)
+
+        def b(band):
+            if band == 'NIR':
+                band = nirBand
+            return block[band]
+
+        for indexName in indexNames:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values, invalid = _INDEX_FUNCTIONS[indexName](b)
+            for band in requiredBands([indexName], nirBand):
+                invalid |= block[band] == 0
+            invalid |= ~np.isfinite(values)
+
+            if scale is not None:
+                values *= scale
+                np.rint(values, out=values)
+                np.clip(values, -32767, 32767, out=values)
+            values[invalid] = nodata
+            indices[indexName][r:r+blockRows] = values
+
+    return indices
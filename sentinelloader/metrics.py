@@ -0,0 +1,162 @@
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('sentinelloader')
+
+CACHE_LAYERS = ['query', 'metadata', 'tile', 'resampled', 'visibility', 'history']
+
+
+class Metrics:
+    """Thread safe stage timings, counters and cache hits/misses per cache layer. Hooks added with addHook(hook) are called
+       as hook(kind, name, value) for every record: kind 'stage' (value in seconds), 'counter' (increment) or 'cache' (value 'hit' or 'miss')"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.cache = dict([(layer, {'hits': 0, 'misses': 0}) for layer in CACHE_LAYERS])
+
+    def addHook(self, hook):
+        self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._hooks.remove(hook)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as stage name. Failed blocks are timed too"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.recordStage(name, time.perf_counter() - start)
+
+    def recordStage(self, name, seconds):
+        with self._lock:
+            s = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0})
+            s['count'] = s['count'] + 1
+            s['seconds'] = s['seconds'] + seconds
+            s['maxSeconds'] = max(s['maxSeconds'], seconds)
+        self._notify('stage', name, seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self._notify('counter', name, value)
+
+    def cacheHit(self, layer):
+        self._cacheEvent(layer, 'hits')
+        self._notify('cache', layer, 'hit')
+
+    def cacheMiss(self, layer):
+        self._cacheEvent(layer, 'misses')
+        self._notify('cache', layer, 'miss')
+
+    def _cacheEvent(self, layer, event):
+        with self._lock:
+            c = self.cache.setdefault(layer, {'hits': 0, 'misses': 0})
+            c[event] = c[event] + 1
+
+    def _notify(self, kind, name, value):
+        for hook in list(self._hooks):
+            try:
+                hook(kind, name, value)
+            except Exception as e:
+                logger.warning("Metrics hook failed. err=%s" % e)
+
+    def snapshot(self):
+        """Returns a copy of all metrics as a dict with 'stages', 'counters' and 'cache'"""
+        with self._lock:
+            return json.loads(json.dumps({'stages': self.stages, 'counters': self.counters, 'cache': self.cache}))
+
+    def toJson(self, indent=None):
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def toPrometheus(self, prefix='sentinelloader'):
+        """Returns the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = ['# TYPE %s_stage_seconds summary' % prefix]
+        for name in sorted(snapshot['stages']):
+            s = snapshot['stages'][name]
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (prefix, name, s['count']))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (prefix, name, s['seconds']))
+        lines.append('# TYPE %s_stage_max_seconds gauge' % prefix)
+        for name in sorted(snapshot['stages']):
+            lines.append('%s_stage_max_seconds{stage="%s"} %f' % (prefix, name, snapshot['stages'][name]['maxSeconds']))
+        for name in sorted(snapshot['counters']):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %s' % (prefix, name, snapshot['counters'][name]))
+        for event in ['hits', 'misses']:
+            lines.append('# TYPE %s_cache_%s_total counter' % (prefix, event))
+            for layer in sorted(snapshot['cache']):
+                lines.append('%s_cache_%s_total{layer="%s"} %d' % (prefix, event, layer, snapshot['cache'][layer][event]))
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(metrics, name):
+    """Same as metrics.stage(name), doing nothing if metrics is None"""
+    if metrics is None:
+        yield
+        return
+    with metrics.stage(name):
+        yield
+
+
+class ProgressBar:
+    """Download progress reporter that draws a progress bar on a stream (stdout by default). It is redrawn only when it changes.
+       Progress reporters are called as reporter(name, downloaded, total, finished), with total None when unknown"""
+
+    def __init__(self, stream=None, width=50):
+        self.stream = stream
+        self.width = width
+        self._lock = threading.Lock()
+        self._drawn = {}
+
+    def __call__(self, name, downloaded, total, finished):
+        stream = self.stream if self.stream is not None else sys.stdout
+        with self._lock:
+            if finished:
+                if self._drawn.pop(name, None) is not None:
+                    stream.write("\n")
+                    stream.flush()
+                return
+            if not total:
+                return
+            done = min(self.width, int(self.width * downloaded / total))
+            if done != self._drawn.get(name):
+                self._drawn[name] = done
+                stream.write("\r[%s%s]" % ('=' * done, ' ' * (self.width-done)))
+                stream.flush()
+
+
+class LogProgress:
+    """Download progress reporter that logs every 'step' percent of each download, for environments where a progress bar would flood the logs"""
+
+    def __init__(self, step=25, level=logging.INFO):
+        self.step = step
+        self.level = level
+        self._lock = threading.Lock()
+        self._logged = {}
+
+    def __call__(self, name, downloaded, total, finished):
+        with self._lock:
+            if finished:
+                self._logged.pop(name, None)
+                logger.log(self.level, "Downloaded %s (%d bytes)" % (name, downloaded))
+                return
+            if not total:
+                return
+            percent = int(100 * downloaded / total) // self.step * self.step
+            if percent > self._logged.get(name, 0) and percent < 100:
+                self._logged[name] = percent
+                logger.log(self.level, "Downloading %s %d%%" % (name, percent))
@@ -0,0 +1,291 @@
+"""Cache warm-up for lists of areas, bands and resolutions over a date range. planPrefetch resolves the deduplicated set of band images that
+getRegionHistory-like requests would use (with the same product selection as getProductBandTiles) and estimates the bytes to download,
+and runPrefetch downloads and converts them into the loader dataPath in priority order, so that later requests are served from the cache.
+
+    python -m sentinelloader.prefetch --data-path /data/sentinelcache --aoi-file fields.geojson --bands B04,B08,SCL --resolutions 10m \\
+        --date-from 2019-01-01 --date-to 2019-03-01 --max-parallel-downloads 4 --max-rate 20M
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import as_completed
+
+from .utils import partialDownloadBytes
+
+logger = logging.getLogger('sentinelloader')
+
+ORDERS = ['newest', 'oldest', 'aoi']
+
+#typical size of a band image of a 100x100km tile at each native resolution, used when exact sizes are not requested
+TYPICAL_IMAGE_BYTES = {'10m': 110*1024*1024, '20m': 28*1024*1024, '60m': 3*1024*1024}
+#scene classification and quality images compress much better than reflectances
+TYPICAL_IMAGE_BYTES_SMALL = {'10m': 8*1024*1024, '20m': 3*1024*1024, '60m': 512*1024}
+LEVEL1C_RESOLUTIONS = {'B01': '60m', 'B09': '60m', 'B10': '60m', 'B05': '20m', 'B06': '20m', 'B07': '20m', 'B8A': '20m', 'B11': '20m', 'B12': '20m'}
+
+
+def estimateImageBytes(productLevel, bandName, resolutionDownload):
+    """Estimated download size of a band image"""
+    resolution = resolutionDownload
+    if productLevel == '1C':
+        #level 1C images have a single (native) resolution per band
+        resolution = LEVEL1C_RESOLUTIONS.get(bandName, '10m')
+    if bandName in ['SCL', 'AOT', 'WVP']:
+        return TYPICAL_IMAGE_BYTES_SMALL.get(resolution, TYPICAL_IMAGE_BYTES_SMALL['10m'])
+    return TYPICAL_IMAGE_BYTES.get(resolution, TYPICAL_IMAGE_BYTES['10m'])
+
+
+class PrefetchPlan:
+    """Band images to be fetched, in priority order. Each item is a dict with 'aoi' and 'date' (the first request that uses it), 'product'
+       ({'uuid', 'title'}), 'productLevel', 'band', 'resolution', 'resolutionDownload', 'file' (cached tile file), 'url', 'cached',
+       'partialBytes' (already downloaded by an interrupted transfer) and 'estimatedBytes' (still to be downloaded).
+       'missing' lists the requests (aoi, date) or products that could not be planned, with the error"""
+
+    def __init__(self, items=None, missing=None):
+        self.items = items if items is not None else []
+        self.missing = missing if missing is not None else []
+
+    @property
+    def estimatedBytes(self):
+        return sum([item['estimatedBytes'] for item in self.items])
+
+    def summary(self):
+        return {'files': len(self.items), 'cachedFiles': len([item for item in self.items if item['cached']]),
+                'products': len(set([item['product']['uuid'] for item in self.items])),
+                'estimatedBytes': self.estimatedBytes, 'missing': len(self.missing)}
+
+    def toJson(self, indent=None):
+        return json.dumps({'summary': self.summary(), 'items': self.items, 'missing': self.missing}, indent=indent)
+
+
+def planPrefetch(loader, geoPolygons, bandNames, resolutions, dateFrom, dateTo, daysStep=5, order='newest', exactSizes=False):
+    """Returns a PrefetchPlan with the band images of bandNames at resolutions needed for each polygon at each date from dateFrom to dateTo
+       every daysStep days. Requests are prioritized by date ('newest' or 'oldest' first, then in polygon order) or by polygon ('aoi', then newest
+       date first). Catalogue results are queried once for the whole range and product metadata is fetched (and cached) with up to
+       loader.maxParallelDownloads concurrent requests. If exactSizes is True, image sizes are asked to the server instead of estimated"""
+    if order not in ORDERS:
+        raise Exception("Invalid order %s. Use one of %s" % (order, ', '.join(ORDERS)))
+    dates = loader._historyDates(dateFrom, dateTo, daysStep)
+    if order == 'oldest':
+        requests = [(i, dateRef) for dateRef in dates for i in range(len(geoPolygons))]
+    elif order == 'newest':
+        requests = [(i, dateRef) for dateRef in reversed(dates) for i in range(len(geoPolygons))]
+    else:
+        requests = [(i, dateRef) for i in range(len(geoPolygons)) for dateRef in reversed(dates)]
+
+    plan = PrefetchPlan()
+    selections = []
+    products = {}
+    with loader.metrics.stage('prefetch_plan'):
+        with loader._bulkQuery(geoPolygons, dates):
+            for i, dateRef in requests:
+                dateRefStr = dateRef.strftime("%Y-%m-%d")
+                try:
+                    productLevel, selected_df = loader._selectProducts(geoPolygons[i], dateRefStr)
+                except Exception as e:
+                    logger.warning("Could not select products. aoi=%d date=%s err=%s" % (i, dateRefStr, e))
+                    plan.missing.append({'aoi': i, 'date': dateRefStr, 'error': str(e)})
+                    continue
+                sps = []
+                for index, sp in selected_df.iterrows():
+                    product = {'uuid': sp['uuid'], 'title': sp['title']}
+                    products.setdefault(product['uuid'], (product, productLevel))
+                    sps.append(product)
+                selections.append((i, dateRefStr, productLevel, sps))
+
+        #metadata is needed for the image names and is small, so it is fetched while planning
+        futures = dict([(productUuid, loader._downloadPool.submit(loader._productMetadata, product, productLevel))
+                        for productUuid, (product, productLevel) in products.items()])
+        metadatas = {}
+        for productUuid, f in futures.items():
+            try:
+                metadatas[productUuid] = f.result()
+            except Exception as e:
+                logger.warning("Could not get product metadata. uuid=%s err=%s" % (productUuid, e))
+                plan.missing.append({'product': productUuid, 'error': str(e)})
+
+        planned = set()
+        counted = set()
+        for i, dateRefStr, productLevel, sps in selections:
+            for product in sps:
+                metadata = metadatas.get(product['uuid'])
+                if metadata is None:
+                    continue
+                for bandName in bandNames:
+                    for resolution in resolutions:
+                        key = (product['uuid'], bandName, resolution)
+                        if key in planned:
+                            continue
+                        planned.add(key)
+                        resolutionDownload = loader._resolutionDownload(productLevel, bandName, resolution)
+                        try:
+                            tile, jp2File, url = loader._tileInfo(product, productLevel, bandName, resolutionDownload, metadata)
+                        except Exception as e:
+                            plan.missing.append({'aoi': i, 'date': dateRefStr, 'product': product['uuid'], 'band': bandName, 'error': str(e)})
+                            continue
+                        cached = os.path.isfile(tile['downloadFilename'])
+                        partialBytes = partialDownloadBytes(jp2File, loader.downloadRanges)
+                        item = {'aoi': i, 'date': dateRefStr, 'product': product, 'productLevel': productLevel, 'band': bandName,
+                                'resolution': resolution, 'resolutionDownload': resolutionDownload, 'file': tile['downloadFilename'],
+                                'url': url, 'cached': cached, 'partialBytes': partialBytes, 'estimatedBytes': 0}
+                        #images shared by more than one resolution are downloaded once
+                        if not cached and tile['downloadFilename'] not in counted:
+                            counted.add(tile['downloadFilename'])
+                            item['estimatedBytes'] = estimateImageBytes(productLevel, bandName, resolutionDownload)
+                            if exactSizes:
+                                item['estimatedBytes'] = _remoteSize(loader, url, item['estimatedBytes'])
+                            item['estimatedBytes'] = max(0, item['estimatedBytes'] - partialBytes)
+                        plan.items.append(item)
+
+    logger.info("Prefetch plan: %d files (%d cached) from %d products, %.1f MB to download" % (len(plan.items),
+                len([item for item in plan.items if item['cached']]), len(metadatas), plan.estimatedBytes/1e6))
+    return plan
+
+
+def _remoteSize(loader, url, default):
+    try:
+        response = loader.session.head(url, allow_redirects=True, timeout=60)
+        if response.status_code == 200 and response.headers.get('content-length') is not None:
+            return int(response.headers.get('content-length'))
+        logger.debug("Could not get image size. status=%s url=%s" % (response.status_code, url))
+    except Exception as e:
+        logger.debug("Could not get image size. err=%s url=%s" % (e, url))
+    return default
+
+
+def runPrefetch(loader, plan):
+    """Downloads and converts the images of plan into the loader cache in priority order, with up to loader.maxParallelDownloads downloads and
+       loader.maxParallelConversions conversions at a time, throttled by the loader maxDownloadRate. Images that are already cached are skipped
+       and downloads interrupted by a previous run are resumed, so an interrupted prefetch is continued by running it again.
+       Returns a dict with 'files', 'failed' (items that could not be fetched, with 'error'), 'bytesDownloaded' and 'seconds'"""
+    start = time.perf_counter()
+    bytesBefore = loader.metrics.snapshot()['counters'].get('bytes_downloaded', 0)
+
+    #resolutions of the same image are converted after a single download
+    groups = {}
+    for item in plan.items:
+        groups.setdefault((item['product']['uuid'], item['band'], item['resolutionDownload']), []).append(item)
+
+    def download(items):
+        item = items[0]
+        return loader._downloadTile(item['product'], item['productLevel'], item['band'], item['resolutionDownload'])
+
+    def convert(tile, items):
+        for n, item in enumerate(items):
+            if n > 0:
+                tile = dict(tile, jp2=None, lock=None)
+            loader._convertTile(tile, item['band'], item['resolution'], item['resolutionDownload'])
+
+    failed = []
+    done = 0
+    downloads = {}
+    conversions = {}
+    try:
+        #pools run tasks in submission order, so images are fetched in priority order
+        for items in groups.values():
+            downloads[loader._downloadPool.submit(download, items)] = items
+        for f in as_completed(downloads):
+            items = downloads[f]
+            try:
+                conversions[loader._conversionPool.submit(convert, f.result(), items)] = items
+            except Exception as e:
+                logger.warning("Could not download image. uuid=%s band=%s err=%s" % (items[0]['product']['uuid'], items[0]['band'], e))
+                failed.extend([dict(item, error=str(e)) for item in items])
+        for c in as_completed(conversions):
+            items = conversions[c]
+            try:
+                c.result()
+                done = done + len(items)
+            except Exception as e:
+                logger.warning("Could not convert image. uuid=%s band=%s err=%s" % (items[0]['product']['uuid'], items[0]['band'], e))
+                failed.extend([dict(item, error=str(e)) for item in items])
+            logger.debug("Prefetched %d of %d files" % (done + len(failed), len(plan.items)))
+    except BaseException:
+        #downloads in progress are kept in their '.part' files and resumed by the next run
+        for f in downloads:
+            f.cancel()
+        raise
+
+    result = {'files': done, 'failed': failed, 'seconds': time.perf_counter() - start,
+              'bytesDownloaded': loader.metrics.snapshot()['counters'].get('bytes_downloaded', 0) - bytesBefore}
+    logger.info("Prefetched %d files (%d failed), %.1f MB downloaded in %.1fs" % (done, len(failed), result['bytesDownloaded']/1e6, result['seconds']))
+    return result
+
+
+def loadPolygons(filename):
+    """Reads areas of interest from a GeoJSON file (one per feature or geometry) or from a text file with one WKT polygon per line"""
+    from shapely.geometry import shape
+    from shapely.wkt import loads
+    contents = open(filename).read()
+    if filename.lower().endswith('.json') or filename.lower().endswith('.geojson'):
+        geojson = json.loads(contents)
+        if geojson.get('type') == 'FeatureCollection':
+            return [shape(f['geometry']) for f in geojson['features']]
+        return [shape(geojson.get('geometry', geojson))]
+    return [loads(line) for line in contents.splitlines() if line.strip() != '']
+
+
+def _bytes(value):
+    """Parses a number of bytes with an optional K, M or G suffix"""
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    value = value.strip().upper().rstrip('B')
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefetches Sentinel-2 band images into a sentinelloader cache')
+    parser.add_argument('--data-path', required=True, help='sentinelloader cache directory (dataPath)')
+    parser.add_argument('--aoi-file', required=True, help='GeoJSON file or text file with one WKT polygon per line')
+    parser.add_argument('--bands', required=True, help='comma separated band names, e.g. B04,B08,SCL')
+    parser.add_argument('--resolutions', default='10m', help='comma separated resolutions, e.g. 10m,20m')
+    parser.add_argument('--date-from', required=True)
+    parser.add_argument('--date-to', required=True)
+    parser.add_argument('--days-step', type=int, default=5)
+    parser.add_argument('--order', default='newest', choices=ORDERS)
+    parser.add_argument('--user', default=os.environ.get('SENTINEL_USER'), help='defaults to $SENTINEL_USER')
+    parser.add_argument('--password', default=os.environ.get('SENTINEL_PASSWORD'), help='defaults to $SENTINEL_PASSWORD')
+    parser.add_argument('--api-url', default='https://apihub.copernicus.eu/apihub/')
+    parser.add_argument('--max-parallel-downloads', type=int, default=2)
+    parser.add_argument('--max-parallel-conversions', type=int, default=1)
+    parser.add_argument('--download-ranges', type=int, default=1)
+    parser.add_argument('--max-rate', type=_bytes, help='bandwidth cap in bytes per second (K, M or G suffixes allowed), e.g. 20M')
+    parser.add_argument('--exact-sizes', action='store_true', help='ask the server for image sizes instead of estimating them')
+    parser.add_argument('--plan-only', action='store_true', help='only show the plan, without downloading images')
+    parser.add_argument('--output', help='write the plan (and results) to this JSON file')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    from .sentinel2loader import Sentinel2Loader
+    from .metrics import LogProgress
+    loader = Sentinel2Loader(args.data_path, args.user, args.password, apiUrl=args.api_url, showProgressbars=False, loglevel=logging.INFO,
+                             maxParallelDownloads=args.max_parallel_downloads, maxParallelConversions=args.max_parallel_conversions,
+                             downloadRanges=args.download_ranges, maxDownloadRate=args.max_rate, progressReporter=LogProgress())
+
+    plan = planPrefetch(loader, loadPolygons(args.aoi_file), args.bands.split(','), args.resolutions.split(','), args.date_from, args.date_to,
+                        daysStep=args.days_step, order=args.order, exactSizes=args.exact_sizes)
+    summary = plan.summary()
+    print('%d files (%d cached) from %d products. %.1f MB to download. %d requests or products could not be planned' % (summary['files'],
+          summary['cachedFiles'], summary['products'], summary['estimatedBytes']/1e6, summary['missing']))
+    if args.max_rate:
+        print('at most %.1f MB/s: about %.1f minutes' % (args.max_rate/1e6, summary['estimatedBytes']/args.max_rate/60))
+
+    output = json.loads(plan.toJson())
+    if not args.plan_only:
+        result = runPrefetch(loader, plan)
+        print('%d files prefetched, %d failed, %.1f MB downloaded in %.1fs' % (result['files'], len(result['failed']), result['bytesDownloaded']/1e6, result['seconds']))
+        output['result'] = result
+
+    if args.output:
+        with open(args.output, 'w') as fw:
+            json.dump(output, fw, indent=2)
+
+    if not args.plan_only and len(output['result']['failed']) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,38 @@
-from sentinelsat import SentinelAPI
 from datetime import datetime
 from datetime import timedelta
-from shapely.geometry import Point, Polygon, mapping
-from shapely.affinity import scale
-import rasterio.features
+from shapely.geometry import Polygon
 import logging
-from osgeo import ogr
 from shapely.wkt import loads
-import geopandas as gpd
+import shapely.wkb
+from shapely.strtree import STRtree
 import pandas as pd
-import requests
 import os
 import re
 import os.path
+import shutil
 from osgeo import gdal
 import hashlib
-from PIL import Image
 import uuid
-import fiona
+import threading
+import time
+import json
 import numpy as np
-import traceback
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from collections import deque
 from .utils import *
+from .indices import *
+from .cacheindex import CacheIndex
+from .metrics import Metrics
 
 logger = logging.getLogger('sentinelloader')
 
 class Sentinel2Loader:
 
-    def __init__(self, dataPath, user, password, apiUrl='https://apihub.copernicus.eu/apihub/', showProgressbars=True, dateToleranceDays=5, cloudCoverage=(0,80), deriveResolutions=True, cacheApiCalls=True, cacheTilesData=True, loglevel=logging.DEBUG, nirBand='B08'):
-        logging.basicConfig(level=loglevel)
-        self.api = SentinelAPI(user, password, apiUrl, show_progressbars=showProgressbars)
+    def __init__(self, dataPath, user, password, apiUrl='https://apihub.copernicus.eu/apihub/', showProgressbars=True, dateToleranceDays=5, cloudCoverage=(0,80), deriveResolutions=True, cacheApiCalls=True, cacheTilesData=True, loglevel=logging.DEBUG, nirBand='B08', maxParallelDownloads=1, maxParallelConversions=1, downloadRanges=1, useGdalApi=True, visibilityFallbacks=0, progressReporter=None, offline=False, maxDownloadRate=None):
+        logger.setLevel(loglevel)
         self.dataPath = dataPath
+        self.apiUrl = apiUrl if apiUrl.endswith('/') else apiUrl + '/'
         self.user = user
         self.password = password
         self.dateToleranceDays=dateToleranceDays
@@ -39,27 +41,99 @@ class Sentinel2Loader:
         self.cacheApiCalls=cacheApiCalls
         self.cacheTilesData=cacheTilesData
         self.nirBand=nirBand
+        self.maxParallelDownloads=maxParallelDownloads
+        self.maxParallelConversions=maxParallelConversions
+        self.downloadRanges=downloadRanges
+        self.useGdalApi=useGdalApi
+        self.offline=offline
+        self.visibilityFallbacks=visibilityFallbacks
+        self.showProgressbars=showProgressbars
+        #download progress is reported to progressReporter (see metrics.ProgressBar and metrics.LogProgress)
+        if progressReporter is None and showProgressbars:
+            progressReporter = ProgressBar()
+        self.progressReporter=progressReporter
+        self.metrics = Metrics()
+        #bandwidth cap in bytes per second shared by all tile downloads of this loader
+        self.rateLimiter = RateLimiter(maxDownloadRate) if maxDownloadRate else None
+        #connections are reused across metadata and tile downloads
+        self.session = createSession(user, password, poolSize=max(10, maxParallelDownloads*downloadRanges))
+        self._downloadPool = ThreadPoolExecutor(max_workers=maxParallelDownloads, thread_name_prefix='sentinelloader-download')
+        self._conversionPool = ThreadPoolExecutor(max_workers=maxParallelConversions, thread_name_prefix='sentinelloader-conversion')
+        self._bulkQueries = []
+        self._cacheIndex = CacheIndex(dataPath)
+        self._footprints = {}
+        self._metadata = {}
+        self._footprintIndexes = {}
+        self._footprintLock = threading.Lock()
+        self._excluded = threading.local()
+        self._api = None
+        self._apiLock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shuts down the download and conversion thread pools and closes the HTTP connections. The loader can't be used afterwards"""
+        self._downloadPool.shutdown(wait=True)
+        self._conversionPool.shutdown(wait=True)
+        self.session.close()
+
+    @property
+    def api(self):
+        """SentinelAPI catalogue client. It is created on first use, so that requests served from the cache don't load or configure it"""
+        if self._api is None:
+            if self.offline:
+                raise Exception('Catalogue queries are not available in offline mode')
+            with self._apiLock:
+                if self._api is None:
+                    from sentinelsat import SentinelAPI
+                    self._api = SentinelAPI(self.user, self.password, self.apiUrl, show_progressbars=self.showProgressbars)
+        return self._api
+
+    @api.setter
+    def api(self, api):
+        self._api = api
 
     
     def getProductBandTiles(self, geoPolygon, bandName, resolution, dateReference):
         """Downloads and returns file names with Sentinel2 tiles that best fit the polygon area at the desired date reference. It will perform up/downsampling if deriveResolutions is True and the desired resolution is not available for the required band."""
         logger.debug("Getting contents. band=%s, resolution=%s, date=%s", bandName, resolution, dateReference)        
         
-        #find tiles that intercepts geoPolygon within date-tolerance and date+dateTolerance
-        dateTolerance = timedelta(days=self.dateToleranceDays)
-        dateObj = datetime.now()
-        if dateReference != 'now':
-            dateObj = datetime.strptime(dateReference, '%Y-%m-%d')
+        productLevel, selected_df = self._selectProducts(geoPolygon, dateReference)
 
-        dateFrom = dateObj-dateTolerance
-        dateTo = dateObj
-        
-        dateL2A = datetime.strptime('2018-12-18', '%Y-%m-%d')
-        productLevel = '2A'
-        if dateObj < dateL2A:
-            logger.debug('Reference date %s before 2018-12-18. Will use Level1C tiles (no atmospheric correction)' % (dateObj))
-            productLevel = '1C'
-        
+        resolutionDownload = self._resolutionDownload(productLevel, bandName, resolution)
+
+        #download tiles data. downloads and conversions run in separate bounded pools so that
+        #network transfers of some tiles overlap with gdal processing of others
+        downloads = {}
+        for index, sp in selected_df.iterrows():
+            f = self._downloadPool.submit(self._downloadTile, sp, productLevel, bandName, resolutionDownload)
+            downloads[f] = len(downloads)
+
+        #downloaded tiles are always converted, even if another download failed, so that their cache locks are released
+        conversions = [None] * len(downloads)
+        error = None
+        for f in as_completed(downloads):
+            try:
+                conversions[downloads[f]] = self._conversionPool.submit(self._convertTile, f.result(), bandName, resolution, resolutionDownload)
+            except Exception as e:
+                error = e
+        for c in conversions:
+            if c is not None:
+                c.exception()
+        if error is not None:
+            raise error
+
+        #keep tile files in the same order as the selected tiles
+        tileFiles = [c.result() for c in conversions]
+        return tileFiles
+
+    def _resolutionDownload(self, productLevel, bandName, resolution):
+        """Returns the resolution to be downloaded for a band. If deriveResolutions is True and the band isn't available at the desired resolution,
+           a resolution that is available is used instead and the tile is resampled after downloaded"""
         resolutionDownload = resolution
         if self.deriveResolutions:
             if productLevel=='2A':
@@ -78,163 +152,383 @@ class Sentinel2Loader:
                         resolutionDownload = '10m'
             elif productLevel=='1C':
                 resolutionDownload = '10m'
+        return resolutionDownload
+
+    def _selectProducts(self, geoPolygon, dateReference):
+        """Returns (productLevel, products) with the products (as a dataframe, in order of preference) whose tiles best cover
+           the polygon bounding box at the date reference. Products excluded for the current thread (see _excludeProducts) are not considered"""
+        #find tiles that intercepts geoPolygon within date-tolerance and date+dateTolerance
+        dateTolerance = timedelta(days=self.dateToleranceDays)
+        dateObj = datetime.now()
+        if dateReference != 'now':
+            dateObj = datetime.strptime(dateReference, '%Y-%m-%d')
+
+        dateFrom = dateObj-dateTolerance
+        dateTo = dateObj
+        
+        productLevel = self._productLevel(dateObj)
 
         logger.debug("Querying API for candidate tiles")
 
-        bbox = rasterio.features.bounds(geoPolygon)
+        bbox = polygonBounds(geoPolygon)
         geoPolygon = [(bbox[0], bbox[3]), (bbox[0], bbox[1]),
             (bbox[2], bbox[1]), (bbox[2], bbox[3])]
 
         area = Polygon(geoPolygon).wkt
-        
-        #query cache key
-        area_hash = hashlib.md5(area.encode()).hexdigest()
-        apicache_file = self.dataPath + "/apiquery/Sentinel-2-S2MSI%s-%s-%s-%s-%s-%s.csv" % (productLevel, area_hash, dateFrom.strftime("%Y%m%d"), dateTo.strftime("%Y%m%d"), self.cloudCoverage[0], self.cloudCoverage[1])
-        products_df = None
-        if self.cacheApiCalls:
-            if os.path.isfile(apicache_file):
-                logger.debug("Using cached API query contents")
-                products_df = pd.read_csv(apicache_file)
-                os.system("touch -c %s" % apicache_file)
-            else:
-                logger.debug("Querying remote API")
-                productType = 'S2MSI%s' % productLevel
-                products = self.api.query(area, 
-                                               date=(dateFrom.strftime("%Y%m%d"), dateTo.strftime("%Y%m%d")),
-                                               platformname='Sentinel-2', producttype=productType, cloudcoverpercentage=self.cloudCoverage)
-                products_df = self.api.to_dataframe(products)
-                logger.debug("Caching API query results for later usage")
-                saveFile(apicache_file, products_df.to_csv(index=True))
+        products_df = self._queryProducts(productLevel, area, dateFrom, dateTo)
+
+        excluded = getattr(self._excluded, 'products', None)
+        if excluded:
+            products_df = products_df[~products_df['uuid'].isin(excluded)]
 
         logger.debug("Found %d products", len(products_df))
 
         if len(products_df)==0:
             raise Exception('Could not find any tiles for the specified parameters')
         
-        products_df_sorted = products_df.sort_values(['ingestiondate','cloudcoverpercentage'], ascending=[False, False])
+        #most recent and least cloudy products are preferred
+        products_df_sorted = products_df.sort_values(['ingestiondate','cloudcoverpercentage'], ascending=[False, True])
 
         #select the best product. if geoPolygon() spans multiple tiles, select the best of them
-        missing = Polygon(geoPolygon)
         desiredRegion = Polygon(geoPolygon)
-        selectedTiles = []
-        footprints = [desiredRegion]
-
-        for index, pf in products_df_sorted.iterrows():
-            #osgeo.ogr.Geometry
-            footprint = gmlToPolygon(pf['gmlfootprint'])
-            
-            if missing.area>0:
-                if missing.intersects(footprint)==True:
-                    missing = (missing.symmetric_difference(footprint)).difference(footprint)
-                    selectedTiles.append(index)
-                    footprints.append(footprint)                
-
-        if missing.area>0:
+        footprints, tree = self._footprintIndex(products_df_sorted)
+        selected, missing = selectCoveringTiles(desiredRegion, footprints, tree)
+        if missing.area > desiredRegion.area*1e-6:
             raise Exception('Could not find tiles for the whole selected area at date range')
+        selectedTiles = [products_df_sorted.index[i] for i in selected]
 
         logger.debug("Tiles selected for covering the entire desired area: %s", selectedTiles)
 
 #         g = gpd.GeoSeries(footprints)
 #         g.plot(cmap=plt.get_cmap('jet'), alpha=0.5)
 
-        #download tiles data
-        tileFiles = []
-        for index, sp in products_df.loc[selectedTiles].iterrows():
-            url = "https://apihub.copernicus.eu/apihub/odata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('MTD_MSIL%s.xml')/$value" % (sp['uuid'], sp['title'], productLevel)
-            meta_cache_file = self.dataPath + "/products/%s-MTD_MSIL%s.xml" % (sp['uuid'], productLevel)
-            mcontents = ''
-            if self.cacheTilesData and os.path.isfile(meta_cache_file):
-                logger.debug('Reusing cached metadata info for tile \'%s\'', sp['uuid'])
-                mcontents = loadFile(meta_cache_file)
-                os.system("touch -c %s" % meta_cache_file)
-            else:
-                logger.debug('Getting metadata info for tile \'%s\' remotelly', sp['uuid'])
-                r = requests.get(url, auth=(self.user, self.password))
-                if r.status_code!=200:
-                    raise Exception("Could not get metadata info. status=%s" % r.status_code)
-                mcontents = r.content.decode("utf-8")
-                saveFile(meta_cache_file, mcontents)
-
-            rexp = "<IMAGE_FILE>GRANULE\/([0-9A-Z_]+)\/IMG_DATA\/([0-9A-Z_]+_%s)<\/IMAGE_FILE>" % (bandName)
-            if productLevel=='2A':
-                rexp = "<IMAGE_FILE>GRANULE\/([0-9A-Z_]+)\/IMG_DATA\/R%s\/([0-9A-Z_]+_%s_%s)<\/IMAGE_FILE>" % (resolutionDownload, bandName, resolutionDownload)
-
-            m = re.search(rexp, mcontents)
-            if m==None:
-                raise Exception("Could not find image metadata. uuid=%s, resolution=%s, band=%s" % (sp['uuid'], resolutionDownload, bandName))
-
-            rexp1 = "<PRODUCT_START_TIME>([\-0-9]+)T[0-9\:\.]+Z<\/PRODUCT_START_TIME>"
-            m1 = re.search(rexp1, mcontents)
-            if m1==None:
-                raise Exception("Could not find product date from metadata")
-                
-            date1 = m1.group(1)
-            downloadFilename = self.dataPath + "/products/%s/%s/%s.tiff" % (date1, sp['uuid'], m.group(2))
-            if not os.path.exists(os.path.dirname(downloadFilename)):
-                os.makedirs(os.path.dirname(downloadFilename))
-
-            if not self.cacheTilesData or not os.path.isfile(downloadFilename):
-                tmp_tile_filejp2 = "%s/tmp/%s.jp2" % (self.dataPath, uuid.uuid4().hex)
-                tmp_tile_filetiff = "%s/tmp/%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-                if not os.path.exists(os.path.dirname(tmp_tile_filejp2)):
-                    os.makedirs(os.path.dirname(tmp_tile_filejp2))
-                        
-                if productLevel=='2A':
-                    url = "https://apihub.copernicus.eu/apihub/odata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('GRANULE')/Nodes('%s')/Nodes('IMG_DATA')/Nodes('R%s')/Nodes('%s.jp2')/$value" % (sp['uuid'], sp['title'], m.group(1), resolutionDownload, m.group(2))
-                elif productLevel=='1C':
-                    url = "https://apihub.copernicus.eu/apihub/odata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('GRANULE')/Nodes('%s')/Nodes('IMG_DATA')/Nodes('%s.jp2')/$value" % (sp['uuid'], sp['title'], m.group(1), m.group(2))
-                    
-                logger.info('Downloading tile uuid=\'%s\', resolution=\'%s\', band=\'%s\', date=\'%s\'', sp['uuid'], resolutionDownload, bandName, date1)
-                downloadFile(url, tmp_tile_filejp2, self.user, self.password)
-                #remove near black features on image border due to compression artifacts. if not removed, some black pixels 
-                #will be present on final image, specially when there is an inclined crop in source images
-                if bandName=='TCI':
-                    logger.debug('Removing near black compression artifacts')
-                    
-                    ret = os.system("which nearblack")
-                    if ret != 0:
-                        raise Exception("gdal nearblack utility was not found in the system. install it")
-                        
-                    ret = os.system("which gdal_translate")
-                    if ret != 0:
-                        raise Exception("gdal gdal_translate utility was not found in the system. install it")
-                        
-                    ret = os.system("nearblack -o %s %s" % (tmp_tile_filetiff, tmp_tile_filejp2))
-                    if ret != 0:
-                        raise Exception("Error during 'nearblack' execution. code=%d" % ret)
-                        
-                    ret = os.system("gdal_translate %s %s" % (tmp_tile_filetiff, downloadFilename))
-                    if ret != 0:
-                        raise Exception("Error during 'gdal_translate' execution. code=%d" % ret)
-                        
-                    os.remove(tmp_tile_filetiff)
+        return productLevel, products_df.loc[selectedTiles]
+
+    @contextmanager
+    def _excludeProducts(self, productUuids):
+        """Products are not selected by the current thread while in this context. Used for falling back to other products of a date"""
+        previous = getattr(self._excluded, 'products', frozenset())
+        self._excluded.products = previous | frozenset(productUuids)
+        try:
+            yield
+        finally:
+            self._excluded.products = previous
+
+    def _productLevel(self, dateObj):
+        dateL2A = datetime.strptime('2018-12-18', '%Y-%m-%d')
+        if dateObj < dateL2A:
+            logger.debug('Reference date %s before 2018-12-18. Will use Level1C tiles (no atmospheric correction)' % (dateObj))
+            return '1C'
+        return '2A'
+
+    def _queryProducts(self, productLevel, area, dateFrom, dateTo):
+        """Returns a dataframe with the products of productLevel that intersect area (WKT) sensed between dateFrom and dateTo.
+           Results are taken from a bulk query registered by _bulkQuery when it covers the request, otherwise from the API query cache or from the remote API"""
+        for bulkLevel, bulkArea, bulkFrom, bulkTo, bulk_df in list(self._bulkQueries):
+            if bulkLevel==productLevel and bulkFrom<=dateFrom and dateTo<=bulkTo and bulkArea.contains(loads(area)):
+                logger.debug("Using products from bulk query")
+                self.metrics.cacheHit('query')
+                #the remote API filters by sensing start with day precision on both ends
+                sensingDates = pd.to_datetime(bulk_df['beginposition'])
+                return bulk_df[(sensingDates >= pd.Timestamp(dateFrom.strftime("%Y%m%d"))) & (sensingDates <= pd.Timestamp(dateTo.strftime("%Y%m%d")))]
+
+        #query cache key
+        area_hash = hashlib.md5(area.encode()).hexdigest()
+        apicache_file = self.dataPath + "/apiquery/Sentinel-2-S2MSI%s-%s-%s-%s-%s-%s.csv" % (productLevel, area_hash, dateFrom.strftime("%Y%m%d"), dateTo.strftime("%Y%m%d"), self.cloudCoverage[0], self.cloudCoverage[1])
+        if not self.cacheApiCalls:
+            self.metrics.cacheMiss('query')
+            return self._remoteQuery(productLevel, area, dateFrom, dateTo)
+
+        if not os.path.isfile(apicache_file):
+            #only one process queries the remote API while the others wait for the results
+            with cacheLock(self.dataPath, apicache_file):
+                if not os.path.isfile(apicache_file):
+                    self.metrics.cacheMiss('query')
+                    products_df = self._remoteQuery(productLevel, area, dateFrom, dateTo)
+                    logger.debug("Caching API query results for later usage")
+                    saveFile(apicache_file, products_df.to_csv(index=True))
+                    self._cacheIndex.add(apicache_file, 'query')
+                    return products_df
+
+        logger.debug("Using cached API query contents")
+        products_df = pd.read_csv(apicache_file)
+        if len(products_df)>0 and 'footprintwkb' not in products_df.columns:
+            #cached by a previous version. store parsed footprints for the next calls
+            products_df['footprintwkb'] = [gmlToPolygon(g).wkb_hex for g in products_df['gmlfootprint']]
+            saveFile(apicache_file, products_df.to_csv(index=False))
+        self._cacheIndex.hit(apicache_file, 'query')
+        self.metrics.cacheHit('query')
+        return products_df
+
+    def _remoteQuery(self, productLevel, area, dateFrom, dateTo):
+        if self.offline:
+            raise Exception('Products query is not cached and remote queries are disabled in offline mode. area=%s dateFrom=%s dateTo=%s' % (area, dateFrom, dateTo))
+        logger.debug("Querying remote API")
+        productType = 'S2MSI%s' % productLevel
+        with self.metrics.stage('query'):
+            products = self.api.query(area, 
+                                           date=(dateFrom.strftime("%Y%m%d"), dateTo.strftime("%Y%m%d")),
+                                           platformname='Sentinel-2', producttype=productType, cloudcoverpercentage=self.cloudCoverage)
+            products_df = self.api.to_dataframe(products)
+        if len(products_df)>0:
+            #parsing GML footprints is slow. they are parsed once and cached in WKB along with the query results
+            products_df['footprintwkb'] = [gmlToPolygon(g).wkb_hex for g in products_df['gmlfootprint']]
+        return products_df
+
+    def _footprintIndex(self, products_df):
+        """Returns the footprint polygons of products_df rows (in the same order) and a spatial index over them.
+           Footprints are parsed once per product and indexes are reused while the same set of products is requested"""
+        key = tuple(products_df['uuid'])
+        with self._footprintLock:
+            cached = self._footprintIndexes.get(key)
+        if cached is not None:
+            return cached
+
+        footprints = []
+        hasWkb = 'footprintwkb' in products_df.columns
+        for i in range(len(products_df)):
+            productUuid = products_df['uuid'].iloc[i]
+            footprint = self._footprints.get(productUuid)
+            if footprint is None:
+                if hasWkb and isinstance(products_df['footprintwkb'].iloc[i], str):
+                    footprint = shapely.wkb.loads(products_df['footprintwkb'].iloc[i], hex=True)
                 else:
-                    os.system("gdal_translate %s %s" % (tmp_tile_filejp2, downloadFilename))
-                os.remove(tmp_tile_filejp2)
-                    
-            else:
-                logger.debug('Reusing tile data from cache')
+                    footprint = gmlToPolygon(products_df['gmlfootprint'].iloc[i])
+                self._footprints[productUuid] = footprint
+            footprints.append(footprint)
 
-            os.system("touch -c %s" % downloadFilename)
+        cached = (footprints, STRtree(footprints))
+        #history dates select products from several threads
+        with self._footprintLock:
+            if len(self._footprintIndexes) >= 64:
+                self._footprintIndexes.pop(next(iter(self._footprintIndexes)))
+            self._footprintIndexes[key] = cached
+        return cached
 
-            filename = downloadFilename
-            if resolution!=resolutionDownload:
-                filename = self.dataPath + "/products/%s/%s/%s-%s.tiff" % (m1.group(1), sp['uuid'], m.group(2), resolution)
-                logger.debug("Resampling band %s originally in resolution %s to %s" % (bandName, resolutionDownload, resolution))
-                rexp = "([0-9]+).*"
-                rnumber = re.search(rexp, resolution)
-                if not self.cacheTilesData or not os.path.isfile(filename):
-                    os.system("gdalwarp -tr %s %s %s %s" % (rnumber.group(1), rnumber.group(1), downloadFilename, filename))
+    @contextmanager
+    def _bulkQuery(self, geoPolygons, dates):
+        """Queries the catalogue once for the whole date range of dates (list of datetime) over the bounding box of geoPolygons.
+           While in this context, getProductBandTiles calls for any of these dates and polygons filter those results locally instead of sending their own queries"""
+        registered = []
+        try:
+            bboxes = [polygonBounds(g) for g in geoPolygons]
+            bbox = (min([b[0] for b in bboxes]), min([b[1] for b in bboxes]), max([b[2] for b in bboxes]), max([b[3] for b in bboxes]))
+            areaPolygon = Polygon([(bbox[0], bbox[3]), (bbox[0], bbox[1]), (bbox[2], bbox[1]), (bbox[2], bbox[3])])
 
-            tileFiles.append(filename)
+            levelDates = {}
+            for dateObj in dates:
+                levelDates.setdefault(self._productLevel(dateObj), []).append(dateObj)
 
-        return tileFiles
+            for productLevel in levelDates:
+                dateFrom = min(levelDates[productLevel]) - timedelta(days=self.dateToleranceDays)
+                dateTo = max(levelDates[productLevel])
+                logger.debug("Querying products for all dates from %s to %s at once" % (dateFrom, dateTo))
+                products_df = self._queryProducts(productLevel, areaPolygon.wkt, dateFrom, dateTo)
+                entry = (productLevel, areaPolygon, dateFrom, dateTo, products_df)
+                self._bulkQueries.append(entry)
+                registered.append(entry)
+
+        except Exception as e:
+            logger.warning("Could not query products for all dates at once. Each date will be queried separately. err=%s" % e)
+
+        try:
+            yield
+        finally:
+            #entries hold dataframes, so they are removed by identity instead of equality
+            registered = [id(entry) for entry in registered]
+            self._bulkQueries = [entry for entry in self._bulkQueries if id(entry) not in registered]
+
+    def _tileInfo(self, sp, productLevel, bandName, resolutionDownload, metadata):
+        """Returns (tile, jp2File, url) for a band image of a product: the tile dict used by _convertTile, the fixed temporary file
+           the image is downloaded to (so that the next attempt can resume an interrupted download) and its download url"""
+        #level 1C image paths have no resolution
+        files = metadata['bands'].get(bandName, {})
+        fileKey = ''
+        if productLevel=='2A':
+            fileKey = resolutionDownload
+        if fileKey not in files:
+            raise Exception("Could not find image metadata. uuid=%s, resolution=%s, band=%s" % (sp['uuid'], resolutionDownload, bandName))
+        granule, imageName = files[fileKey]
+
+        if metadata['date'] is None:
+            raise Exception("Could not find product date from metadata")
+
+        tile = {'uuid': sp['uuid'], 'date': metadata['date'], 'name': imageName, 'jp2': None, 'lock': None}
+        tile['downloadFilename'] = self.dataPath + "/products/%s/%s/%s.tiff" % (tile['date'], sp['uuid'], tile['name'])
+        jp2File = "%s/tmp/%s-%s.jp2" % (self.dataPath, sp['uuid'], imageName)
 
-    def cropRegion(self, geoPolygon, sourceGeoTiffs):
+        if productLevel=='2A':
+            url = "%sodata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('GRANULE')/Nodes('%s')/Nodes('IMG_DATA')/Nodes('R%s')/Nodes('%s.jp2')/$value" % (self.apiUrl, sp['uuid'], sp['title'], granule, resolutionDownload, imageName)
+        else:
+            url = "%sodata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('GRANULE')/Nodes('%s')/Nodes('IMG_DATA')/Nodes('%s.jp2')/$value" % (self.apiUrl, sp['uuid'], sp['title'], granule, imageName)
+        return tile, jp2File, url
+
+    def _downloadTile(self, sp, productLevel, bandName, resolutionDownload):
+        """Gets metadata for a selected product and downloads the band image file if it is not cached yet"""
+        metadata = self._productMetadata(sp, productLevel)
+        tile, jp2File, url = self._tileInfo(sp, productLevel, bandName, resolutionDownload, metadata)
+        os.makedirs(os.path.dirname(tile['downloadFilename']), exist_ok=True)
+
+        if not self.cacheTilesData or not os.path.isfile(tile['downloadFilename']):
+            #the lock is held until the tile is converted (see _convertTile), so that only one process or thread
+            #downloads and converts a tile while the others wait for it
+            tile['lock'] = acquireCacheLock(self.dataPath, tile['downloadFilename'])
+            if self.cacheTilesData and os.path.isfile(tile['downloadFilename']):
+                logger.debug('Tile data was cached while waiting for it')
+                releaseCacheLock(tile['lock'])
+                tile['lock'] = None
+                self.metrics.cacheHit('tile')
+                return tile
+            self.metrics.cacheMiss('tile')
+            if self.offline:
+                releaseCacheLock(tile['lock'])
+                raise Exception('Tile is not cached and downloads are disabled in offline mode. uuid=%s image=%s' % (sp['uuid'], tile['name']))
+
+            tile['jp2'] = jp2File
+            os.makedirs(os.path.dirname(tile['jp2']), exist_ok=True)
+
+            logger.info('Downloading tile uuid=\'%s\', resolution=\'%s\', band=\'%s\', date=\'%s\'', sp['uuid'], resolutionDownload, bandName, tile['date'])
+            try:
+                with self.metrics.stage('download'):
+                    size = downloadFile(url, tile['jp2'], self.user, self.password, session=self.session, parallelRanges=self.downloadRanges, showProgress=False, progress=self.progressReporter, rateLimiter=self.rateLimiter)
+                self.metrics.increment('bytes_downloaded', size)
+            except Exception:
+                releaseCacheLock(tile['lock'])
+                raise
+        else:
+            logger.debug('Reusing tile data from cache')
+            self.metrics.cacheHit('tile')
+
+        return tile
+
+    def _productMetadata(self, sp, productLevel):
+        """Returns the parsed metadata record of a product (see parseProductMetadata). Records are kept in memory and in the cache
+           as small JSON files, so the product MTD_MSIL XML is downloaded and parsed only once"""
+        metadata = self._metadata.get(sp['uuid'])
+        if metadata is not None:
+            self.metrics.cacheHit('metadata')
+            return metadata
+
+        meta_cache_file, legacy_cache_file = self._metadataCacheFiles(sp, productLevel)
+        if self.cacheTilesData and os.path.isfile(meta_cache_file):
+            logger.debug('Reusing cached metadata info for tile \'%s\'', sp['uuid'])
+            metadata = json.loads(loadFile(meta_cache_file))
+            self._cacheIndex.hit(meta_cache_file, 'metadata')
+            self.metrics.cacheHit('metadata')
+        else:
+            with cacheLock(self.dataPath, meta_cache_file):
+                if self.cacheTilesData and os.path.isfile(meta_cache_file):
+                    #fetched by another process while waiting for the lock
+                    metadata = json.loads(loadFile(meta_cache_file))
+                    self.metrics.cacheHit('metadata')
+                else:
+                    self.metrics.cacheMiss('metadata')
+                    if self.cacheTilesData and os.path.isfile(legacy_cache_file):
+                        logger.debug('Parsing cached metadata info for tile \'%s\'', sp['uuid'])
+                        mcontents = loadFile(legacy_cache_file)
+                    else:
+                        if self.offline:
+                            raise Exception('Product metadata is not cached and downloads are disabled in offline mode. uuid=%s' % sp['uuid'])
+                        logger.debug('Getting metadata info for tile \'%s\' remotelly', sp['uuid'])
+                        with self.metrics.stage('metadata'):
+                            r = self.session.get(self._metadataUrl(sp, productLevel), timeout=60)
+                        if r.status_code!=200:
+                            raise Exception("Could not get metadata info. status=%s" % r.status_code)
+                        self.metrics.increment('bytes_downloaded', len(r.content))
+                        mcontents = r.content.decode("utf-8")
+                    metadata = self._storeMetadata(sp, productLevel, mcontents)
+
+        self._metadata[sp['uuid']] = metadata
+        return metadata
+
+    def _metadataCacheFiles(self, sp, productLevel):
+        """Returns the metadata record cache file of a product and the MTD_MSIL XML cache file used by previous versions"""
+        return self.dataPath + "/products/%s-metadata.json" % (sp['uuid']), self.dataPath + "/products/%s-MTD_MSIL%s.xml" % (sp['uuid'], productLevel)
+
+    def _metadataUrl(self, sp, productLevel):
+        return "%sodata/v1/Products('%s')/Nodes('%s.SAFE')/Nodes('MTD_MSIL%s.xml')/$value" % (self.apiUrl, sp['uuid'], sp['title'], productLevel)
+
+    def _storeMetadata(self, sp, productLevel, mcontents):
+        """Parses the MTD_MSIL XML contents of a product and stores its metadata record in the cache"""
+        with self.metrics.stage('metadata_parse'):
+            metadata = parseProductMetadata(mcontents)
+        metadata['uuid'] = sp['uuid']
+        metadata['productLevel'] = productLevel
+        meta_cache_file = self._metadataCacheFiles(sp, productLevel)[0]
+        saveFile(meta_cache_file, json.dumps(metadata))
+        self._cacheIndex.add(meta_cache_file, 'metadata')
+        return metadata
+
+    def getAvailableBands(self, productUuid):
+        """Returns a dict of band name -> list of resolutions available for a product whose metadata is already cached, without network access.
+           Level 1C products have one image per band and report the resolution as ''"""
+        metadata = self._metadata.get(productUuid)
+        if metadata is None:
+            meta_cache_file = self.dataPath + "/products/%s-metadata.json" % (productUuid)
+            if not os.path.isfile(meta_cache_file):
+                raise Exception("Metadata for product %s is not cached" % productUuid)
+            metadata = json.loads(loadFile(meta_cache_file))
+            self._metadata[productUuid] = metadata
+        return dict([(band, sorted(files.keys())) for band, files in metadata['bands'].items()])
+
+    def _convertTile(self, tile, bandName, resolution, resolutionDownload):
+        """Converts a downloaded tile image to GeoTIFF and resamples it to the desired resolution if needed"""
+        downloadFilename = tile['downloadFilename']
+        #scene classification values are labels and must not be averaged
+        resampling = 'average'
+        if bandName=='SCL':
+            resampling = 'nearest'
+
+        if tile['jp2'] is not None:
+            #remove near black features on image border due to compression artifacts. if not removed, some black pixels 
+            #will be present on final image, specially when there is an inclined crop in source images
+            if bandName=='TCI':
+                logger.debug('Removing near black compression artifacts')
+            #readers never see a partially written tile
+            tmp_file = "%s-%s.tmp" % (downloadFilename, uuid.uuid4().hex)
+            try:
+                translateTile(tile['jp2'], tmp_file, removeNearBlack=(bandName=='TCI'), overviewResampling=resampling, useGdalApi=self.useGdalApi, metrics=self.metrics)
+                self.metrics.increment('bytes_written', os.path.getsize(tmp_file))
+                os.replace(tmp_file, downloadFilename)
+                os.remove(tile['jp2'])
+            finally:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                releaseCacheLock(tile['lock'])
+            self._cacheIndex.add(downloadFilename, 'tile')
+        else:
+            self._cacheIndex.hit(downloadFilename, 'tile')
+
+        filename = downloadFilename
+        if resolution!=resolutionDownload:
+            #derived resolutions are just views over the internal overviews of the cached tile
+            filename = self.dataPath + "/products/%s/%s/%s-%s.vrt" % (tile['date'], tile['uuid'], tile['name'], resolution)
+            logger.debug("Resampling band %s originally in resolution %s to %s" % (bandName, resolutionDownload, resolution))
+            rexp = "([0-9]+).*"
+            rnumber = re.search(rexp, resolution)
+            if not self.cacheTilesData or not os.path.isfile(filename):
+                with cacheLock(self.dataPath, filename):
+                    if not self.cacheTilesData or not os.path.isfile(filename):
+                        self.metrics.cacheMiss('resampled')
+                        #same directory as the tile, so that its relative source path stays valid after renaming
+                        tmp_file = "%s-%s.tmp.vrt" % (filename[:-4], uuid.uuid4().hex)
+                        with self.metrics.stage('resample'):
+                            resampleTile(downloadFilename, tmp_file, float(rnumber.group(1)), resampling=resampling, useGdalApi=self.useGdalApi)
+                        os.replace(tmp_file, filename)
+                    else:
+                        self.metrics.cacheHit('resampled')
+                self._cacheIndex.add(filename, 'resampled')
+            else:
+                self._cacheIndex.hit(filename, 'resampled')
+                self.metrics.cacheHit('resampled')
+
+        return filename
+
+    def cropRegion(self, geoPolygon, sourceGeoTiffs, resolution=None):
         """Returns an image file with contents from a bunch of GeoTiff files cropped to the specified geoPolygon.
+           If resolution is specified, the output grid depends only on geoPolygon and resolution, so that crops from different dates or bands are aligned.
            Pay attention to the fact that a new file is created at each request and you should delete it after using it"""
         logger.debug("Cropping polygon from %d files" % (len(sourceGeoTiffs)))
-        desiredRegion = Polygon(geoPolygon)
 
 #         #show tile images
 #         for fn in tilesData:
@@ -245,204 +539,622 @@ class Sentinel2Loader:
         source_tiles = ' '.join(sourceGeoTiffs)
         tmp_file = "%s/tmp/%s.tiff" % (self.dataPath, uuid.uuid4().hex)
         if not os.path.exists(os.path.dirname(tmp_file)):
-            os.makedirs(os.path.dirname(tmp_file))
-        
+            os.makedirs(os.path.dirname(tmp_file), exist_ok=True)
+
         #define output bounds in destination srs reference
-        bounds = desiredRegion.bounds
-        s1 = convertWGS84To3857(bounds[0], bounds[1])
-        s2 = convertWGS84To3857(bounds[2], bounds[3])
+        bounds, pixelSize = regionGrid(geoPolygon, resolution)
 
         logger.debug('Combining tiles into a single image. sources=%s tmpfile=%s' % (source_tiles, tmp_file))
-        os.system("gdalwarp -multi -srcnodata 0 -t_srs EPSG:3857 -te %s %s %s %s %s %s" % (s1[0],s1[1],s2[0],s2[1],source_tiles,tmp_file))
-        
+        with self.metrics.stage('warp'):
+            warpRegion(sourceGeoTiffs, tmp_file, bounds, pixelSize=pixelSize, useGdalApi=self.useGdalApi)
+        self.metrics.increment('bytes_written', os.path.getsize(tmp_file))
+
         return tmp_file
 
+    def cropRegionArray(self, geoPolygon, sourceGeoTiffs, resolution=None, dtype=None):
+        """Same as cropRegion, but returns (data, geoTransform, projection) with the cropped image as a numpy array and no files written"""
+        logger.debug("Cropping polygon from %d files into memory" % (len(sourceGeoTiffs)))
+        bounds, pixelSize = regionGrid(geoPolygon, resolution)
+        with self.metrics.stage('warp'):
+            return warpRegionArray(sourceGeoTiffs, bounds, pixelSize=pixelSize, dtype=dtype, useGdalApi=self.useGdalApi, tmpDir="%s/tmp" % self.dataPath)
 
-    def getRegionHistory(self, geoPolygon, bandOrIndexName, resolution, dateFrom, dateTo, daysStep=5, ignoreMissing=True, minVisibleLand=0, visibleLandPolygon=None, keepVisibleWithCirrus=False, interpolateMissingDates=False):
-        """Gets a series of GeoTIFF files for a region for a specific band and resolution in a date range"""
+
+    def getRegionHistory(self, geoPolygon, bandOrIndexName, resolution, dateFrom, dateTo, daysStep=5, ignoreMissing=True, minVisibleLand=0, visibleLandPolygon=None, keepVisibleWithCirrus=False, interpolateMissingDates=False, parallelDates=1, interpolateCloudMasked=False, persistResults=False):
+        """Gets a series of GeoTIFF files for a region for a specific band and resolution in a date range.
+           The catalogue is queried once for the whole range and up to parallelDates dates are processed concurrently. Files are returned in date order.
+           If interpolateMissingDates is True (or one of 'linear', 'nearest', 'previous'; True means 'linear'), images for dates without a suitable image
+           between two good ones are created by interpolating each pixel over time. If interpolateCloudMasked is True, pixels hidden by clouds according to
+           the SCL band are treated as gaps and interpolated too.
+           If persistResults is True, the image of each date is kept in dataPath/history (see _persistedHistoryStep) and reused by later calls with
+           the same parameters, so that only new or invalidated dates are processed. Those files are shared and must not be modified or deleted"""
         logger.info("Getting region history for band %s from %s to %s at %s" % (bandOrIndexName, dateFrom, dateTo, resolution))
-        dateFromObj = datetime.strptime(dateFrom, '%Y-%m-%d')
-        dateToObj = datetime.strptime(dateTo, '%Y-%m-%d')
-        dateRef = dateFromObj
-        regionHistoryFiles = []
         
         if visibleLandPolygon is None:
             visibleLandPolygon = geoPolygon
-        
-        lastSuccessfulFile = None
-        pendingInterpolations = 0
-        
-        while dateRef <= dateToObj:
-            logger.debug(dateRef)
-            dateRefStr = dateRef.strftime("%Y-%m-%d")
-            regionFile = None
-            try:
 
-                cirrus = 0
-                if keepVisibleWithCirrus:
-                    cirrus = 1
+        def getStep(dateRefStr):
+            return self._getRegionHistoryStep(geoPolygon, bandOrIndexName, resolution, dateRefStr, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus)
 
-                if minVisibleLand > 0:
-                    try:
-                        labelsFile = self.getRegionBand(visibleLandPolygon, "SCL", resolution, dateRefStr)
-                        ldata = gdal.Open(labelsFile).ReadAsArray()
-                        ldata[ldata==1] = 0
-                        ldata[ldata==2] = 0
-                        ldata[ldata==3] = 0
-                        ldata[ldata==4] = 1
-                        ldata[ldata==5] = 1
-                        ldata[ldata==6] = 1
-                        ldata[ldata==7] = 0
-                        ldata[ldata==8] = 0
-                        ldata[ldata==9] = 0
-                        ldata[ldata==10] = cirrus
-                        ldata[ldata==11] = 1
-                        os.remove(labelsFile)
-                        
-                        s = np.shape(ldata)
-                        visibleLandRatio = np.sum(ldata)/(s[0]*s[1])
-
-                        if visibleLandRatio<minVisibleLand:
-                            raise Exception("Too few land shown in image. visible ratio=%s" % visibleLandRatio)
-                        else:
-                            logger.debug('Minimum visible land detected. visible ratio=%s' % visibleLandRatio)
-
-                    except Exception as exp:
-                        logger.warning('Could not filter minimum visible land using SCL band. dateRef=%s err=%s' % (dateRefStr, exp))
-
-                if bandOrIndexName in ['NDVI', 'NDWI', 'NDWI_MacFeeters', 'NDMI']:
-                    regionFile = self.getRegionIndex(geoPolygon, bandOrIndexName, resolution, dateRefStr)
-                else:
-                    regionFile = self.getRegionBand(geoPolygon, bandOrIndexName, resolution, dateRefStr)
-                tmp_tile_file = "%s/tmp/%s-%s-%s-%s.tiff" % (self.dataPath, dateRefStr, bandOrIndexName, resolution, uuid.uuid4().hex)
-
-                useImage = True
-                
-                if pendingInterpolations>0:
-                    previousData = gdal.Open(lastSuccessfulFile).ReadAsArray()
-                    nextData = gdal.Open(regionFile).ReadAsArray()
-
-#                     print(np.shape(previousData))
-#                     print(np.shape(nextData))
-                    na = np.empty(np.shape(previousData))
-#                     print("INT")
-#                     print(np.shape(na))
-                    
-                    #FIXME NOT WORKING. PERFORM 2D TIME INTERPOLATION
-                    raise Exception('Interpolation not yet implemented')
-                    logger.info("Calculating %s interpolated images" % pendingInterpolations)
-                    series = pd.Series([previousData])
-                    for i in range (0, pendingInterpolations):
-                        series.add([na])
-                    series.add([nextData])
-                    idata = series.interpolate()
-                    # print(np.shape(idata))
-                    
-                    pendingInterpolations = 0
-
-                #add good image
-                os.system("mv %s %s" % (regionFile,tmp_tile_file))
-                regionHistoryFiles.append(tmp_tile_file)
-                lastSuccessfulFile = tmp_tile_file
+        if persistResults:
+            getStep = self._persistedHistoryStep(getStep, geoPolygon, bandOrIndexName, resolution, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus)
+
+        interpolate = interpolateMissingDates or interpolateCloudMasked
+        #the bulk catalogue query is kept until interpolation has finished, as cloud masks select the products of each date again
+        with self._bulkQuery([geoPolygon, visibleLandPolygon], self._historyDates(dateFrom, dateTo, daysStep)) if interpolate else nullcontext():
+            steps = []
+            for dateRefStr, regionFile, err in self._iterHistorySteps([geoPolygon, visibleLandPolygon], dateFrom, dateTo, daysStep, getStep, parallelDates):
+                if err is not None:
+                    if not ignoreMissing and not interpolateMissingDates:
+                        raise err
+                    logger.info("Couldn't get data for %s using the specified filter. err=%s" % (dateRefStr, err))
+                steps.append((dateRefStr, regionFile))
 
+            if interpolate:
+                method = 'linear'
+                if isinstance(interpolateMissingDates, str):
+                    method = interpolateMissingDates
+                #only dates between two good images are interpolated
+                good = [i for i in range(len(steps)) if steps[i][1] is not None]
+                fill = []
+                if interpolateMissingDates and len(good) > 1:
+                    fill = [i for i in range(good[0], good[-1]) if steps[i][1] is None]
+                if len(fill) > 0 or (interpolateCloudMasked and len(good) > 0):
+                    if persistResults and interpolateCloudMasked:
+                        #cloudy pixels are rewritten in place, so persisted images are copied first
+                        for i in good:
+                            tmp_tile_file = "%s/tmp/%s-%s-%s-%s.tiff" % (self.dataPath, steps[i][0], bandOrIndexName, resolution, uuid.uuid4().hex)
+                            shutil.copyfile(steps[i][1], tmp_tile_file)
+                            steps[i] = (steps[i][0], tmp_tile_file)
+                    steps = self._interpolateHistory(geoPolygon, bandOrIndexName, resolution, steps, fill, method, interpolateCloudMasked, keepVisibleWithCirrus,
+                                                       minVisibleLand, visibleLandPolygon)
+
+        regionHistoryFiles = [regionFile for dateRefStr, regionFile in steps if regionFile is not None]
+        return regionHistoryFiles
+
+    def _interpolateHistory(self, geoPolygon, bandOrIndexName, resolution, steps, fill, method, maskClouds, keepVisibleWithCirrus, minVisibleLand=0, visibleLandPolygon=None, blockRows=256):
+        """Creates images for the positions in fill of steps (a list of (date, file or None)) by interpolating each pixel over time from the good images.
+           If maskClouds is True, cloudy pixels (according to SCL) of good images are treated as gaps and rewritten too. The SCL band of each date is taken
+           from the same products as its image, after the same minVisibleLand checks (over visibleLandPolygon) as _getRegionHistoryStep. Images are processed in blocks
+           of blockRows rows, so that only a block of every image is in memory at a time. Returns steps with the created files"""
+        positions = sorted([i for i in range(len(steps)) if steps[i][1] is not None] + fill)
+        dates = [datetime.strptime(steps[i][0], '%Y-%m-%d') for i in positions]
+        times = [(d - dates[0]).days for d in dates]
+        logger.info("Calculating %d interpolated images using %s interpolation" % (len(fill), method))
+
+        datasets = []
+        reference = None
+        for i in positions:
+            if steps[i][1] is None:
+                datasets.append(None)
+                continue
+            ds = gdal.Open(steps[i][1], gdal.GA_Update if maskClouds else gdal.GA_ReadOnly)
+            if reference is None:
+                reference = ds
+            elif (ds.RasterXSize, ds.RasterYSize, ds.RasterCount) != (reference.RasterXSize, reference.RasterYSize, reference.RasterCount):
+                raise Exception("Images of the region history don't have the same size and can't be interpolated. file=%s" % steps[i][1])
+            datasets.append(ds)
+
+        cols = reference.RasterXSize
+        rows = reference.RasterYSize
+        dataType = reference.GetRasterBand(1).DataType
+        nodata = reference.GetRasterBand(1).GetNoDataValue()
+        dtype = reference.GetRasterBand(1).ReadAsArray(0, 0, 1, 1).dtype
+        steps = list(steps)
+        for t in range(len(positions)):
+            if datasets[t] is None:
+                i = positions[t]
+                tmp_tile_file = "%s/tmp/%s-%s-%s-%s.tiff" % (self.dataPath, steps[i][0], bandOrIndexName, resolution, uuid.uuid4().hex)
+                ds = gdal.GetDriverByName('GTiff').Create(tmp_tile_file, cols, rows, reference.RasterCount, dataType)
+                ds.SetGeoTransform(reference.GetGeoTransform())
+                ds.SetProjection(reference.GetProjection())
+                if nodata is not None:
+                    for b in range(reference.RasterCount):
+                        ds.GetRasterBand(b+1).SetNoDataValue(nodata)
+                datasets[t] = ds
+                steps[i] = (steps[i][0], tmp_tile_file)
+
+        #cloud masks are kept in a memory mapped file, as they are needed for all dates at once
+        masks = None
+        masksFile = None
+        if maskClouds:
+            masksFile = "%s/tmp/masks-%s.npy" % (self.dataPath, uuid.uuid4().hex)
+            masks = np.lib.format.open_memmap(masksFile, mode='w+', dtype=np.bool_, shape=(len(positions), rows, cols))
+            for t in range(len(positions)):
+                masks[t] = False
+                dateRefStr = steps[positions[t]][0]
+                if positions[t] in fill:
+                    continue
+                if self._productLevel(datetime.strptime(dateRefStr, '%Y-%m-%d')) == '1C':
+                    logger.debug('No SCL band available for Level-1C products. Clouds of %s will not be masked' % dateRefStr)
+                    continue
+                try:
+                    rejected = self._historyStepExclusions(visibleLandPolygon or geoPolygon, resolution, dateRefStr, minVisibleLand, keepVisibleWithCirrus)
+                    with self._excludeProducts(rejected):
+                        scl,_,_ = self.getRegionBandArray(geoPolygon, 'SCL', resolution, dateRefStr, dtype=None)
+                    masks[t] = sclVisibility(scl, keepVisibleWithCirrus) == 0
+                except Exception as e:
+                    logger.warning("Could not get cloud mask for %s. err=%s" % (dateRefStr, e))
+
+        try:
+            for yoff in range(0, rows, blockRows):
+                height = min(blockRows, rows - yoff)
+                for b in range(reference.RasterCount):
+                    stack = np.full((len(positions), height, cols), np.nan, dtype=np.float32)
+                    for t in range(len(positions)):
+                        if positions[t] in fill:
+                            continue
+                        stack[t] = datasets[t].GetRasterBand(b+1).ReadAsArray(0, yoff, cols, height)
+                        if nodata is not None:
+                            stack[t][stack[t] == nodata] = np.nan
+                        if masks is not None:
+                            stack[t][masks[t, yoff:yoff+height]] = np.nan
+
+                    interpolateTimeSeries(stack, times, method)
+
+                    for t in range(len(positions)):
+                        if positions[t] not in fill and (masks is None or not masks[t, yoff:yoff+height].any()):
+                            continue
+                        values = stack[t]
+                        if np.issubdtype(dtype, np.integer):
+                            values = np.clip(np.rint(values), np.iinfo(dtype).min, np.iinfo(dtype).max)
+                        values[np.isnan(values)] = nodata if nodata is not None else 0
+                        datasets[t].GetRasterBand(b+1).WriteArray(values.astype(dtype), 0, yoff)
+        finally:
+            for ds in datasets:
+                if ds is not None:
+                    ds.FlushCache()
+            datasets = None
+            reference = None
+            masks = None
+            if masksFile is not None and os.path.isfile(masksFile):
+                os.remove(masksFile)
+
+        return steps
+
+    def iterRegionHistory(self, geoPolygon, bandOrIndexName, resolution, dateFrom, dateTo, daysStep=5, minVisibleLand=0, visibleLandPolygon=None, keepVisibleWithCirrus=False, parallelDates=1, asArrays=False):
+        """Streaming version of getRegionHistory. Yields (date, GeoTIFF file) for each date with a suitable image, in date order, as soon as it is ready,
+           so that callers can process the first dates while the next ones are still being fetched. Dates without suitable images are skipped.
+           If asArrays is True, yields (date, (data, geoTransform, projection)) instead and no files are written"""
+        logger.info("Streaming region history for band %s from %s to %s at %s" % (bandOrIndexName, dateFrom, dateTo, resolution))
+        if visibleLandPolygon is None:
+            visibleLandPolygon = geoPolygon
+
+        def getStep(dateRefStr):
+            return self._getRegionHistoryStep(geoPolygon, bandOrIndexName, resolution, dateRefStr, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus, asArray=asArrays)
+
+        for dateRefStr, result, err in self._iterHistorySteps([geoPolygon, visibleLandPolygon], dateFrom, dateTo, daysStep, getStep, parallelDates):
+            if err is not None:
+                logger.info("Couldn't get data for %s using the specified filter. err=%s" % (dateRefStr, err))
+                continue
+            yield dateRefStr, result
+
+    def getRegionHistoryCube(self, geoPolygon, bandOrIndexName, resolution, dateFrom, dateTo, outputFile, daysStep=5, minVisibleLand=0, visibleLandPolygon=None, keepVisibleWithCirrus=False, parallelDates=1, dtype=np.float32):
+        """Writes a region history as a datacube: a memory mapped numpy file (.npy) with shape (dates, rows, cols), or (dates, bands, rows, cols)
+           for multi band images such as TCI, with one entry for each date from dateFrom to dateTo every daysStep days. Dates are written as soon as they
+           are ready. Dates without a suitable image are filled with NaN (or 0 for integer dtypes). A JSON file named outputFile + '.json' describes the
+           cube with its dates, which of them are valid, geoTransform and projection. Use openRegionHistoryCube(outputFile) to memory map it back.
+           All dates share the same grid, as crops of the same polygon and resolution are aligned. Returns outputFile"""
+        logger.info("Writing region history cube for band %s from %s to %s at %s to %s" % (bandOrIndexName, dateFrom, dateTo, resolution, outputFile))
+        if visibleLandPolygon is None:
+            visibleLandPolygon = geoPolygon
+
+        def getStep(dateRefStr):
+            return self._getRegionHistoryStep(geoPolygon, bandOrIndexName, resolution, dateRefStr, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus, asArray=True)
+
+        dates = [d.strftime("%Y-%m-%d") for d in self._historyDates(dateFrom, dateTo, daysStep)]
+
+        cube = None
+        info = {'band': bandOrIndexName, 'resolution': resolution, 'dates': dates, 'valid': [False]*len(dates), 'geoTransform': None, 'projection': None, 'dtype': np.dtype(dtype).name}
+        for dateRefStr, result, err in self._iterHistorySteps([geoPolygon, visibleLandPolygon], dateFrom, dateTo, daysStep, getStep, parallelDates):
+            if err is not None:
+                logger.info("Couldn't get data for %s using the specified filter. err=%s" % (dateRefStr, err))
+                continue
+            data, geoTransform, projection = result
+            if cube is None:
+                os.makedirs(os.path.dirname(os.path.abspath(outputFile)), exist_ok=True)
+                cube = np.lib.format.open_memmap(outputFile, mode='w+', dtype=dtype, shape=(len(dates),) + np.shape(data))
+                cube[:] = np.nan if np.issubdtype(cube.dtype, np.floating) else 0
+                info['geoTransform'] = list(geoTransform)
+                info['projection'] = projection
+            i = dates.index(dateRefStr)
+            cube[i] = data
+            cube.flush()
+            info['valid'][i] = True
+            saveFile(outputFile + '.json', json.dumps(info))
+
+        if cube is None:
+            raise Exception('Could not find any suitable image from %s to %s' % (dateFrom, dateTo))
+        del cube
+        return outputFile
+
+    def _getRegionHistoryStep(self, geoPolygon, bandOrIndexName, resolution, dateRefStr, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus, asArray=False):
+        """Returns a GeoTIFF file (or a tuple (data, geoTransform, projection) if asArray is True) for a single date of a region history
+           or raises an exception if there is no suitable image for it (see _historyStepExclusions)"""
+        rejected = self._historyStepExclusions(visibleLandPolygon, resolution, dateRefStr, minVisibleLand, keepVisibleWithCirrus)
+        with self._excludeProducts(rejected):
+            return self._getRegionHistoryData(geoPolygon, bandOrIndexName, resolution, dateRefStr, asArray)
+
+    def _historyStepExclusions(self, visibleLandPolygon, resolution, dateRefStr, minVisibleLand, keepVisibleWithCirrus):
+        """Returns the products that must be excluded for a date of a region history to have at least minVisibleLand visible land, or raises
+           an exception if there is no suitable product. Land visibility is checked using the SCL band before the requested band is fetched.
+           If it is too low, up to visibilityFallbacks other products of the date tolerance window are tried. Visibility ratios are cached,
+           so calling it again for the same date doesn't read any image"""
+        rejected = set()
+        if minVisibleLand <= 0:
+            return rejected
+        for attempt in range(self.visibilityFallbacks + 1):
+            with self._excludeProducts(rejected):
+                try:
+                    visibility = self._regionVisibility(visibleLandPolygon, resolution, dateRefStr, keepVisibleWithCirrus)
+                except Exception as exp:
+                    if len(rejected) > 0:
+                        raise Exception("Too few land shown in images and no other products available. err=%s" % exp)
+                    logger.warning('Could not filter minimum visible land using SCL band. dateRef=%s err=%s' % (dateRefStr, exp))
+                    visibility = None
+            if visibility is not None:
+                visibleLandRatio, productUuids = visibility
+                if visibleLandRatio < minVisibleLand:
+                    logger.debug('Too few land shown in image. dateRef=%s visible ratio=%s products=%s' % (dateRefStr, visibleLandRatio, productUuids))
+                    rejected.update(productUuids)
+                    continue
+                logger.debug('Minimum visible land detected. visible ratio=%s' % visibleLandRatio)
+            return rejected
+
+        raise Exception("Too few land shown in image. dateRef=%s visible ratio=%s" % (dateRefStr, visibleLandRatio))
+
+    def _getRegionHistoryData(self, geoPolygon, bandOrIndexName, resolution, dateRefStr, asArray):
+        if asArray:
+            if bandOrIndexName in INDEX_NAMES:
+                return self.getRegionIndexArray(geoPolygon, bandOrIndexName, resolution, dateRefStr)
+            return self.getRegionBandArray(geoPolygon, bandOrIndexName, resolution, dateRefStr)
+
+        if bandOrIndexName in INDEX_NAMES:
+            regionFile = self.getRegionIndex(geoPolygon, bandOrIndexName, resolution, dateRefStr)
+        else:
+            regionFile = self.getRegionBand(geoPolygon, bandOrIndexName, resolution, dateRefStr)
+        tmp_tile_file = "%s/tmp/%s-%s-%s-%s.tiff" % (self.dataPath, dateRefStr, bandOrIndexName, resolution, uuid.uuid4().hex)
+        os.replace(regionFile, tmp_tile_file)
+        return tmp_tile_file
+
+    def _persistedHistoryStep(self, getStep, geoPolygon, bandOrIndexName, resolution, minVisibleLand, visibleLandPolygon, keepVisibleWithCirrus):
+        """Wraps a region history step function so that its images are kept in a content-addressed store. Each series (crop grids, band, resolution
+           and filter parameters) has a directory dataPath/history/<series hash> with a manifest.json and one image per date, named after the hash
+           of the series, the date and the products in the image (those selected for geoPolygon after excluding the ones with too few visible land).
+           A date is processed again only if its image is missing or those products changed (e.g. a newer product was published within its date
+           tolerance). Dates without a suitable image are not stored, as checking them again is cheap with the cached visibility ratios"""
+        polygons = [geoPolygon]
+        if visibleLandPolygon is not geoPolygon:
+            polygons.append(visibleLandPolygon)
+        grids = []
+        for polygon in polygons:
+            bounds, pixelSize = regionGrid(polygon, resolution)
+            grids.append([[float(b) for b in bounds], None if pixelSize is None else float(pixelSize)])
+        params = {'grids': grids, 'band': bandOrIndexName, 'resolution': resolution, 'minVisibleLand': minVisibleLand, 'keepVisibleWithCirrus': keepVisibleWithCirrus,
+                  'visibilityFallbacks': self.visibilityFallbacks, 'nirBand': self.nirBand}
+        seriesKey = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        seriesDir = "%s/history/%s" % (self.dataPath, seriesKey)
+        manifestFile = seriesDir + "/manifest.json"
+        recorded = {}
+        if os.path.isfile(manifestFile):
+            recorded = json.loads(loadFile(manifestFile))['steps']
+
+        def record(dateRefStr, stepFile, products):
+            with cacheLock(self.dataPath, manifestFile):
+                manifest = {'params': params, 'steps': {}}
+                if os.path.isfile(manifestFile):
+                    manifest = json.loads(loadFile(manifestFile))
+                previous = manifest['steps'].get(dateRefStr)
+                manifest['steps'][dateRefStr] = {'file': os.path.basename(stepFile), 'products': products, 'computedAt': datetime.now().isoformat()}
+                saveFile(manifestFile, json.dumps(manifest, indent=1))
+            #the image computed for previous products of this date is superseded
+            if previous is not None and previous['file'] != os.path.basename(stepFile):
+                previousFile = "%s/%s" % (seriesDir, previous['file'])
+                if os.path.isfile(previousFile):
+                    logger.debug("Removing superseded history image for %s" % dateRefStr)
+                    os.remove(previousFile)
+                self._cacheIndex.remove(previousFile)
+
+        def step(dateRefStr):
+            #the products that end up in the image, after those rejected for low visible land (cached visibility ratios make this cheap)
+            rejected = self._historyStepExclusions(visibleLandPolygon, resolution, dateRefStr, minVisibleLand, keepVisibleWithCirrus)
+            try:
+                with self._excludeProducts(rejected):
+                    products = sorted(set([str(u) for u in self._selectProducts(geoPolygon, dateRefStr)[1]['uuid']]))
             except Exception as e:
-                if ignoreMissing:
-                    logger.info("Couldn't get data for %s using the specified filter. err=%s" % (dateRefStr, e))
-                else:
-                    if interpolateMissingDates:
-                        if lastSuccessfulFile!=None:
-                            pendingInterpolations = pendingInterpolations + 1
-                    else:
-                        raise e
+                logger.debug("Could not select products for persisted history step. date=%s err=%s" % (dateRefStr, e))
+                return getStep(dateRefStr)
+            stepFile = "%s/%s.tiff" % (seriesDir, hashlib.md5(json.dumps([seriesKey, dateRefStr, products]).encode()).hexdigest())
+
+            if os.path.isfile(stepFile):
+                logger.debug("Reusing persisted history image for %s" % dateRefStr)
+                self._cacheIndex.hit(stepFile, 'history')
+                self.metrics.cacheHit('history')
+                if recorded.get(dateRefStr, {}).get('file') != os.path.basename(stepFile):
+                    record(dateRefStr, stepFile, products)
+                return stepFile
 
+            with cacheLock(self.dataPath, stepFile):
+                if os.path.isfile(stepFile):
+                    self.metrics.cacheHit('history')
+                    return stepFile
+                self.metrics.cacheMiss('history')
+                regionFile = getStep(dateRefStr)
+                os.makedirs(seriesDir, exist_ok=True)
+                os.replace(regionFile, stepFile)
+                self._cacheIndex.add(stepFile, 'history')
+            record(dateRefStr, stepFile, products)
+            return stepFile
+
+        return step
+
+    def _regionVisibility(self, geoPolygon, resolution, dateReference, keepVisibleWithCirrus):
+        """Returns (visibleLandRatio, productUuids) for the products that would be selected for geoPolygon at the date reference, or None
+           for Level-1C products (which have no SCL band). Ratios are cached per set of products and crop grid in dataPath/visibility,
+           so only the SCL band is fetched for dates that end up rejected, and repeated checks don't read any image"""
+        productLevel, selected_df = self._selectProducts(geoPolygon, dateReference)
+        if productLevel == '1C':
+            logger.debug('No SCL band available for Level-1C products. Visible land will not be checked')
+            return None
+        productUuids = sorted(selected_df['uuid'])
+        bounds, pixelSize = regionGrid(geoPolygon, resolution)
+        key = hashlib.md5(json.dumps([productUuids, list(bounds), pixelSize, keepVisibleWithCirrus]).encode()).hexdigest()
+        visibility_file = "%s/visibility/%s.json" % (self.dataPath, key)
+
+        if self.cacheTilesData and os.path.isfile(visibility_file):
+            self._cacheIndex.hit(visibility_file, 'visibility')
+            self.metrics.cacheHit('visibility')
+            return json.loads(loadFile(visibility_file))['visibleLandRatio'], productUuids
+
+        with cacheLock(self.dataPath, visibility_file):
+            if self.cacheTilesData and os.path.isfile(visibility_file):
+                self.metrics.cacheHit('visibility')
+                return json.loads(loadFile(visibility_file))['visibleLandRatio'], productUuids
+            self.metrics.cacheMiss('visibility')
+            scl,_,_ = self.getRegionBandArray(geoPolygon, 'SCL', resolution, dateReference, dtype=None)
+            visibleLandRatio = float(np.count_nonzero(sclVisibility(scl, keepVisibleWithCirrus)))/scl.size
+            if self.cacheTilesData:
+                saveFile(visibility_file, json.dumps({'visibleLandRatio': visibleLandRatio, 'products': productUuids}))
+                self._cacheIndex.add(visibility_file, 'visibility')
+        return visibleLandRatio, productUuids
+
+    def _historyDates(self, dateFrom, dateTo, daysStep):
+        dateRef = datetime.strptime(dateFrom, '%Y-%m-%d')
+        dateToObj = datetime.strptime(dateTo, '%Y-%m-%d')
+        dates = []
+        while dateRef <= dateToObj:
+            dates.append(dateRef)
             dateRef = dateRef + timedelta(days=daysStep)
-            
-        return regionHistoryFiles
-    
+        return dates
+
+    def _iterHistorySteps(self, geoPolygons, dateFrom, dateTo, daysStep, stepFunction, parallelDates=1):
+        """Calls stepFunction(dateRefStr) for each date from dateFrom to dateTo every daysStep days, using a single catalogue query for all dates (see _bulkQuery)
+           and up to parallelDates threads. Yields (dateRefStr, result, exception) in date order, as soon as each date and all previous ones are done"""
+        dates = self._historyDates(dateFrom, dateTo, daysStep)
+        with self._bulkQuery(geoPolygons, dates):
+            if parallelDates <= 1:
+                for dateRef in dates:
+                    dateRefStr = dateRef.strftime("%Y-%m-%d")
+                    logger.debug(dateRef)
+                    try:
+                        yield dateRefStr, stepFunction(dateRefStr), None
+                    except Exception as e:
+                        yield dateRefStr, None, e
+                return
+
+            pool = ThreadPoolExecutor(max_workers=parallelDates, thread_name_prefix='sentinelloader-history')
+            pending = deque([dateRef.strftime("%Y-%m-%d") for dateRef in dates])
+            #only the next date and parallelDates more are submitted ahead of the consumer and each result is dropped once yielded,
+            #so that only a few dates are held in memory at a time while all threads are kept busy
+            futures = deque()
+            try:
+                while len(pending) > 0 or len(futures) > 0:
+                    while len(pending) > 0 and len(futures) < parallelDates + 1:
+                        dateRefStr = pending.popleft()
+                        futures.append((dateRefStr, pool.submit(stepFunction, dateRefStr)))
+                    #no local variable keeps the result while the consumer holds it
+                    yield self._historyStepResult(*futures.popleft())
+            finally:
+                #the caller may stop iterating before the last date
+                for dateRefStr, f in futures:
+                    f.cancel()
+                futures = None
+                pool.shutdown(wait=True)
+
+    def _historyStepResult(self, dateRefStr, future):
+        try:
+            return dateRefStr, future.result(), None
+        except Exception as e:
+            return dateRefStr, None, e
+
     def getRegionBand(self, geoPolygon, bandName, resolution, dateReference):
         regionTileFiles = self.getProductBandTiles(geoPolygon, bandName, resolution, dateReference)
-        return self.cropRegion(geoPolygon, regionTileFiles)
-    
-    def _getBandDataFloat(self, geoPolygon, bandName, resolution, dateReference):
-        bandFile = self.getRegionBand(geoPolygon, bandName, resolution, dateReference)
-        
-        gdalBand = gdal.Open(bandFile)
-        geoTransform = gdalBand.GetGeoTransform()
-        projection = gdalBand.GetProjection()
-        
-        data = gdalBand.ReadAsArray().astype(np.float)
-        os.remove(bandFile)
-        return data, geoTransform, projection
-        
+        return self.cropRegion(geoPolygon, regionTileFiles, resolution)
+
+    def getRegionBandArray(self, geoPolygon, bandName, resolution, dateReference, dtype=np.float32):
+        """Returns (data, geoTransform, projection) for a band cropped to geoPolygon, with data as a numpy array of dtype. No files are written besides the tiles cache"""
+        regionTileFiles = self.getProductBandTiles(geoPolygon, bandName, resolution, dateReference)
+        return self.cropRegionArray(geoPolygon, regionTileFiles, resolution, dtype=dtype)
+
+    def getRegionsBand(self, geoPolygons, bandName, resolution, dateReference, mask=False):
+        """Same as getRegionBand for many polygons at once. Returns a list of GeoTIFF files in geoPolygons order (see getRegionsBandArray)"""
+        files = []
+        os.makedirs("%s/tmp" % self.dataPath, exist_ok=True)
+        for data, geoTransform, projection in self.getRegionsBandArray(geoPolygons, bandName, resolution, dateReference, mask=mask, dtype=None):
+            tmp_file = "%s/tmp/%s.tiff" % (self.dataPath, uuid.uuid4().hex)
+            saveGeoTiff(data, tmp_file, geoTransform, projection, nodata=0)
+            self.metrics.increment('bytes_written', os.path.getsize(tmp_file))
+            files.append(tmp_file)
+        return files
+
+    def getRegionsBandArray(self, geoPolygons, bandName, resolution, dateReference, mask=False, dtype=np.float32):
+        """Same as getRegionBandArray for many polygons at once, returning a list of (data, geoTransform, projection) in geoPolygons order.
+           The catalogue is queried and tiles are selected once for the bounding box of all polygons and each source tile is opened and
+           reprojected once, so the cost depends on the number of pixels read rather than on the number of polygons.
+           All windows are cut from the same grid, whose pixel size is taken at the latitude of the center of all polygons.
+           If mask is True, pixels outside each polygon are set to 0 (no data) instead of returning its whole bounding box"""
+        areaPolygon = self._boundingPolygon(geoPolygons)
+        regionTileFiles = self.getProductBandTiles(areaPolygon, bandName, resolution, dateReference)
+        return self.cropRegionsArray(geoPolygons, regionTileFiles, resolution, mask=mask, dtype=dtype)
+
+    def cropRegionsArray(self, geoPolygons, sourceGeoTiffs, resolution=None, mask=False, dtype=None):
+        """Same as cropRegionArray for many polygons, cutting every window from a single reprojection of sourceGeoTiffs (see getRegionsBandArray)"""
+        logger.debug("Cropping %d polygons from %d files into memory" % (len(geoPolygons), len(sourceGeoTiffs)))
+        bounds, pixelSize = regionGrid(self._boundingPolygon(geoPolygons), resolution)
+        with self.metrics.stage('warp'):
+            return warpRegionWindows(sourceGeoTiffs, bounds, geoPolygons, pixelSize=pixelSize, dtype=dtype, mask=mask,
+                                     useGdalApi=self.useGdalApi, tmpDir="%s/tmp" % self.dataPath)
+
+    def getRegionsStatistics(self, geoPolygons, bandOrIndexName, resolution, dateFrom, dateTo, daysStep=5, stats=('count', 'mean', 'median', 'std'),
+                             maskClouds=True, keepVisibleWithCirrus=False, ignoreMissing=True, parallelDates=1):
+        """Returns a pandas DataFrame with one row per polygon and date from dateFrom to dateTo (every daysStep days) and one column per statistic of
+           a band or index over the polygon pixels. stats are names of utils.ZONAL_STATISTICS or 'pNN' for percentiles (e.g. 'p90'). Columns 'polygon'
+           (position in geoPolygons) and 'date' identify each row, and 'pixels' has the number of polygon pixels. Polygons are rasterized once on the
+           crop grid of their bounding box and statistics of all polygons are calculated at once for each date in memory, without writing any files.
+           A pixel belongs to a polygon when its center is inside it, so polygons smaller than a pixel may have no pixels (pixels 0 and NaN statistics).
+           Overlapping polygons are rasterized in separate groups, so pixels in the overlap count for each of them.
+           If maskClouds is True, pixels that are not visible according to the SCL band are ignored (Level-1C dates have no SCL band and are not masked). Dates without images are skipped (or raise if ignoreMissing is False)"""
+        logger.info("Getting statistics of %d polygons for %s from %s to %s at %s" % (len(geoPolygons), bandOrIndexName, dateFrom, dateTo, resolution))
+        areaPolygon = self._boundingPolygon(geoPolygons)
+        stats = list(stats)
+        groups = nonOverlappingGroups(geoPolygons)
+        #the label rasters are the same for all dates, as they share the crop grid
+        zones = {}
+        zonesLock = threading.Lock()
+
+        def getLabels(geoTransform, shape):
+            with zonesLock:
+                key = (tuple(geoTransform), shape)
+                if key not in zones:
+                    zones[key] = [rasterizePolygons([geoPolygons[i] for i in group], geoTransform, shape[1], shape[0]) for group in groups]
+                return zones[key]
+
+        def getStep(dateRefStr):
+            if bandOrIndexName in INDEX_NAMES:
+                data, geoTransform, projection = self.getRegionIndexArray(areaPolygon, bandOrIndexName, resolution, dateRefStr)
+                valid = np.isfinite(data)
+            else:
+                data, geoTransform, projection = self.getRegionBandArray(areaPolygon, bandOrIndexName, resolution, dateRefStr, dtype=None)
+                if len(data.shape) != 2:
+                    raise Exception("Statistics are only available for single band images. band=%s" % bandOrIndexName)
+                valid = data != 0
+            groupLabels = getLabels(geoTransform, data.shape)
+            if maskClouds and self._productLevel(datetime.strptime(dateRefStr, '%Y-%m-%d')) == '1C':
+                logger.debug('No SCL band available for Level-1C products. Clouds of %s will not be masked' % dateRefStr)
+            elif maskClouds:
+                scl,_,_ = self.getRegionBandArray(areaPolygon, 'SCL', resolution, dateRefStr, dtype=None)
+                valid = valid & (sclVisibility(scl, keepVisibleWithCirrus) == 1)
+            results = dict([(stat, np.empty(len(geoPolygons))) for stat in stats])
+            pixels = np.zeros(len(geoPolygons), dtype=np.int64)
+            with self.metrics.stage('statistics'):
+                for group, labels in zip(groups, groupLabels):
+                    groupResults = zonalStatistics(data, labels, len(group), stats, valid)
+                    for stat in stats:
+                        results[stat][group] = groupResults[stat]
+                    pixels[group] = np.bincount(labels.ravel(), minlength=len(group)+1)[1:]
+            return results, pixels
+
+        rows = []
+        for dateRefStr, result, err in self._iterHistorySteps([areaPolygon], dateFrom, dateTo, daysStep, getStep, parallelDates):
+            if err is not None:
+                if not ignoreMissing:
+                    raise err
+                logger.info("Couldn't get data for %s. err=%s" % (dateRefStr, err))
+                continue
+            results, pixels = result
+            table = pd.DataFrame(dict([(stat, results[stat]) for stat in stats]))
+            table.insert(0, 'pixels', pixels)
+            table.insert(0, 'date', dateRefStr)
+            table.insert(0, 'polygon', np.arange(len(geoPolygons)))
+            rows.append(table)
+
+        if len(rows) == 0:
+            return pd.DataFrame(columns=['polygon', 'date', 'pixels'] + stats)
+        return pd.concat(rows, ignore_index=True)
+
+    def _boundingPolygon(self, geoPolygons):
+        bounds = [Polygon(g).bounds for g in geoPolygons]
+        bbox = (min([b[0] for b in bounds]), min([b[1] for b in bounds]), max([b[2] for b in bounds]), max([b[3] for b in bounds]))
+        return [(bbox[0], bbox[3]), (bbox[0], bbox[1]), (bbox[2], bbox[1]), (bbox[2], bbox[3])]
+
     def getRegionIndex(self, geoPolygon, indexName, resolution, dateReference):
-        if indexName=='NDVI':
-            #get band 04
-            red,geoTransform,projection = self._getBandDataFloat(geoPolygon, 'B04', resolution, dateReference)
-            #get band 08
-            nir,_,_ = self._getBandDataFloat(geoPolygon, self.nirBand, resolution, dateReference)
-            #calculate ndvi
-            ndvi = ((nir - red)/(nir + red))
-            #save file
-            tmp_file = "%s/tmp/ndvi-%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-            saveGeoTiff(ndvi, tmp_file, geoTransform, projection)
-            return tmp_file
+        data, geoTransform, projection = self.getRegionIndexArray(geoPolygon, indexName, resolution, dateReference)
+        return self._saveRegionIndex(indexName, data, geoTransform, projection)
 
-        elif indexName=='NDWI':
-            #get band 08
-            b08,geoTransform,projection = self._getBandDataFloat(geoPolygon, self.nirBand, resolution, dateReference)
-            #get band 11
-            b11,_,_ = self._getBandDataFloat(geoPolygon, 'B11', resolution, dateReference)
-            #calculate
-            ndwi = ((b08 - b11)/(b08 + b11))
-            #save file
-            tmp_file = "%s/tmp/ndwi-%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-            saveGeoTiff(ndwi, tmp_file, geoTransform, projection)
-            return tmp_file
+    def _saveRegionIndex(self, indexName, data, geoTransform, projection):
+        tmp_file = "%s/tmp/%s-%s.tiff" % (self.dataPath, indexName.lower(), uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(tmp_file), exist_ok=True)
+        saveGeoTiff(data, tmp_file, geoTransform, projection)
+        self.metrics.increment('bytes_written', os.path.getsize(tmp_file))
+        return tmp_file
 
-        elif indexName=='NDWI_MacFeeters':
-            #get band 03
-            b03,geoTransform,projection = self._getBandDataFloat(geoPolygon, 'B03', resolution, dateReference)
-            #get band 08
-            b08,_,_ = self._getBandDataFloat(geoPolygon, self.nirBand, resolution, dateReference)
-            #calculate
-            ndwi = ((b03 - b08)/(b03 + b08))
-            #save file
-            tmp_file = "%s/tmp/ndwi-%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-            saveGeoTiff(ndwi, tmp_file, geoTransform, projection)
-            return tmp_file
+    def getRegionIndexArray(self, geoPolygon, indexName, resolution, dateReference, dtype=np.float32):
+        """Returns (data, geoTransform, projection) for an index calculated over geoPolygon, with data as a numpy array of dtype"""
+        indices, geoTransform, projection = self.getRegionIndicesArray(geoPolygon, [indexName], resolution, dateReference)
+        return indices[indexName].astype(dtype, copy=False), geoTransform, projection
 
-        elif indexName=='NDMI':
-            #get band 03
-            nir,geoTransform,projection = self._getBandDataFloat(geoPolygon, 'B03', resolution, dateReference)
-            #get band 08
-            swir,_,_ = self._getBandDataFloat(geoPolygon, 'B10', resolution, dateReference)
-            #calculate
-            ndmi = ((nir - swir)/(nir + swir))
-            #save file
-            tmp_file = "%s/tmp/ndmi-%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-            saveGeoTiff(ndmi, tmp_file, geoTransform, projection)
-            return tmp_file
-        
-        elif indexName=='EVI':
-            #https://github.com/sentinel-hub/custom-scripts/tree/master/sentinel-2
-            # index = 2.5 * (B08 - B04) / ((B08 + 6.0 * B04 - 7.5 * B02) + 1.0)
-            
-            #get band 04
-            b04,geoTransform,projection = self._getBandDataFloat(geoPolygon, 'B04', resolution, dateReference)
-            #get band 08
-            b08,_,_ = self._getBandDataFloat(geoPolygon, self.nirBand, resolution, dateReference)
-            #get band 02
-            b02,_,_ = self._getBandDataFloat(geoPolygon, 'B02', resolution, dateReference)
-            #calculate
-            evi = 2.5 * (b08 - b04) / ((b08 + (6.0 * b04) - (7.5 * b02)) + 1.0)
-            #save file
-            tmp_file = "%s/tmp/ndmi-%s.tiff" % (self.dataPath, uuid.uuid4().hex)
-            saveGeoTiff(evi, tmp_file, geoTransform, projection)
+    def getRegionIndices(self, geoPolygon, indexNames, resolution, dateReference, multiBand=True, nodata=None, scale=None):
+        """Calculates several indexes over geoPolygon fetching each required band only once. If multiBand is True, returns a single GeoTIFF file
+           with one band per index (in indexNames order), otherwise a dict of index name -> GeoTIFF file. See getRegionIndicesArray for nodata and scale"""
+        indices, geoTransform, projection = self.getRegionIndicesArray(geoPolygon, indexNames, resolution, dateReference, nodata=nodata, scale=scale)
+        if nodata is None:
+            nodata = np.nan if scale is None else INT16_NODATA
+        os.makedirs("%s/tmp" % self.dataPath, exist_ok=True)
+
+        if multiBand:
+            tmp_file = "%s/tmp/%s-%s.tiff" % (self.dataPath, '-'.join(indexNames).lower(), uuid.uuid4().hex)
+            saveGeoTiff(np.stack([indices[n] for n in indexNames]), tmp_file, geoTransform, projection, nodata=nodata, bandNames=indexNames)
             return tmp_file
 
-        else:
-            raise Exception('\'indexName\' must be NDVI, NDWI, NDWI_MacFeeters, or NDMI')
+        files = {}
+        for indexName in indexNames:
+            files[indexName] = "%s/tmp/%s-%s.tiff" % (self.dataPath, indexName.lower(), uuid.uuid4().hex)
+            saveGeoTiff(indices[indexName], files[indexName], geoTransform, projection, nodata=nodata, bandNames=[indexName])
+        return files
+
+    def getRegionIndicesArray(self, geoPolygon, indexNames, resolution, dateReference, nodata=None, scale=None):
+        """Returns (indices, geoTransform, projection), with indices a dict of index name -> numpy array for each of indexNames.
+           Each band required by the indexes is fetched and cropped only once and the indexes are calculated blockwise in float32.
+           Pixels with no data or zero division are set to nodata. If scale is specified (e.g. 10000), arrays are scaled int16 and
+           nodata defaults to -32768, otherwise they are float32 and nodata defaults to NaN"""
+        bandTiles = dict([(bandName, self.getProductBandTiles(geoPolygon, bandName, resolution, dateReference)) for bandName in requiredBands(indexNames, self.nirBand)])
+        return self._regionIndicesArray(geoPolygon, indexNames, resolution, bandTiles, nodata=nodata, scale=scale)
+
+    def _regionIndicesArray(self, geoPolygon, indexNames, resolution, bandTiles, nodata=None, scale=None):
+        """Same as getRegionIndicesArray, from the tile files of each required band (band name -> files, see getProductBandTiles)"""
+        bands = {}
+        geoTransform = None
+        projection = None
+        for bandName in bandTiles:
+            bands[bandName], geoTransform, projection = self.cropRegionArray(geoPolygon, bandTiles[bandName], resolution)
+        with self.metrics.stage('indices'):
+            indices = calculateIndices(indexNames, bands, self.nirBand, nodata=nodata, scale=scale)
+        return indices, geoTransform, projection
+
+    def addMetricsHook(self, hook):
+        """Calls hook(kind, name, value) for every metric recorded by this loader: kind 'stage' with the stage duration in seconds
+           (query, metadata, download, nearblack, translate, overviews, resample, warp, indices, statistics), 'counter' with an increment
+           (bytes_downloaded, bytes_written) or 'cache' with 'hit' or 'miss' for a cache layer (query, metadata, tile, resampled, visibility).
+           Totals are kept in self.metrics, which can be exported with self.metrics.toJson() or self.metrics.toPrometheus()"""
+        self.metrics.addHook(hook)
+
+    def cleanupCache(self, filesNotUsedDays=None, maxBytes=None, policy='lru'):
+        """Removes cached files not used for more than filesNotUsedDays and then, if maxBytes is specified, the least recently used (policy='lru')
+           or least frequently used (policy='lfu') files until the cache size is within maxBytes. Cached files are tracked in a SQLite index,
+           so the cache tree is not walked (see rebuildCacheIndex() for caches created by older versions). Temporary files older than filesNotUsedDays
+           and lock files not held by any process are removed too"""
+        removed, freed = self._cacheIndex.evict(notUsedDays=filesNotUsedDays, maxBytes=maxBytes, policy=policy)
+        logger.info("Removed %d cached files (%d bytes)" % (removed, freed))
+
+        tmpDir = "%s/tmp" % self.dataPath
+        if filesNotUsedDays is not None and os.path.isdir(tmpDir):
+            for entry in os.scandir(tmpDir):
+                if entry.is_file() and entry.stat().st_mtime < time.time() - filesNotUsedDays*86400:
+                    os.remove(entry.path)
+
+        #one lock file is created for each cached file that is produced
+        logger.debug("Removed %d stale lock files" % removeStaleLocks(self.dataPath))
 
-    def cleanupCache(self, filesNotUsedDays):
-        os.system("find %s -type f -name '*' -mtime +%s -exec rm {} \;" % (self.dataPath, filesNotUsedDays))
+    def rebuildCacheIndex(self):
+        """Indexes files already present in dataPath that are not in the cache index yet, such as caches created by previous versions"""
+        self._cacheIndex.rebuild()
         
@@ -1,12 +1,25 @@
-import sys
 import os
 from osgeo import ogr
-from shapely.geometry import Point, Polygon, mapping
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 import requests
-import subprocess
+import shutil
+import threading
+import fcntl
+import hashlib
+from contextlib import contextmanager
+import io
+import json
+import xml.etree.ElementTree as ET
+import uuid
+import re
+import math
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal, osr    
-import cartopy.crs as ccrs
 import logging
+from .metrics import ProgressBar, timed
 
 logger = logging.getLogger('sentinelloader')
 
@@ -21,36 +34,458 @@ def gmlToPolygon(gmlStr):
     return Polygon(coords)
 
 
-def downloadFile(url, filepath, user, password):
-    if not os.path.exists(os.path.dirname(filepath)):
-        os.makedirs(os.path.dirname(filepath))
+def _strtreeQuery(tree, geometries, geometry):
+    #shapely>=2 returns positions, older versions return the geometries themselves
+    result = tree.query(geometry)
+    if len(result) > 0 and hasattr(result[0], 'geom_type'):
+        positions = dict([(id(g), i) for i, g in enumerate(geometries)])
+        return [positions[id(g)] for g in result]
+    return [int(i) for i in result]
 
-    with open(filepath, "wb") as f:
-        logger.debug("Downloading %s to %s" % (url, filepath))
-        response = requests.get(url, auth=(user, password), stream=True)
-        if response.status_code != 200:
-            raise Exception("Could not download file. status=%s" % response.status_code)
-        total_length = response.headers.get('content-length')
 
-        if total_length is None:  # no content length header
-            f.write(response.content)
+def selectCoveringTiles(region, footprints, tree, minGainRatio=0.9):
+    """Selects footprints (sorted from the most to the least preferred) that together cover region. At each step, the candidates that
+       intersect the area still missing are looked up in tree (a STRtree over footprints) and the most preferred of the ones that cover at least
+       minGainRatio of what the best candidate would cover is selected. Returns (selected positions, area still missing)"""
+    missing = region
+    selected = []
+    while missing.area > region.area*1e-6:
+        gains = []
+        for i in sorted(_strtreeQuery(tree, footprints, missing)):
+            if i not in selected:
+                gain = missing.intersection(footprints[i]).area
+                if gain > 0:
+                    gains.append((i, gain))
+        if len(gains) == 0:
+            break
+        bestGain = max([g for i, g in gains])
+        best = [i for i, g in gains if g >= bestGain*minGainRatio][0]
+        selected.append(best)
+        missing = missing.difference(footprints[best])
+    return selected, missing
+
+
+def createSession(user, password, poolSize=10):
+    """Creates a requests Session with a connection pool large enough for poolSize concurrent transfers to the same host"""
+    session = requests.Session()
+    session.auth = (user, password)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def downloadFile(url, filepath, user, password, session=None, parallelRanges=1, minRangeSize=32*1024*1024, retries=3, showProgress=True, progress=None, rateLimiter=None):
+    """Downloads url contents to filepath. Data is written to a '.part' file that is renamed to filepath only when complete,
+       so an interrupted download is resumed from where it stopped (using HTTP Range requests) on retries or on the next call.
+       If parallelRanges>1 and the server supports ranges, files larger than minRangeSize are fetched as parallelRanges concurrent byte ranges.
+       progress is a reporter called as progress(name, downloaded, total, finished) (see metrics.ProgressBar). If it is None and showProgress
+       is True, a progress bar is drawn on stdout. If rateLimiter (see RateLimiter) is set, received data is throttled by it. Returns the file size"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    if session is None:
+        session = requests.Session()
+    auth = (user, password)
+    logger.debug("Downloading %s to %s" % (url, filepath))
+
+    total_length = None
+    if parallelRanges > 1:
+        response = session.head(url, auth=auth, allow_redirects=True)
+        if response.status_code == 200 and response.headers.get('accept-ranges') == 'bytes' and response.headers.get('content-length') is not None:
+            total_length = int(response.headers.get('content-length'))
+
+    if progress is None and showProgress:
+        progress = ProgressBar()
+    progress = _DownloadProgress(os.path.basename(filepath), total_length, progress)
+    if total_length is not None and total_length >= minRangeSize:
+        size = total_length // parallelRanges
+        ranges = [(i*size, (i+1)*size-1) for i in range(parallelRanges)]
+        ranges[-1] = (ranges[-1][0], total_length-1)
+        #the number of ranges is part of the name so that leftovers from a download with a different split are not mixed
+        parts = ["%s.part%dof%d" % (filepath, i, parallelRanges) for i in range(parallelRanges)]
+        with ThreadPoolExecutor(max_workers=parallelRanges) as pool:
+            futures = [pool.submit(_downloadRange, session, url, auth, parts[i], ranges[i][0], ranges[i][1], progress, retries, rateLimiter) for i in range(parallelRanges)]
+            for f in futures:
+                f.result()
+        #parts are assembled into a separate file and removed only after it is renamed, so that an interrupted
+        #assembly leaves them untouched and is simply done again on the next call
+        assembly = "%s.part-assembly" % filepath
+        with open(assembly, 'wb') as fw:
+            for part in parts:
+                with open(part, 'rb') as fr:
+                    shutil.copyfileobj(fr, fw, 1024*1024)
+        os.replace(assembly, filepath)
+        for part in parts:
+            os.remove(part)
+
+    else:
+        part = filepath + ".part"
+        _downloadRange(session, url, auth, part, 0, None, progress, retries, rateLimiter)
+        os.replace(part, filepath)
+
+    progress.finish()
+    return os.path.getsize(filepath)
+
+
+def partialDownloadBytes(filepath, parallelRanges=1):
+    """Returns the bytes of filepath already downloaded by an interrupted downloadFile call with parallelRanges, which are resumed by the next
+       call. The '.part-assembly' file of an interrupted assembly is not counted, as its contents are a copy of the range parts"""
+    parts = [filepath + ".part"]
+    if parallelRanges > 1:
+        parts = parts + ["%s.part%dof%d" % (filepath, i, parallelRanges) for i in range(parallelRanges)]
+    return sum([os.path.getsize(part) for part in parts if os.path.isfile(part)])
+
+
+def _downloadRange(session, url, auth, partFile, start, end, progress, retries, rateLimiter=None):
+    """Downloads bytes start-end (end=None for until the end of file) of url appending to partFile, resuming from its current size"""
+    attempt = 0
+    counted = 0
+    while True:
+        done = 0
+        if os.path.isfile(partFile):
+            done = os.path.getsize(partFile)
+        if end is not None and start + done > end:
+            progress.add(done - counted)
+            return
+
+        headers = {}
+        if start + done > 0 or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (start + done, '' if end is None else end)
+
+        try:
+            with session.get(url, auth=auth, headers=headers, stream=True, timeout=60) as response:
+                mode = 'ab'
+                if response.status_code == 416 and end is None and done > 0:
+                    #range starts at the end of the file. it was already completely downloaded
+                    progress.add(done - counted)
+                    return
+                elif response.status_code == 200 and 'Range' in headers:
+                    if start > 0 or end is not None:
+                        raise Exception("Server doesn't support range requests. status=%s" % response.status_code)
+                    logger.debug("Server ignored range request. Restarting download of %s" % url)
+                    mode = 'wb'
+                    done = 0
+                elif response.status_code not in [200, 206]:
+                    raise Exception("Could not download file. status=%s" % response.status_code)
+
+                if done > 0:
+                    logger.debug("Resuming download of %s from byte %d" % (url, start + done))
+                remaining = response.headers.get('content-length')
+                if remaining is not None:
+                    remaining = int(remaining)
+                    if end is None:
+                        progress.setTotal(start + done + remaining)
+                #bytes of this range already on disk are accounted only once across retries
+                progress.add(done - counted)
+                counted = done
+                received = 0
+                with open(partFile, mode) as f:
+                    for data in response.iter_content(chunk_size=_chunkSize(remaining)):
+                        f.write(data)
+                        received += len(data)
+                        progress.add(len(data))
+                        counted += len(data)
+                        if rateLimiter is not None:
+                            rateLimiter.consume(len(data))
+
+                if remaining is not None and received < remaining:
+                    raise requests.exceptions.ConnectionError("Connection closed after %d of %d bytes" % (received, remaining))
+                return
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            attempt = attempt + 1
+            if attempt > retries:
+                raise
+            logger.warning("Download of %s interrupted. Resuming. attempt=%d err=%s" % (url, attempt, e))
+
+
+def _chunkSize(length):
+    """Chunk size proportional to the transfer size, from 64KB for small files up to 1MB for large ones"""
+    if length is None:
+        return 256*1024
+    return max(64*1024, min(1024*1024, length//256))
+
+
+class RateLimiter:
+    """Thread safe token bucket that limits the throughput of all downloads sharing it to bytesPerSecond, allowing bursts of up to burstSeconds of data"""
+
+    def __init__(self, bytesPerSecond, burstSeconds=1.0):
+        if bytesPerSecond <= 0:
+            raise Exception("bytesPerSecond must be positive. bytesPerSecond=%s" % bytesPerSecond)
+        self.bytesPerSecond = float(bytesPerSecond)
+        self.capacity = self.bytesPerSecond * burstSeconds
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Accounts nbytes transferred, sleeping until the average throughput is back under the limit"""
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, nbytes):
+        """Accounts nbytes transferred and returns the seconds to wait before transferring more, without sleeping (for asyncio callers)"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.bytesPerSecond)
+            self._last = now
+            #tokens may go negative. later callers wait for the debt of the earlier ones too
+            self._tokens -= nbytes
+            return -self._tokens / self.bytesPerSecond
+
+
+class _DownloadProgress:
+    """Thread safe progress shared by all ranges of a download, forwarded to a progress reporter"""
+
+    def __init__(self, name, total, reporter):
+        self.name = name
+        self.total = total
+        self.reporter = reporter
+        self.downloaded = 0
+        self.lock = threading.Lock()
+
+    def setTotal(self, total):
+        if self.total is None:
+            self.total = total
+
+    def add(self, n):
+        if self.reporter is None:
+            return
+        with self.lock:
+            self.downloaded += n
+            self.reporter(self.name, self.downloaded, self.total, False)
+
+    def finish(self):
+        if self.reporter is not None:
+            self.reporter(self.name, self.downloaded, self.total, True)
+
+
+def parseProductMetadata(contents):
+    """Parses the contents of a MTD_MSIL1C.xml or MTD_MSIL2A.xml product metadata file into a dict with 'startTime', 'date' (YYYY-MM-DD),
+       'cloudStats' (quality indicator name -> percentage) and 'bands' (band name -> resolution -> [granule id, image file name]).
+       Resolutions are '10m', '20m' or '60m' for Level-2A images and '' for Level-1C images, whose paths don't have a resolution"""
+    metadata = {'startTime': None, 'date': None, 'cloudStats': {}, 'bands': {}}
+    inQualityIndicators = False
+    for event, element in ET.iterparse(io.StringIO(contents), events=('start', 'end')):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'Quality_Indicators_Info':
+            inQualityIndicators = (event == 'start')
+        if event != 'end' or element.text is None:
+            continue
+        text = element.text.strip()
+
+        if tag == 'IMAGE_FILE':
+            m = re.match("GRANULE/([0-9A-Za-z_]+)/IMG_DATA/(R([0-9]+m)/)?([0-9A-Za-z_]+)$", text)
+            if m is not None:
+                resolution = m.group(3) or ''
+                name = m.group(4)
+                if resolution != '':
+                    band = name[:-len(resolution)-1].rsplit('_', 1)[-1]
+                else:
+                    band = name.rsplit('_', 1)[-1]
+                #same as searching the first occurrence in the file
+                metadata['bands'].setdefault(band, {}).setdefault(resolution, [m.group(1), name])
+
+        elif tag == 'PRODUCT_START_TIME':
+            metadata['startTime'] = text
+            metadata['date'] = text.split('T')[0]
+
+        elif inQualityIndicators and (tag.endswith('PERCENTAGE') or tag == 'Cloud_Coverage_Assessment'):
+            try:
+                metadata['cloudStats'][tag] = float(text)
+            except ValueError:
+                pass
+
+    return metadata
+
+
+#visibility of each Sentinel-2 scene classification (SCL) class: vegetation, not vegetated, water and snow are visible, while no data,
+#defective, dark, cloud shadows, unclassified and clouds are not. thin cirrus (10) visibility is configurable
+SCL_VISIBILITY = np.array([0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 1], dtype=np.uint8)
+
+
+def sclVisibility(scl, keepVisibleWithCirrus=False):
+    """Maps an array of SCL classes to 1 (visible) or 0 (not visible) with a single lookup"""
+    lut = SCL_VISIBILITY.copy()
+    if keepVisibleWithCirrus:
+        lut[10] = 1
+    return lut[np.clip(scl, 0, len(lut)-1)]
+
+
+def interpolateTimeSeries(stack, times, method='linear'):
+    """Fills NaN values of stack (an array with time as the first axis) pixel by pixel, using the closest valid values before and after
+       each gap along time. times has the time of each entry of the first axis (e.g. days). method can be 'linear' (interpolation between the
+       previous and next valid values), 'nearest' (closest valid value in time) or 'previous' (last valid value). Values that can't be filled
+       (e.g. no valid value before a gap with 'linear') are kept as NaN. stack is modified in place and returned"""
+    if method not in ['linear', 'nearest', 'previous']:
+        raise Exception('\'method\' must be linear, nearest or previous')
+    T = stack.shape[0]
+    gaps = np.isnan(stack)
+    shape = (T,) + (1,)*(stack.ndim-1)
+    positions = np.arange(T).reshape(shape)
+
+    #position of the last valid value up to each entry and of the first valid value from each entry on
+    previous = np.where(gaps, -1, positions)
+    np.maximum.accumulate(previous, axis=0, out=previous)
+    following = np.where(gaps, T, positions)
+    following = np.flip(np.minimum.accumulate(np.flip(following, axis=0), axis=0), axis=0)
+    hasPrevious = previous >= 0
+    hasFollowing = following < T
+    previous = np.clip(previous, 0, T-1)
+    following = np.clip(following, 0, T-1)
+
+    previousValues = np.take_along_axis(stack, previous, axis=0)
+    times = np.asarray(times, dtype=np.float64)
+    if method == 'previous':
+        filled = np.where(hasPrevious, previousValues, np.nan)
+    else:
+        followingValues = np.take_along_axis(stack, following, axis=0)
+        t = times.reshape(shape)
+        dtPrevious = t - times[previous]
+        dtFollowing = times[following] - t
+        if method == 'nearest':
+            usePrevious = hasPrevious & (~hasFollowing | (dtPrevious <= dtFollowing))
+            filled = np.where(usePrevious, previousValues, np.where(hasFollowing, followingValues, np.nan))
         else:
-            dl = 0
-            total_length = int(total_length)
-            for data in response.iter_content(chunk_size=4096):
-                dl += len(data)
-                f.write(data)
-                done = int(50 * dl / total_length)
-                sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)))
-                sys.stdout.flush()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = dtPrevious / (dtPrevious + dtFollowing)
+            filled = previousValues + (followingValues - previousValues) * weight
+            filled[~(hasPrevious & hasFollowing)] = np.nan
+
+    stack[gaps] = filled[gaps]
+    return stack
+
+
+ZONAL_STATISTICS = ['count', 'mean', 'std', 'min', 'max', 'median']
+
+
+def zonalStatistics(data, labels, zones, stats, valid=None):
+    """Calculates statistics of the pixels of data for each zone of labels (an int array of the same shape with values 1 to zones, 0 for none)
+       with grouped reductions over all zones at once. stats is a list of ZONAL_STATISTICS names or 'pNN' for the NN percentile (e.g. 'p90').
+       Only pixels where valid is True (if specified) are used. Returns a dict of stat -> float64 array with one value per zone (NaN when a zone has no valid pixels)"""
+    for stat in stats:
+        if stat not in ZONAL_STATISTICS and not re.match("p[0-9]+(\\.[0-9]+)?$", stat):
+            raise Exception("Unknown statistic %s. Use one of %s or pNN for percentiles" % (stat, ZONAL_STATISTICS))
+    selected = labels > 0
+    if valid is not None:
+        selected = selected & valid
+    zoneLabels = labels[selected]
+    values = data[selected].astype(np.float64)
+
+    count = np.bincount(zoneLabels, minlength=zones+1)[1:zones+1]
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'count' in stats:
+            results['count'] = count.astype(np.float64)
+        if 'mean' in stats or 'std' in stats:
+            mean = np.bincount(zoneLabels, weights=values, minlength=zones+1)[1:zones+1] / count
+            if 'mean' in stats:
+                results['mean'] = mean
+            if 'std' in stats:
+                squares = np.bincount(zoneLabels, weights=values*values, minlength=zones+1)[1:zones+1] / count
+                results['std'] = np.sqrt(np.maximum(squares - mean*mean, 0))
+
+    orderStats = [s for s in stats if s in ['min', 'max', 'median'] or s.startswith('p')]
+    if len(orderStats) > 0:
+        #sorting by zone and value puts each zone values in order in a contiguous slice
+        order = np.lexsort((values, zoneLabels))
+        sortedValues = values[order]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        empty = count == 0
+        last = np.maximum(count - 1, 0)
+        for stat in orderStats:
+            if stat == 'min':
+                q = 0.0
+            elif stat == 'max':
+                q = 1.0
+            elif stat == 'median':
+                q = 0.5
+            else:
+                q = float(stat[1:]) / 100
+            #linear interpolation between the closest ranks, as numpy.percentile
+            position = last * q
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, last)
+            if len(sortedValues) > 0:
+                lowerValues = sortedValues[np.minimum(starts + lower, len(sortedValues) - 1)]
+                upperValues = sortedValues[np.minimum(starts + upper, len(sortedValues) - 1)]
+                result = lowerValues + (upperValues - lowerValues) * (position - lower)
+            else:
+                result = np.zeros(zones)
+            result[empty] = np.nan
+            results[stat] = result
+
+    return results
+
+
+def openRegionHistoryCube(cubeFile, mode='r'):
+    """Memory maps a datacube written by Sentinel2Loader.getRegionHistoryCube. Returns (cube, info), with cube a numpy memmap
+       with shape (dates, rows, cols) or (dates, bands, rows, cols) and info a dict with 'dates', 'valid', 'geoTransform' and 'projection'"""
+    with open(cubeFile + '.json', 'r') as fr:
+        info = json.load(fr)
+    return np.load(cubeFile, mmap_mode=mode), info
 
 
 def saveFile(filename, contents):
-    if not os.path.exists(os.path.dirname(filename)):
-        os.makedirs(os.path.dirname(filename))
-    with open(filename, 'w') as fw:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    #written to a temporary file and renamed, so readers never see partial contents
+    tmp_file = "%s-%s.tmp" % (filename, uuid.uuid4().hex)
+    with open(tmp_file, 'w') as fw:
         fw.write(contents)
         fw.flush()
+    os.replace(tmp_file, filename)
+
+
+def acquireCacheLock(dataPath, cacheFile):
+    """Blocks until an exclusive lock for producing cacheFile is acquired. Locks are shared by all threads and processes using the same dataPath
+       (lock files are kept in dataPath/locks). Returns a handle to be passed to releaseCacheLock"""
+    lockFile = "%s/locks/%s.lock" % (dataPath, hashlib.md5(os.path.relpath(cacheFile, dataPath).encode()).hexdigest())
+    while True:
+        os.makedirs(os.path.dirname(lockFile), exist_ok=True)
+        f = open(lockFile, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        #the lock file may have been removed by removeStaleLocks while waiting for it. in that case, lock the new one
+        try:
+            if os.stat(lockFile).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def releaseCacheLock(lock):
+    if lock is not None and not lock.closed:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+
+
+def removeStaleLocks(dataPath):
+    """Removes the lock files in dataPath/locks that are not held by any thread or process. Returns the number of files removed"""
+    lockDir = "%s/locks" % dataPath
+    removed = 0
+    if not os.path.isdir(lockDir):
+        return removed
+    for entry in os.scandir(lockDir):
+        if not entry.is_file():
+            continue
+        with open(entry.path, 'a') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            #removed while locked. waiters of this file notice it and lock a new one (see acquireCacheLock)
+            os.remove(entry.path)
+            removed = removed + 1
+    return removed
+
+
+@contextmanager
+def cacheLock(dataPath, cacheFile):
+    lock = acquireCacheLock(dataPath, cacheFile)
+    try:
+        yield
+    finally:
+        releaseCacheLock(lock)
 
 
 def loadFile(filename):
@@ -58,29 +493,330 @@ def loadFile(filename):
         return fr.read()
 
 
+_transformations = threading.local()
+
+
+def getCoordinateTransformation(sourceEpsg, targetEpsg):
+    """Returns an osr CoordinateTransformation between two EPSG codes with coordinates in (x/longitude, y/latitude) order.
+       Transformations are built once per EPSG pair and per thread, as osr objects must not be shared among threads"""
+    cache = getattr(_transformations, 'cache', None)
+    if cache is None:
+        cache = {}
+        _transformations.cache = cache
+
+    key = (sourceEpsg, targetEpsg)
+    transformation = cache.get(key)
+    if transformation is None:
+        srs = []
+        for epsg in key:
+            sr = osr.SpatialReference()
+            sr.ImportFromEPSG(epsg)
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            srs.append(sr)
+        transformation = osr.CoordinateTransformation(srs[0], srs[1])
+        cache[key] = transformation
+    return transformation
+
+
+def transformCoordinates(xs, ys, sourceEpsg=4326, targetEpsg=3857):
+    """Transforms arrays of x and y coordinates from sourceEpsg to targetEpsg in a single call. Returns a tuple of numpy arrays (xs, ys)"""
+    xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    if xs.size == 0:
+        return xs.copy(), ys.copy()
+    points = np.column_stack((xs.ravel(), ys.ravel()))
+    transformed = np.asarray(getCoordinateTransformation(sourceEpsg, targetEpsg).TransformPoints(points.tolist()))
+    return transformed[:,0].reshape(xs.shape), transformed[:,1].reshape(ys.shape)
+
+
 def convertWGS84To3857(x, y):
-    s1 = subprocess.check_output(["echo \"%s %s\" | cs2cs +init=epsg:4326 +to +init=epsg:3857" % (x,y)], shell=True)
-    # s1 = !echo "{x} {y}" | cs2cs + init = epsg: 4326 + to + init = epsg: 3857
-    s = s1.decode("utf-8").replace(" 0.00", "").split('\t')
-    return (float(s[0]), float(s[1]))
+    xs, ys = transformCoordinates([x], [y])
+    return (float(xs[0]), float(ys[0]))
 
 
 def convertGeoJSONFromWGS84To3857(geojson):
-    coords = []
-    c = geojson['coordinates'][0]
-    for co in list(c):
-        coords.append(convertWGS84To3857(co[0], co[1]))
+    c = np.asarray(geojson['coordinates'][0], dtype=np.float64)
+    xs, ys = transformCoordinates(c[:,0], c[:,1])
+    coords = [(float(x), float(y)) for x, y in zip(xs, ys)]
     geo = {
         'coordinates': ((tuple(coords)),),
         'type': geojson['type']
     }
     return geo
 
-def saveGeoTiff(imageDataFloat, outputFile, geoTransform, projection):
+def saveGeoTiff(imageData, outputFile, geoTransform, projection, nodata=None, bandNames=None):
+    """Saves a 2D array or a 3D array (bands, rows, cols) to a GeoTIFF file. int16/uint8/uint16 arrays keep their type, other types are saved as float32"""
+    if len(imageData.shape) == 2:
+        imageData = imageData.reshape((1,) + imageData.shape)
+    dataType = {np.dtype(np.int16): gdal.GDT_Int16, np.dtype(np.uint8): gdal.GDT_Byte, np.dtype(np.uint16): gdal.GDT_UInt16}.get(imageData.dtype, gdal.GDT_Float32)
     driver = gdal.GetDriverByName('GTiff')
-    image_data = driver.Create(outputFile, imageDataFloat.shape[1], imageDataFloat.shape[0], 1, gdal.GDT_Float32)
-    image_data.GetRasterBand(1).WriteArray(imageDataFloat)
+    image_data = driver.Create(outputFile, imageData.shape[2], imageData.shape[1], imageData.shape[0], dataType)
+    for i in range(imageData.shape[0]):
+        band = image_data.GetRasterBand(i+1)
+        band.WriteArray(imageData[i])
+        if nodata is not None:
+            band.SetNoDataValue(float(nodata))
+        if bandNames is not None:
+            band.SetDescription(bandNames[i])
     image_data.SetGeoTransform(geoTransform) 
     image_data.SetProjection(projection)
     image_data.FlushCache()
     image_data=None
+
+
+def _checkGdalResult(ds, operation, sourceFile):
+    if ds is None:
+        raise Exception("Error during '%s' of %s. err=%s" % (operation, sourceFile, gdal.GetLastErrorMsg()))
+    ds.FlushCache()
+
+
+def _runGdalCommand(utility, args):
+    if shutil.which(utility) is None:
+        raise Exception("gdal %s utility was not found in the system. install it" % utility)
+    ret = os.system("%s %s" % (utility, args))
+    if ret != 0:
+        raise Exception("Error during '%s' execution. code=%d" % (utility, ret))
+
+
+TILE_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE']
+
+
+def _overviewFactors(pixelSize, overviewResolutions):
+    return [int(round(r/pixelSize)) for r in overviewResolutions if int(round(r/pixelSize)) > 1]
+
+
+def translateTile(sourceFile, outputFile, removeNearBlack=False, overviewResolutions=(20, 60), overviewResampling='average', useGdalApi=True, metrics=None):
+    """Converts a tile image file to a Cloud Optimized GeoTIFF (tiled, compressed and with internal overviews for each of
+       overviewResolutions in meters that is coarser than the source). If removeNearBlack is True, near black compression
+       artifacts on the image borders are removed on the way. With useGdalApi the GDAL Python API is used, otherwise gdal
+       command line utilities. The overviews are built in a temporary tiled file, which is then copied to outputFile with
+       its overviews placed before the image data as required by the COG layout. With the GDAL API the temporary file is
+       kept uncompressed in /vsimem/, so the pixels are only compressed once. Stages are timed in metrics, if specified"""
+    if useGdalApi:
+        source = sourceFile
+        nearblackFile = None
+        tiledFile = "/vsimem/%s.tiff" % uuid.uuid4().hex
+        try:
+            if removeNearBlack:
+                with timed(metrics, 'nearblack'):
+                    nearblackFile = "/vsimem/%s.tiff" % uuid.uuid4().hex
+                    ds = gdal.Nearblack(nearblackFile, sourceFile, format='GTiff')
+                    _checkGdalResult(ds, 'nearblack', sourceFile)
+                    ds = None
+                source = nearblackFile
+            with timed(metrics, 'translate'):
+                ds = gdal.Translate(tiledFile, source, format='GTiff', creationOptions=[o for o in TILE_CREATION_OPTIONS if not o.startswith('COMPRESS=')])
+                _checkGdalResult(ds, 'translate', sourceFile)
+            with timed(metrics, 'overviews'):
+                factors = _overviewFactors(abs(ds.GetGeoTransform()[1]), overviewResolutions)
+                if len(factors) > 0 and ds.BuildOverviews(overviewResampling.upper(), factors) != 0:
+                    raise Exception("Error building overviews for %s. err=%s" % (sourceFile, gdal.GetLastErrorMsg()))
+                ds = None
+                ds = gdal.Translate(outputFile, tiledFile, format='GTiff', creationOptions=TILE_CREATION_OPTIONS + ['COPY_SRC_OVERVIEWS=YES'])
+                _checkGdalResult(ds, 'translate', sourceFile)
+                ds = None
+        finally:
+            ds = None
+            if nearblackFile is not None:
+                gdal.Unlink(nearblackFile)
+            gdal.Unlink(tiledFile)
+
+    else:
+        tiledFile = "%s-%s.tmp" % (outputFile, uuid.uuid4().hex)
+        co = ' '.join(['-co %s' % o for o in TILE_CREATION_OPTIONS])
+        nearblackFile = "%s-%s.nearblack.tmp" % (outputFile, uuid.uuid4().hex)
+        try:
+            source = sourceFile
+            if removeNearBlack:
+                with timed(metrics, 'nearblack'):
+                    _runGdalCommand('nearblack', "-of GTiff -o %s %s" % (nearblackFile, sourceFile))
+                source = nearblackFile
+            with timed(metrics, 'translate'):
+                _runGdalCommand('gdal_translate', "-of GTiff %s %s %s" % (co, source, tiledFile))
+            with timed(metrics, 'overviews'):
+                ds = gdal.Open(tiledFile)
+                factors = _overviewFactors(abs(ds.GetGeoTransform()[1]), overviewResolutions)
+                ds = None
+                if len(factors) > 0:
+                    _runGdalCommand('gdaladdo', "-r %s %s %s" % (overviewResampling, tiledFile, ' '.join([str(f) for f in factors])))
+                _runGdalCommand('gdal_translate', "-of GTiff %s -co COPY_SRC_OVERVIEWS=YES %s %s" % (co, tiledFile, outputFile))
+        finally:
+            for f in [nearblackFile, tiledFile]:
+                if os.path.isfile(f):
+                    os.remove(f)
+
+
+def resampleTile(sourceFile, outputFile, resolutionMeters, resampling='average', useGdalApi=True):
+    """Writes a small VRT file that exposes sourceFile contents at resolutionMeters in its own reference system. No pixel data
+       is copied: when read, GDAL takes the data from the closest internal overview of sourceFile"""
+    if useGdalApi:
+        ds = gdal.Translate(outputFile, sourceFile, format='VRT', xRes=resolutionMeters, yRes=resolutionMeters, resampleAlg=resampling)
+        _checkGdalResult(ds, 'translate', sourceFile)
+        ds = None
+    else:
+        _runGdalCommand('gdal_translate', "-of VRT -tr %s %s -r %s %s %s" % (resolutionMeters, resolutionMeters, resampling, sourceFile, outputFile))
+
+
+def polygonBounds(geoPolygon):
+    """Returns the bounds (minx, miny, maxx, maxy) of a polygon given as a list of (lon, lat) coordinates, a shapely geometry or a GeoJSON-like geometry"""
+    if hasattr(geoPolygon, 'bounds'):
+        return tuple(geoPolygon.bounds)
+    if hasattr(geoPolygon, '__geo_interface__'):
+        geoPolygon = geoPolygon.__geo_interface__
+    if isinstance(geoPolygon, dict):
+        geoPolygon = geoPolygon.get('geometry', geoPolygon)['coordinates']
+    coords = np.asarray(geoPolygon, dtype=np.float64).reshape((-1, 2))
+    return (coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max())
+
+
+def regionGrid(geoPolygon, resolution=None):
+    """Returns the bounds (minx, miny, maxx, maxy) in EPSG:3857 of a polygon given in EPSG:4326 and, if resolution
+       (e.g. '10m') is specified, the EPSG:3857 pixel size that corresponds to it at the polygon latitude.
+       Crops of the same polygon at the same resolution always get the same grid, whatever tiles they come from"""
+    bounds = Polygon(geoPolygon).bounds
+    xs, ys = transformCoordinates([bounds[0], bounds[2]], [bounds[1], bounds[3]])
+    pixelSize = None
+    if resolution is not None:
+        meters = float(re.search("([0-9]+).*", resolution).group(1))
+        pixelSize = meters / math.cos(math.radians((bounds[1] + bounds[3]) / 2))
+    return (xs[0], ys[0], xs[1], ys[1]), pixelSize
+
+
+def warpRegion(sourceFiles, outputFile, bounds, pixelSize=None, useGdalApi=True):
+    """Combines sourceFiles into a single GeoTIFF in EPSG:3857 limited to bounds (minx, miny, maxx, maxy in EPSG:3857).
+       If pixelSize is None, the output resolution is derived from the sources"""
+    if useGdalApi:
+        ds = gdal.Warp(outputFile, sourceFiles, format='GTiff', srcNodata=0, dstSRS='EPSG:3857', outputBounds=bounds, xRes=pixelSize, yRes=pixelSize, multithread=True)
+        _checkGdalResult(ds, 'warp', ' '.join(sourceFiles))
+        ds = None
+    else:
+        tr = ''
+        if pixelSize is not None:
+            tr = '-tr %s %s' % (pixelSize, pixelSize)
+        _runGdalCommand('gdalwarp', "-of GTiff -multi -srcnodata 0 -t_srs EPSG:3857 -te %s %s %s %s %s %s %s" % (bounds[0], bounds[1], bounds[2], bounds[3], tr, ' '.join(sourceFiles), outputFile))
+
+
+def warpRegionArray(sourceFiles, bounds, pixelSize=None, dtype=None, useGdalApi=True, tmpDir=None):
+    """Same as warpRegion, but returns (data, geoTransform, projection) with data as a numpy array instead of writing a file.
+       With useGdalApi the warp is done to an in-memory dataset, otherwise through a temporary file in tmpDir"""
+    tmp_file = None
+    if useGdalApi:
+        ds = gdal.Warp('', sourceFiles, format='MEM', srcNodata=0, dstSRS='EPSG:3857', outputBounds=bounds, xRes=pixelSize, yRes=pixelSize, multithread=True)
+        _checkGdalResult(ds, 'warp', ' '.join(sourceFiles))
+    else:
+        tmp_file = "%s/%s.tiff" % (tmpDir, uuid.uuid4().hex)
+        os.makedirs(tmpDir, exist_ok=True)
+        warpRegion(sourceFiles, tmp_file, bounds, pixelSize=pixelSize, useGdalApi=False)
+        ds = gdal.Open(tmp_file)
+
+    data = ds.ReadAsArray()
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    geoTransform = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    ds = None
+    if tmp_file is not None:
+        os.remove(tmp_file)
+    return data, geoTransform, projection
+
+
+def regionWindow(geoPolygon, geoTransform, cols, rows):
+    """Returns the window (xoff, yoff, xsize, ysize) of a raster in EPSG:3857 with geoTransform and size cols x rows that covers
+       the bounds of geoPolygon (EPSG:4326), clipped to the raster. The window is empty (zero size) if they don't intersect"""
+    bounds, pixelSize = regionGrid(geoPolygon)
+    x0 = int(math.floor((bounds[0] - geoTransform[0]) / geoTransform[1] + 1e-6))
+    x1 = int(math.ceil((bounds[2] - geoTransform[0]) / geoTransform[1] - 1e-6))
+    y0 = int(math.floor((bounds[3] - geoTransform[3]) / geoTransform[5] + 1e-6))
+    y1 = int(math.ceil((bounds[1] - geoTransform[3]) / geoTransform[5] - 1e-6))
+    x0, x1 = max(0, min(cols, x0)), max(0, min(cols, x1))
+    y0, y1 = max(0, min(rows, y0)), max(0, min(rows, y1))
+    return x0, y0, max(0, x1-x0), max(0, y1-y0)
+
+
+def rasterizePolygons(geoPolygons, geoTransform, cols, rows):
+    """Returns an int32 array (rows, cols) for a raster in EPSG:3857 with geoTransform in which pixels whose center is inside
+       geoPolygons[i] (EPSG:4326) have the value i+1 and other pixels are 0. Where polygons overlap, the last one wins (see nonOverlappingGroups)"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    ds = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Int32)
+    ds.SetGeoTransform(geoTransform)
+    ds.SetProjection(srs.ExportToWkt())
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('polygons', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    for i, geoPolygon in enumerate(geoPolygons):
+        coords = list(Polygon(geoPolygon).exterior.coords)
+        xs, ys = transformCoordinates([c[0] for c in coords], [c[1] for c in coords])
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('label', i+1)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(Polygon(zip(xs, ys)).wkt))
+        layer.CreateFeature(feature)
+        feature = None
+    if gdal.RasterizeLayer(ds, [1], layer, options=['ATTRIBUTE=label']) != 0:
+        raise Exception("Error rasterizing polygons. err=%s" % gdal.GetLastErrorMsg())
+    labels = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    source = None
+    return labels
+
+
+def nonOverlappingGroups(geoPolygons):
+    """Splits the positions of geoPolygons into groups in which no two polygons overlap (sharing borders is fine), so that each group
+       can be rasterized into a single label raster with rasterizePolygons. Returns a list of lists of positions. Polygons that
+       don't overlap any other are all in the first group"""
+    polygons = [Polygon(g) for g in geoPolygons]
+    tree = STRtree(polygons)
+    groupOf = []
+    groups = []
+    for i, polygon in enumerate(polygons):
+        used = set([groupOf[j] for j in _strtreeQuery(tree, polygons, polygon) if j < i and polygon.intersection(polygons[j]).area > 0])
+        group = 0
+        while group in used:
+            group += 1
+        if group == len(groups):
+            groups.append([])
+        groups[group].append(i)
+        groupOf.append(group)
+    return groups
+
+
+def warpRegionWindows(sourceFiles, bounds, geoPolygons, pixelSize=None, dtype=None, mask=False, nodata=0, useGdalApi=True, tmpDir=None):
+    """Reads the window of each of geoPolygons (EPSG:4326) from sourceFiles combined in EPSG:3857 limited to bounds (which should cover
+       all polygons). The sources are opened and reprojected once through a warped VRT, from which only the pixels of each window are computed.
+       Returns a list of (data, geoTransform, projection) in geoPolygons order. If mask is True, pixels outside each polygon are set to nodata"""
+    if useGdalApi:
+        vrtFile = "/vsimem/%s.vrt" % uuid.uuid4().hex
+        ds = gdal.Warp(vrtFile, sourceFiles, format='VRT', srcNodata=0, dstSRS='EPSG:3857', outputBounds=bounds, xRes=pixelSize, yRes=pixelSize)
+        _checkGdalResult(ds, 'warp', ' '.join(sourceFiles))
+    else:
+        vrtFile = "%s/%s.vrt" % (tmpDir, uuid.uuid4().hex)
+        os.makedirs(tmpDir, exist_ok=True)
+        tr = ''
+        if pixelSize is not None:
+            tr = '-tr %s %s' % (pixelSize, pixelSize)
+        _runGdalCommand('gdalwarp', "-of VRT -srcnodata 0 -t_srs EPSG:3857 -te %s %s %s %s %s %s %s" % (bounds[0], bounds[1], bounds[2], bounds[3], tr, ' '.join(sourceFiles), vrtFile))
+        ds = gdal.Open(vrtFile)
+
+    try:
+        geoTransform = ds.GetGeoTransform()
+        projection = ds.GetProjection()
+        results = []
+        for geoPolygon in geoPolygons:
+            xoff, yoff, xsize, ysize = regionWindow(geoPolygon, geoTransform, ds.RasterXSize, ds.RasterYSize)
+            if xsize == 0 or ysize == 0:
+                raise Exception("Polygon is outside of the region bounds. polygon=%s" % (geoPolygon,))
+            data = ds.ReadAsArray(xoff, yoff, xsize, ysize)
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+            windowTransform = (geoTransform[0] + xoff*geoTransform[1], geoTransform[1], 0, geoTransform[3] + yoff*geoTransform[5], 0, geoTransform[5])
+            if mask:
+                outside = rasterizePolygons([geoPolygon], windowTransform, xsize, ysize) == 0
+                data[..., outside] = nodata
+            results.append((data, windowTransform, projection))
+        return results
+    finally:
+        ds = None
+        if useGdalApi:
+            gdal.Unlink(vrtFile)
+        elif os.path.isfile(vrtFile):
+            os.remove(vrtFile)
@@ -11,6 +11,7 @@ setup(
     packages=find_packages(),
     install_requires=['uuid >= 1.3.0', 'gdal >= 2.2.2',
                       'requests >= 2.21.0', 'pandas >= 0.24.1', 
-                      'geopandas >= 0.4.1', 'shapely >= 1.6.4', 
+                      'shapely >= 1.6.4', 
                       'sentinelsat >= 0.12.2'],
+    extras_require={'async': ['aiohttp >= 3.6']},
 )
@@ -0,0 +1,72 @@
+"""CacheIndex eviction by age and by size with the lru and lfu policies"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from sentinelloader.cacheindex import CacheIndex
+
+DAY = 86400
+
+
+def _index(tmp_path, entries):
+    """Creates files of the given sizes (bytes) and indexes them. entries is a list of (name, size, days since last access, hits)"""
+    index = CacheIndex(str(tmp_path))
+    now = time.time()
+    for name, size, days, hits in entries:
+        path = str(tmp_path / 'products' / name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fw:
+            fw.write(b'\0' * size)
+        index.add(path, 'tile', lastAccess=now - days*DAY)
+        index._connection().execute('UPDATE artifacts SET hits=? WHERE key=?', (hits, index._key(path)))
+    return index
+
+
+def _remaining(tmp_path):
+    return sorted(os.listdir(str(tmp_path / 'products')))
+
+
+ENTRIES = [('a', 100, 1, 9), ('b', 200, 2, 1), ('c', 300, 3, 5), ('d', 400, 4, 2)]
+
+
+def test_evict_lru_within_max_bytes(tmp_path):
+    index = _index(tmp_path, ENTRIES)
+    assert index.totalSize() == 1000
+    #oldest first: d (400) and c (300) are enough to get within 350 bytes
+    assert index.evict(maxBytes=350, policy='lru') == (2, 700)
+    assert _remaining(tmp_path) == ['a', 'b']
+    assert index.totalSize() == 300
+    assert index.evict(maxBytes=300) == (0, 0)
+
+
+def test_evict_lfu_within_max_bytes(tmp_path):
+    index = _index(tmp_path, ENTRIES)
+    #fewest hits first: b (1 hit) and d (2 hits)
+    assert index.evict(maxBytes=500, policy='lfu') == (2, 600)
+    assert _remaining(tmp_path) == ['a', 'c']
+
+
+def test_hits_change_lru_and_lfu_order(tmp_path):
+    index = _index(tmp_path, ENTRIES)
+    for i in range(10):
+        index.hit(str(tmp_path / 'products' / 'd'), 'tile')
+    #d has the most hits now and it is the most recently used
+    assert index.evict(maxBytes=600, policy='lfu') == (2, 500)
+    assert _remaining(tmp_path) == ['a', 'd']
+    assert index.evict(maxBytes=400, policy='lru') == (1, 100)
+    assert _remaining(tmp_path) == ['d']
+
+
+def test_evict_not_used_days_and_missing_files(tmp_path):
+    index = _index(tmp_path, ENTRIES)
+    os.remove(str(tmp_path / 'products' / 'a'))
+    #files that are already gone are dropped from the index without counting them
+    assert index.evict(notUsedDays=2.5) == (2, 700)
+    assert index.evict(maxBytes=0) == (1, 200)
+    assert _remaining(tmp_path) == []
+    assert index.totalSize() == 0
+    with pytest.raises(Exception):
+        index.evict(maxBytes=0, policy='fifo')
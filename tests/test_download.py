@@ -0,0 +1,79 @@
+"""downloadFile range splitting and resume against the local OData stand-in of benchmarks/mockapi.py"""
+import os
+import sys
+
+import pytest
+import requests
+
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from mockapi import startServer
+from sentinelloader.utils import downloadFile, partialDownloadBytes
+
+SIZE = 300000
+
+
+@pytest.fixture
+def server(tmp_path):
+    os.makedirs(str(tmp_path / 'products' / 'p1'))
+    with open(str(tmp_path / 'products' / 'p1' / 'image.jp2'), 'wb') as fw:
+        fw.write(os.urandom(SIZE))
+    server = startServer(str(tmp_path / 'products'))
+    yield server
+    server.shutdown()
+
+
+def _url(server):
+    return server.apiUrl + "odata/v1/Products('p1')/Nodes('x.SAFE')/Nodes('image.jp2')/$value"
+
+
+def _contents(server):
+    with open(os.path.join(server.dataDir, 'p1', 'image.jp2'), 'rb') as fr:
+        return fr.read()
+
+
+def _served(server):
+    return requests.get(server.apiUrl + 'stats').json()
+
+
+def test_parallel_ranges(server, tmp_path):
+    filepath = str(tmp_path / 'out' / 'image.jp2')
+    size = downloadFile(_url(server), filepath, 'user', 'password', parallelRanges=3, minRangeSize=1000, showProgress=False)
+    assert size == SIZE
+    with open(filepath, 'rb') as fr:
+        assert fr.read() == _contents(server)
+    assert _served(server) == {'requests': 3, 'bytes': SIZE}
+    assert os.listdir(str(tmp_path / 'out')) == ['image.jp2']
+
+
+def test_resume_single_stream(server, tmp_path):
+    filepath = str(tmp_path / 'out' / 'image.jp2')
+    os.makedirs(os.path.dirname(filepath))
+    with open(filepath + '.part', 'wb') as fw:
+        fw.write(_contents(server)[:120000])
+    assert partialDownloadBytes(filepath, 4) == 120000
+    downloadFile(_url(server), filepath, 'user', 'password', showProgress=False)
+    with open(filepath, 'rb') as fr:
+        assert fr.read() == _contents(server)
+    assert _served(server)['bytes'] == SIZE - 120000
+
+
+def test_resume_ranges_after_interrupted_assembly(server, tmp_path):
+    filepath = str(tmp_path / 'out' / 'image.jp2')
+    os.makedirs(os.path.dirname(filepath))
+    contents = _contents(server)
+    #first range complete, second one partial and the assembly of a previous call interrupted
+    with open(filepath + '.part0of2', 'wb') as fw:
+        fw.write(contents[:SIZE//2])
+    with open(filepath + '.part1of2', 'wb') as fw:
+        fw.write(contents[SIZE//2:SIZE//2 + 1000])
+    with open(filepath + '.part-assembly', 'wb') as fw:
+        fw.write(contents[:SIZE//2 + 500])
+    assert partialDownloadBytes(filepath, 2) == SIZE//2 + 1000
+    assert partialDownloadBytes(filepath) == 0
+    downloadFile(_url(server), filepath, 'user', 'password', parallelRanges=2, minRangeSize=1000, showProgress=False)
+    with open(filepath, 'rb') as fr:
+        assert fr.read() == contents
+    assert _served(server)['bytes'] == SIZE - SIZE//2 - 1000
+    assert os.listdir(os.path.dirname(filepath)) == ['image.jp2']
@@ -0,0 +1,74 @@
+"""calculateIndices formulas, no data handling and int16 scaling"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from sentinelloader.indices import calculateIndices, requiredBands, INDEX_NAMES, INT16_NODATA
+
+
+def _bands():
+    rng = np.random.RandomState(11)
+    bands = dict([(band, rng.randint(1, 10000, size=(37, 23)).astype(np.uint16)) for band in ['B02', 'B03', 'B04', 'B08', 'B8A', 'B11']])
+    #no data in one band of each index
+    bands['B04'][0, 0] = 0
+    bands['B11'][1, 1] = 0
+    bands['B03'][2, 2] = 0
+    bands['B02'][3, 3] = 0
+    return bands
+
+
+def _reference(indexName, bands, nirBand='B08'):
+    b = dict([(band, bands[band].astype(np.float64)) for band in bands])
+    nir = b[nirBand]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if indexName == 'NDVI':
+            values, sources = (nir - b['B04']) / (nir + b['B04']), [nir, b['B04']]
+        elif indexName in ['NDWI', 'NDMI']:
+            values, sources = (nir - b['B11']) / (nir + b['B11']), [nir, b['B11']]
+        elif indexName == 'NDWI_MacFeeters':
+            values, sources = (b['B03'] - nir) / (b['B03'] + nir), [b['B03'], nir]
+        else:
+            values, sources = 2.5 * (nir - b['B04']) / (nir + 6.0*b['B04'] - 7.5*b['B02'] + 1.0), [nir, b['B04'], b['B02']]
+    for source in sources:
+        values[source == 0] = np.nan
+    values[~np.isfinite(values)] = np.nan
+    return values
+
+
+def test_formulas_and_nodata():
+    bands = _bands()
+    indices = calculateIndices(INDEX_NAMES, bands, blockRows=5)
+    for indexName in INDEX_NAMES:
+        assert indices[indexName].dtype == np.float32
+        np.testing.assert_allclose(indices[indexName], _reference(indexName, bands), rtol=1e-5, atol=1e-6, equal_nan=True)
+    assert np.isnan(indices['NDVI'][0, 0]) and np.isnan(indices['EVI'][3, 3]) and np.isnan(indices['NDWI_MacFeeters'][2, 2])
+    assert np.isfinite(indices['NDVI'][1, 1])
+
+
+def test_zero_divisor():
+    #EVI divisor: 0.5 + 6*1 - 7.5*1 + 1 = 0
+    bands = {'B08': np.array([[0.5, 0.5]], dtype=np.float32), 'B04': np.array([[1, 1]], dtype=np.float32), 'B02': np.array([[1, 0.5]], dtype=np.float32)}
+    evi = calculateIndices(['EVI'], bands, nodata=-9)['EVI']
+    np.testing.assert_allclose(evi, [[-9, 2.5*(0.5 - 1)/(0.5 + 6 - 3.75 + 1)]], rtol=1e-6)
+
+
+def test_scale_to_int16():
+    bands = _bands()
+    indices = calculateIndices(['NDVI', 'EVI'], bands, scale=10000)
+    for indexName in ['NDVI', 'EVI']:
+        reference = _reference(indexName, bands)
+        expected = np.where(np.isnan(reference), INT16_NODATA, np.clip(np.rint(reference*10000), -32767, 32767))
+        assert indices[indexName].dtype == np.int16
+        #float32 rounding may move values at .5 by one unit
+        assert np.abs(indices[indexName].astype(np.int64) - expected).max() <= 1
+        assert np.array_equal(indices[indexName] == INT16_NODATA, np.isnan(reference))
+
+
+def test_nir_band_and_required_bands():
+    bands = _bands()
+    assert requiredBands(['NDVI', 'EVI', 'NDMI'], nirBand='B8A') == ['B8A', 'B04', 'B02', 'B11']
+    ndvi = calculateIndices(['NDVI'], bands, nirBand='B8A')['NDVI']
+    np.testing.assert_allclose(ndvi, _reference('NDVI', bands, nirBand='B8A'), rtol=1e-5, equal_nan=True)
+    with pytest.raises(Exception):
+        requiredBands(['SAVI'])
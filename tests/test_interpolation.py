@@ -0,0 +1,69 @@
+"""interpolateTimeSeries gap filling compared against per pixel NumPy references"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from sentinelloader.utils import interpolateTimeSeries
+
+NAN = np.nan
+#irregular time steps (days) to catch weights computed from positions instead of times
+TIMES = [0, 5, 15, 20, 40]
+
+
+def _stack(*series):
+    """Stack of shape (time, 1, pixels) with one pixel per series"""
+    return np.array(series, dtype=np.float32).T.reshape((len(series[0]), 1, len(series)))
+
+
+def _pixels(stack):
+    return [list(s) for s in stack.reshape((stack.shape[0], -1)).T]
+
+
+def _assertSeries(stack, expected):
+    for result, exp in zip(_pixels(stack), expected):
+        np.testing.assert_allclose(result, exp, rtol=1e-6, equal_nan=True)
+
+
+def test_linear_matches_numpy_interp():
+    rng = np.random.RandomState(3)
+    stack = rng.uniform(0, 1, size=(len(TIMES), 4, 5)).astype(np.float32)
+    stack[rng.uniform(size=stack.shape) < 0.4] = NAN
+    stack[0] = rng.uniform(0, 1, size=(4, 5))
+    stack[-1] = rng.uniform(0, 1, size=(4, 5))
+    expected = np.empty_like(stack)
+    for i in range(4):
+        for j in range(5):
+            valid = ~np.isnan(stack[:, i, j])
+            expected[:, i, j] = np.interp(TIMES, np.asarray(TIMES)[valid], stack[valid, i, j])
+    result = interpolateTimeSeries(stack, TIMES, 'linear')
+    assert result is stack
+    np.testing.assert_allclose(stack, expected, rtol=1e-6)
+
+
+def test_linear_keeps_edges_and_empty_pixels():
+    stack = _stack([NAN, 1, NAN, 3, NAN], [NAN]*5, [2, 2, 2, 2, 2])
+    interpolateTimeSeries(stack, TIMES, 'linear')
+    #no value before the first or after the last valid date to interpolate from
+    _assertSeries(stack, [[NAN, 1, 1 + 2*10/15., 3, NAN], [NAN]*5, [2]*5])
+
+
+def test_nearest():
+    stack = _stack([NAN, 1, NAN, 3, NAN], [4, NAN, NAN, NAN, 8], [NAN]*5)
+    interpolateTimeSeries(stack, TIMES, 'nearest')
+    #t=15 is 10 days after t=5 and 5 days before t=20. Ties (t=20 between 0 and 40) take the previous value
+    _assertSeries(stack, [[1, 1, 3, 3, 3], [4, 4, 4, 4, 8], [NAN]*5])
+
+
+def test_previous():
+    stack = _stack([NAN, 1, NAN, 3, NAN], [4, NAN, NAN, NAN, 8], [NAN]*5)
+    interpolateTimeSeries(stack, TIMES, 'previous')
+    _assertSeries(stack, [[NAN, 1, 1, 3, 3], [4, 4, 4, 4, 8], [NAN]*5])
+
+
+def test_single_date_and_invalid_method():
+    stack = _stack([NAN], [7])
+    interpolateTimeSeries(stack, [0], 'linear')
+    _assertSeries(stack, [[NAN], [7]])
+    with pytest.raises(Exception):
+        interpolateTimeSeries(stack, [0], 'cubic')
@@ -0,0 +1,63 @@
+"""Cache lock files: stale lock removal and waiters of a removed lock file"""
+import os
+import threading
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from sentinelloader.utils import acquireCacheLock, releaseCacheLock, removeStaleLocks
+
+
+def _lockFiles(dataPath):
+    return os.listdir(os.path.join(dataPath, 'locks'))
+
+
+def test_remove_stale_locks_keeps_held_ones(tmp_path):
+    dataPath = str(tmp_path)
+    assert removeStaleLocks(dataPath) == 0
+    held = acquireCacheLock(dataPath, os.path.join(dataPath, 'products', 'a.tiff'))
+    releaseCacheLock(acquireCacheLock(dataPath, os.path.join(dataPath, 'products', 'b.tiff')))
+    assert len(_lockFiles(dataPath)) == 2
+
+    assert removeStaleLocks(dataPath) == 1
+    assert _lockFiles(dataPath) == [os.path.basename(held.name)]
+    releaseCacheLock(held)
+    assert removeStaleLocks(dataPath) == 1
+    assert _lockFiles(dataPath) == []
+
+
+def test_waiter_locks_the_new_file_after_removal(tmp_path):
+    dataPath = str(tmp_path)
+    cacheFile = os.path.join(dataPath, 'products', 'a.tiff')
+    held = acquireCacheLock(dataPath, cacheFile)
+    acquired = []
+
+    def waiter(name):
+        lock = acquireCacheLock(dataPath, cacheFile)
+        acquired.append((name, os.fstat(lock.fileno()).st_ino))
+        ready.wait(10)
+        releaseCacheLock(lock)
+
+    ready = threading.Event()
+    first = threading.Thread(target=waiter, args=('first',))
+    first.start()
+    first.join(0.3)
+    assert acquired == []
+
+    #same steps as removeStaleLocks once it holds the lock
+    os.remove(held.name)
+    releaseCacheLock(held)
+    first.join(0.3)
+    assert [name for name, inode in acquired] == ['first']
+    assert acquired[0][1] == os.stat(held.name).st_ino
+
+    #the lock on the new file still excludes other threads
+    second = threading.Thread(target=waiter, args=('second',))
+    second.start()
+    second.join(0.3)
+    assert len(acquired) == 1
+    ready.set()
+    first.join(10)
+    second.join(10)
+    assert [name for name, inode in acquired] == ['first', 'second']
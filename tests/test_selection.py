@@ -0,0 +1,56 @@
+"""Product selection with a single bulk catalogue query must match selection with one query per date"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from mockapi import MockSentinelAPI, _catalogueDataframe
+from sentinelloader import Sentinel2Loader
+
+AREA = [(-47.99, -16.02), (-47.91, -16.02), (-47.91, -16.08), (-47.99, -16.08)]
+
+
+def _footprint(minLon, minLat, maxLon, maxLat):
+    coords = " ".join(["%s,%s" % (lat, lon) for lon, lat in [(minLon, maxLat), (minLon, minLat), (maxLon, minLat), (maxLon, maxLat), (minLon, maxLat)]])
+    return '<gml:Polygon xmlns:gml="http://www.opengis.net/gml"><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>%s</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>' % coords
+
+
+def _catalogue():
+    """Two adjacent tiles sensed in the afternoon every 5 days, plus an extra product late on one of the dates"""
+    rows = []
+    for d in range(6):
+        dateObj = datetime(2019, 1, 1) + timedelta(days=d*5)
+        for column, bounds in enumerate([(-48.0, -16.1, -47.95, -16.0), (-47.95, -16.1, -47.9, -16.0)]):
+            rows.append({'uuid': 'p%d-%d' % (d, column), 'title': 't%d-%d' % (d, column), 'producttype': 'S2MSI2A', 'platformname': 'Sentinel-2',
+                         'beginposition': dateObj.strftime('%Y-%m-%d 13:22:31'), 'ingestiondate': dateObj.strftime('%Y-%m-%d 15:30:00'),
+                         'cloudcoverpercentage': float((d*7 + column*3) % 60), 'gmlfootprint': _footprint(*bounds)})
+    rows.append(dict(rows[4], uuid='late', title='late', beginposition='2019-01-11 23:59:00', ingestiondate='2019-01-12 02:00:00'))
+    return _catalogueDataframe(rows)
+
+
+def _selection(sl, dateRefStr):
+    try:
+        return sorted(sl._selectProducts(AREA, dateRefStr)[1]['uuid'])
+    except Exception as e:
+        return str(e)
+
+
+def test_bulk_and_per_date_selection_match(tmp_path):
+    sl = Sentinel2Loader(str(tmp_path), 'user', 'password', showProgressbars=False, cacheApiCalls=False)
+    sl.api = MockSentinelAPI(_catalogue())
+    dates = sl._historyDates('2019-01-01', '2019-01-28', 3)
+
+    perDate = [_selection(sl, d.strftime('%Y-%m-%d')) for d in dates]
+    queries = sl.api.queries
+    with sl._bulkQuery([AREA], dates):
+        bulk = [_selection(sl, d.strftime('%Y-%m-%d')) for d in dates]
+
+    assert bulk == perDate
+    assert sl.api.queries == queries + 1
+    #the end of the date range is midnight, so products sensed on the reference date itself are not selected
+    assert isinstance(perDate[0], str)
+    assert perDate[dates.index(datetime(2019, 1, 7))] == ['p1-0', 'p1-1']
@@ -0,0 +1,91 @@
+"""zonalStatistics, nonOverlappingGroups and rasterizePolygons compared against NumPy on synthetic label grids"""
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from sentinelloader.utils import zonalStatistics, nonOverlappingGroups, rasterizePolygons
+
+R = 6378137.0
+
+
+def _grid():
+    rng = np.random.RandomState(7)
+    data = rng.normal(100, 30, size=(60, 80)).astype(np.float32)
+    labels = rng.randint(0, 6, size=data.shape).astype(np.int32)
+    #zone 6 has no pixels and zone 5 only invalid ones
+    valid = rng.uniform(size=data.shape) < 0.8
+    valid[labels == 5] = False
+    return data, labels, valid
+
+
+def _reference(data, labels, valid, zone, stat):
+    values = data[(labels == zone) & valid].astype(np.float64)
+    if stat == 'count':
+        return float(len(values))
+    if len(values) == 0:
+        return np.nan
+    if stat.startswith('p'):
+        return np.percentile(values, float(stat[1:]))
+    return getattr(np, stat)(values)
+
+
+def test_zonal_statistics_match_numpy():
+    data, labels, valid = _grid()
+    stats = ['count', 'mean', 'std', 'min', 'max', 'median', 'p10', 'p90', 'p2.5']
+    results = zonalStatistics(data, labels, 6, stats, valid)
+    for stat in stats:
+        assert results[stat].shape == (6,)
+        expected = [_reference(data, labels, valid, zone, stat) for zone in range(1, 7)]
+        np.testing.assert_allclose(results[stat], expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+def test_zonal_statistics_without_valid_mask_and_unknown_stat():
+    data, labels, _ = _grid()
+    results = zonalStatistics(data, labels, 5, ['count', 'mean'])
+    everything = np.ones(data.shape, dtype=bool)
+    np.testing.assert_allclose(results['count'], [_reference(data, labels, everything, z, 'count') for z in range(1, 6)])
+    np.testing.assert_allclose(results['mean'], [_reference(data, labels, everything, z, 'mean') for z in range(1, 6)])
+    with pytest.raises(Exception):
+        zonalStatistics(data, labels, 5, ['mode'])
+
+
+def _box(minx, miny, maxx, maxy):
+    return [(minx, maxy), (minx, miny), (maxx, miny), (maxx, maxy)]
+
+
+def test_non_overlapping_groups():
+    polygons = [_box(0, 0, 2, 2), _box(2, 0, 4, 2), _box(1, 1, 3, 3), _box(5, 5, 6, 6), _box(1.5, 0.5, 2.5, 1.5)]
+    #sharing a border is not an overlap. Each group must be free of overlaps and polygons go to the first group they fit in
+    assert nonOverlappingGroups(polygons) == [[0, 1, 3], [2], [4]]
+
+
+def _lonLat(x, y):
+    return (math.degrees(x / R), math.degrees(2*math.atan(math.exp(y / R)) - math.pi/2))
+
+
+def _geoBox(x0, y0, pixel, cols, rows):
+    """Polygon in EPSG:4326 for a rectangle given in pixels of a EPSG:3857 grid with origin (x0, y0)"""
+    def corner(c, r):
+        return _lonLat(x0 + c*pixel, y0 - r*pixel)
+    return [corner(cols[0], rows[0]), corner(cols[0], rows[1]), corner(cols[1], rows[1]), corner(cols[1], rows[0])]
+
+
+def test_rasterize_polygons_pixel_centers():
+    x0, y0, pixel = -5342000.0, -1804000.0, 10.0
+    geoTransform = (x0, pixel, 0.0, y0, 0.0, -pixel)
+    polygons = [_geoBox(x0, y0, pixel, (2.25, 10.25), (1.25, 6.75)),
+                _geoBox(x0, y0, pixel, (8.25, 14.75), (4.25, 9.25)),
+                #smaller than a pixel and not covering any pixel center
+                _geoBox(x0, y0, pixel, (16.1, 16.4), (2.1, 2.4))]
+    labels = rasterizePolygons(polygons, geoTransform, 20, 12)
+
+    expected = np.zeros((12, 20), dtype=np.int32)
+    cols, rows = np.meshgrid(np.arange(20) + 0.5, np.arange(12) + 0.5)
+    for i, (c, r) in enumerate([((2.25, 10.25), (1.25, 6.75)), ((8.25, 14.75), (4.25, 9.25))]):
+        expected[(cols > c[0]) & (cols < c[1]) & (rows > r[0]) & (rows < r[1])] = i + 1
+    #the last polygon wins where they overlap and the sub-pixel one gets no pixels
+    np.testing.assert_array_equal(labels, expected)
+    assert np.bincount(labels.ravel(), minlength=4)[3] == 0